@@ -0,0 +1,66 @@
+import os
+import asyncio
+import functools
+import threading
+import contextvars
+import concurrent.futures
+
+
+# Threads for SDK calls that have no asyncio API (Storage, Files API, token counting)
+ASYNC_IO_THREADS = int(os.getenv("ASYNC_IO_THREADS", 32))
+
+# Blocking calls made by coroutines run here, so the number of threads stays bounded
+# however many pipelines are in flight
+io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=ASYNC_IO_THREADS, thread_name_prefix="async-io")
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+# Function to run a blocking call from a coroutine without blocking the event loop
+async def run_io(fn, *args, **kwargs):
+    # Copy the context so the request id and deadline follow the call into the thread
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, fn, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(io_executor, call)
+
+
+# Function to get the worker's shared event loop, starting its thread on first use
+def get_loop():
+    """Returns the event loop that runs every pipeline coroutine of this process.
+
+    The loop runs forever in a daemon thread, so request threads and job
+    workers can hand it coroutines with submit or run.
+    """
+    global _loop
+    if _loop is not None:
+        return _loop
+
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="event-loop", daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+async def _in_context(values, coroutine):
+    # Tasks start from the loop thread's context; bring over the submitting thread's variables
+    for var, value in values:
+        var.set(value)
+    return await coroutine
+
+
+# Function to schedule a coroutine on the shared loop from any thread
+def submit(coroutine):
+    """Returns a concurrent.futures.Future of the coroutine's result.
+
+    The coroutine sees the caller's context variables, such as the request id.
+    """
+    values = list(contextvars.copy_context().items())
+    return asyncio.run_coroutine_threadsafe(_in_context(values, coroutine), get_loop())
+
+
+# Function to run a coroutine on the shared loop and wait for its result
+def run(coroutine, timeout=None):
+    return submit(coroutine).result(timeout)
@@ -0,0 +1,241 @@
+import os
+import ffmpeg
+import numpy as np
+import metrics
+
+
+# Analyze the project's audio locally and tell Gemini its timing in the prompt
+AUDIO_ANALYSIS = os.getenv("AUDIO_ANALYSIS", "1") == "1"
+# Also upload the audio file to Gemini; with AUDIO_UPLOAD=0 the timing summary replaces it
+AUDIO_UPLOAD = os.getenv("AUDIO_UPLOAD", "1") == "1"
+# Move the audio_edits Gemini returns onto the nearest beat
+SNAP_AUDIO_EDITS = os.getenv("SNAP_AUDIO_EDITS", "1") == "1"
+AUDIO_ANALYSIS_SAMPLE_RATE = int(os.getenv("AUDIO_ANALYSIS_SAMPLE_RATE", 22050))
+# Length of the loudness segments described in the prompt
+AUDIO_LOUDNESS_SEGMENT_SECONDS = float(os.getenv("AUDIO_LOUDNESS_SEGMENT_SECONDS", 2))
+# Strongest onsets listed in the prompt
+AUDIO_MAX_ONSETS = int(os.getenv("AUDIO_MAX_ONSETS", 24))
+
+FRAME_LENGTH = 2048
+HOP_LENGTH = 512
+MIN_BPM = 60
+MAX_BPM = 200
+
+audio_snaps = metrics.Counter(
+    "audio_edit_snaps_total",
+    "audio_edits moved onto the beat grid, by result",
+    labelnames=("result",),
+)
+
+
+# Function to decode an audio (or video) file into mono float samples in memory
+def decode_audio(path, sample_rate=AUDIO_ANALYSIS_SAMPLE_RATE):
+    out, _ = (
+        ffmpeg
+        .input(path)
+        .audio
+        .output('pipe:', format='f32le', acodec='pcm_f32le', ac=1, ar=sample_rate)
+        .run(capture_stdout=True, quiet=True)
+    )
+    return np.frombuffer(out, np.float32)
+
+
+# Function to split samples into overlapping analysis frames without copying them
+def frame_samples(samples, frame_length=FRAME_LENGTH, hop_length=HOP_LENGTH):
+    if len(samples) < frame_length:
+        samples = np.pad(samples, (0, frame_length - len(samples)))
+    count = 1 + (len(samples) - frame_length) // hop_length
+    return np.lib.stride_tricks.as_strided(
+        samples, shape=(count, frame_length), strides=(samples.strides[0] * hop_length, samples.strides[0]),
+        writeable=False)
+
+
+# Function to measure how strongly new sounds start in each frame
+def onset_strength(frames):
+    """Returns the spectral flux of every frame: the summed increase of its log
+    magnitude spectrum over the previous frame, normalized to a peak of 1."""
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(frames.shape[1]).astype(np.float32), axis=1))
+    log_spectrum = np.log1p(100 * spectrum)
+    flux = np.zeros(len(frames), dtype=np.float32)
+    flux[1:] = np.maximum(np.diff(log_spectrum, axis=0), 0).sum(axis=1)
+    # Remove the slowly varying part, so sustained loud passages do not look like onsets
+    window = 16
+    baseline = np.convolve(flux, np.ones(window) / window, mode='same')
+    flux = np.maximum(flux - baseline, 0)
+    peak = flux.max()
+    return flux / peak if peak > 0 else flux
+
+
+# Function to estimate the tempo from the periodicity of the onsets
+def estimate_tempo(onsets, frame_rate, min_bpm=MIN_BPM, max_bpm=MAX_BPM):
+    """Returns (beats per minute, beat period in frames) from the onset autocorrelation.
+
+    Lags are weighted towards 120 BPM, so a track is not read at half or
+    double its tempo when both fit about as well. The period is a whole
+    number of frames; beat_grid refines it.
+    """
+    size = 1 << int(np.ceil(np.log2(2 * len(onsets))))
+    spectrum = np.fft.rfft(onsets - onsets.mean(), size)
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum), size)[:len(onsets)]
+
+    lags = np.arange(len(autocorrelation))
+    valid = (lags >= frame_rate * 60 / max_bpm) & (lags <= frame_rate * 60 / min_bpm)
+    if not valid.any():
+        return 0.0, 0
+    bpm = 60 * frame_rate / np.maximum(lags, 1)
+    weighted = autocorrelation * np.exp(-0.5 * np.log2(bpm / 120) ** 2)
+    period = int(lags[valid][np.argmax(weighted[valid])])
+    return 60 * frame_rate / period, period
+
+
+# Function to place a regular beat grid on the onsets
+def beat_grid(onsets, period, tolerance=0.02, steps=41):
+    """Fits evenly spaced beats to the onsets.
+
+    Every period within `tolerance` of the estimate is tried at every phase,
+    and the grid that hits the most (lightly smoothed) onset strength wins.
+    A weighted line through the onset peaks next to those beats then fixes
+    the period precisely, so the grid does not drift off the beat over a long
+    track.
+
+    Returns:
+        A tuple of the beat frames and the fitted period in frames.
+    """
+    if period <= 0:
+        return np.array([], dtype=int), period
+    smoothed = np.convolve(onsets, [0.25, 0.5, 0.25], mode='same')
+    periods = period * np.linspace(1 - tolerance, 1 + tolerance, steps)
+    phases = np.arange(int(np.ceil(period)))
+    beat_numbers = np.arange(int(len(onsets) / periods.min()) + 1)
+    # positions[period, phase, beat]
+    positions = np.rint(phases[None, :, None] + periods[:, None, None] * beat_numbers[None, None, :]).astype(int)
+    inside = positions < len(onsets)
+    strength = np.where(inside, smoothed[np.minimum(positions, len(onsets) - 1)], 0).sum(axis=2)
+    best_period, best_phase = np.unravel_index(np.argmax(strength), strength.shape)
+    beats = positions[best_period, best_phase][inside[best_period, best_phase]]
+    period = float(periods[best_period])
+
+    # Refine with a weighted line through the onset peak nearest each beat
+    reach = max(1, int(period / 4))
+    windows = np.clip(beats[:, None] + np.arange(-reach, reach + 1)[None, :], 0, len(onsets) - 1)
+    values = smoothed[windows]
+    peaks = windows[np.arange(len(beats)), np.argmax(values, axis=1)]
+    weights = values.max(axis=1)
+    on_beat = weights > 0.1
+    if on_beat.sum() >= 4:
+        period, phase = np.polyfit(np.flatnonzero(on_beat), peaks[on_beat], 1, w=weights[on_beat])
+        phase -= np.floor(phase / period) * period
+        beats = np.rint(phase + period * np.arange(int((len(onsets) - 1 - phase) / period) + 1)).astype(int)
+    return beats, float(period)
+
+
+# Function to pick the strongest onsets, at most one per beat period
+def strong_onsets(onsets, min_gap, max_onsets=AUDIO_MAX_ONSETS):
+    peaks = np.flatnonzero((onsets[1:-1] > onsets[:-2]) & (onsets[1:-1] >= onsets[2:]) & (onsets[1:-1] > 0.3)) + 1
+    keep = []
+    for frame in peaks[np.argsort(-onsets[peaks], kind='stable')]:
+        if all(abs(frame - kept) >= min_gap for kept in keep):
+            keep.append(int(frame))
+        if len(keep) == max_onsets:
+            break
+    return sorted(keep)
+
+
+# Function to describe the loudness of the track in fixed segments
+def loudness_segments(frames, frame_rate, segment_seconds=AUDIO_LOUDNESS_SEGMENT_SECONDS):
+    """Returns [start, end, level] segments, where level is "quiet", "medium" or "loud"
+    relative to the track itself and neighbouring segments of the same level are merged."""
+    rms = np.sqrt(np.mean(frames.astype(np.float64) ** 2, axis=1))
+    decibels = 20 * np.log10(np.maximum(rms, 1e-5))
+    per_segment = max(1, int(round(segment_seconds * frame_rate)))
+    count = int(np.ceil(len(decibels) / per_segment))
+    padded = np.pad(decibels, (0, count * per_segment - len(decibels)), mode='edge')
+    levels = padded.reshape(count, per_segment).mean(axis=1)
+
+    low, high = np.percentile(levels, [33, 67])
+    names = np.where(levels <= low, "quiet", np.where(levels >= high, "loud", "medium"))
+    segments = []
+    for index, name in enumerate(names):
+        start = index * per_segment / frame_rate
+        end = min((index + 1) * per_segment, len(decibels)) / frame_rate
+        if segments and segments[-1][2] == name:
+            segments[-1][1] = end
+        else:
+            segments.append([start, end, str(name)])
+    return [[round(start, 2), round(end, 2), name] for start, end, name in segments]
+
+
+# Function to analyze the timing of an audio track
+def analyze_audio(path, sample_rate=AUDIO_ANALYSIS_SAMPLE_RATE):
+    """Decodes the track once and measures its tempo, beats, strongest onsets and loudness.
+
+    Returns:
+        A dictionary with 'duration', 'tempo' (beats per minute), 'beat_period'
+        and 'beats' (seconds), 'onsets' (seconds) and 'loudness' ([start, end,
+        level] segments).
+    """
+    samples = decode_audio(path, sample_rate)
+    frames = frame_samples(samples)
+    frame_rate = sample_rate / HOP_LENGTH
+    onsets = onset_strength(frames)
+    tempo, period = estimate_tempo(onsets, frame_rate)
+    beats, period = beat_grid(onsets, period)
+    tempo = 60 * frame_rate / period if period else 0.0
+
+    # Frames are stamped with the time of their centre
+    def seconds(frame):
+        return float(frame / frame_rate + FRAME_LENGTH / 2 / sample_rate)
+
+    return {
+        'duration': round(len(samples) / sample_rate, 3),
+        'tempo': round(float(tempo), 1),
+        'beat_period': round(float(period / frame_rate), 4),
+        'beats': [round(seconds(frame), 3) for frame in beats],
+        'onsets': [round(seconds(frame), 2) for frame in strong_onsets(onsets, max(period, 1))],
+        'loudness': loudness_segments(frames, frame_rate),
+    }
+
+
+# Function to describe an analysis in a few lines of the prompt
+def timing_summary(analysis, attached=True):
+    lines = [f"Duration: {analysis['duration']:.2f}s."]
+    if analysis['beats']:
+        lines.append(f"Tempo: {analysis['tempo']:.0f} BPM. Beats fall every {analysis['beat_period']:.3f}s "
+                     f"starting at {analysis['beats'][0]:.3f}s.")
+    if analysis['onsets']:
+        lines.append("Strongest onsets (s): " + ", ".join(f"{onset:.2f}" for onset in analysis['onsets']) + ".")
+    lines.append("Loudness: " + ", ".join(f"{start:.1f}-{end:.1f}s {level}"
+                                          for start, end, level in analysis['loudness']) + ".")
+    if not attached:
+        lines.append("The audio file itself is not attached; choose the audio_edits from this timing.")
+    return "\n".join(lines)
+
+
+# Function to move the audio trim onto the beat grid without changing its length
+def snap_audio_edits(audio_edits, analysis):
+    """Moves start_time to the nearest beat and end_time with it, so the trimmed
+    audio still matches the length of the edited video.
+
+    Returns:
+        A new audio_edits dictionary; the input is returned unchanged when it has
+        no numeric times or the track has no beats.
+    """
+    try:
+        start_time, end_time = float(audio_edits['start_time']), float(audio_edits['end_time'])
+    except (KeyError, TypeError, ValueError):
+        audio_snaps.inc(result="skipped")
+        return audio_edits
+    beats = np.array(analysis['beats'])
+    length = end_time - start_time
+    if len(beats) == 0 or length <= 0:
+        audio_snaps.inc(result="skipped")
+        return audio_edits
+
+    # Only beats that leave room for the whole trim before the track ends
+    candidates = beats[beats + length <= analysis['duration']]
+    if len(candidates) == 0:
+        audio_snaps.inc(result="skipped")
+        return audio_edits
+    snapped = float(candidates[np.argmin(np.abs(candidates - start_time))])
+    audio_snaps.inc(result="snapped")
+    return {**audio_edits, 'start_time': round(snapped, 3), 'end_time': round(snapped + length, 3)}
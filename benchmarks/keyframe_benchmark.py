@@ -0,0 +1,135 @@
+"""Compares the full-video model input with the keyframe input (INPUT_MODE=keyframes).
+
+Synthetic clips with scene cuts are generated with ffmpeg's test sources, so no
+project media or credentials are needed:
+
+    python benchmarks/keyframe_benchmark.py --clips 6 --shot-seconds 4
+    python benchmarks/keyframe_benchmark.py --bandwidth-mbps 5
+
+For each input the local preparation time, the bytes sent to Gemini, the
+modelled upload time at --bandwidth-mbps and an estimate of the input tokens
+are printed. With --live and GEMINI_API_KEY set, both inputs are also sent to
+Gemini and the end-to-end latency of each is measured.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import ffmpeg
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from video import Video
+from keyframes import prepare_keyframe_input
+
+# Gemini's documented token rates for media input
+VIDEO_TOKENS_PER_SECOND = 263
+AUDIO_TOKENS_PER_SECOND = 32
+IMAGE_TOKENS = 258
+
+SHOT_SOURCES = ["testsrc2", "smptebars", "rgbtestsrc", "mandelbrot", "cellauto", "life"]
+
+
+def make_clips(directory, count, shots, shot_seconds, size):
+    """Writes `count` clips, each made of `shots` shots from different test sources."""
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"video_{i}.mp4")
+        segments = []
+        for shot in range(shots):
+            source = SHOT_SOURCES[(i + shot) % len(SHOT_SOURCES)]
+            video = ffmpeg.input(f"{source}=size={size}:rate=30", f='lavfi', t=shot_seconds).video.filter('format', 'yuv420p')
+            audio = ffmpeg.input(f"sine=frequency={220 + 40 * shot}:sample_rate=44100", f='lavfi', t=shot_seconds)
+            segments += [video, audio]
+        joined = ffmpeg.concat(*segments, v=1, a=1).node
+        ffmpeg.output(joined[0], joined[1], path, vcodec='libx264', pix_fmt='yuv420p',
+                      acodec='aac').overwrite_output().run(quiet=True)
+        paths.append(path)
+    return paths
+
+
+def prepare_video_input(paths, work_dir, proxy):
+    start = time.perf_counter()
+    video_path, video_durations, total_duration = Video.concatenate_videos({path: path for path in paths}, work_dir)
+    if proxy:
+        video_path, _ = Video.create_analysis_proxy(video_path, work_dir)
+    return {
+        'seconds': time.perf_counter() - start,
+        'bytes': os.path.getsize(video_path),
+        'tokens': int(total_duration * VIDEO_TOKENS_PER_SECOND),
+        'files': [video_path],
+        'parts': [],
+        'video_durations': video_durations,
+    }
+
+
+def prepare_keyframes(paths, work_dir):
+    start = time.perf_counter()
+    parts, video_durations, soundtrack_path, stats = prepare_keyframe_input(paths, work_dir)
+    total_duration = max(end for _, end in video_durations.values())
+    return {
+        'seconds': time.perf_counter() - start,
+        'bytes': stats['jpeg_bytes'] + stats['soundtrack_bytes'],
+        'tokens': stats['keyframes'] * IMAGE_TOKENS + int(total_duration * AUDIO_TOKENS_PER_SECOND),
+        'files': [soundtrack_path] if soundtrack_path else [],
+        'parts': parts,
+        'video_durations': video_durations,
+        'keyframes': stats['keyframes'],
+    }
+
+
+def run_live(result, prompt, model_name):
+    """Uploads the input's files, prompts Gemini and returns the end-to-end seconds."""
+    import google.generativeai as genai
+    from gemini import Gemini
+
+    genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+    model = genai.GenerativeModel(model_name, generation_config={"response_mime_type": "application/json"})
+    start = time.perf_counter()
+    files = [Gemini.upload_to_gemini(path, genai) for path in result['files']]
+    files = Gemini.wait_for_files_active(files, genai)
+    if result['parts']:
+        Gemini.prompt_gemini_api(files[0] if files else None, prompt, result['video_durations'], None, model,
+                                 keyframes=result['parts'])
+    else:
+        Gemini.prompt_gemini_api(files[0], prompt, result['video_durations'], None, model)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clips", type=int, default=6)
+    parser.add_argument("--shots", type=int, default=3, help="scene cuts per clip plus one")
+    parser.add_argument("--shot-seconds", type=float, default=4)
+    parser.add_argument("--size", default="1280x720")
+    parser.add_argument("--no-proxy", action="store_true", help="upload the concatenated video as is")
+    parser.add_argument("--bandwidth-mbps", type=float, default=20, help="uplink used to model upload time")
+    parser.add_argument("--live", action="store_true", help="also prompt Gemini with both inputs")
+    parser.add_argument("--model", default="gemini-1.5-flash")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        print(f"Generating {args.clips} clips of {args.shots} shots...")
+        paths = make_clips(work_dir, args.clips, args.shots, args.shot_seconds, args.size)
+
+        results = {
+            'video': prepare_video_input(paths, work_dir, proxy=not args.no_proxy),
+            'keyframes': prepare_keyframes(paths, work_dir),
+        }
+        print(f"Expected {args.clips * args.shots} shots, selected {results['keyframes']['keyframes']} keyframes\n")
+
+        print(f"{'input':<10} {'prepare':>9} {'payload':>11} {'upload':>9} {'total':>9} {'tokens':>8}")
+        for name, result in results.items():
+            upload_seconds = result['bytes'] * 8 / (args.bandwidth_mbps * 1e6)
+            print(f"{name:<10} {result['seconds']:>8.2f}s {result['bytes'] / 1e6:>9.2f}MB {upload_seconds:>8.2f}s "
+                  f"{result['seconds'] + upload_seconds:>8.2f}s {result['tokens']:>8}")
+
+        if args.live:
+            prompt = "Make an upbeat highlight reel"
+            for name, result in results.items():
+                print(f"{name} end to end with Gemini: {run_live(result, prompt, args.model):.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""Load test of POST /process_videos against local stand-ins for Firebase and Gemini.
+
+    python benchmarks/loadtest.py --requests 40 --concurrency 8
+    CPU_STAGE_CONCURRENCY=1 python benchmarks/loadtest.py --projects 4 --model-latency 2
+    ASYNC_PIPELINE=1 python benchmarks/loadtest.py --requests 200 --concurrency 100
+    python benchmarks/loadtest.py --preprocess      # prepare media from upload events first
+
+Clips are generated with ffmpeg, Storage is served from a temporary directory
+and the Gemini stand-in answers after --model-latency seconds, so the run
+exercises the real download, concatenation, proxy and stage limits of one
+worker process. Limits are read from the environment like in production.
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+import concurrent.futures
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def make_clip(path, seconds, color):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    subprocess.run(["ffmpeg", "-y", "-loglevel", "error",
+                    "-f", "lavfi", "-i", f"color=c={color}:s=640x360:r=30:d={seconds}",
+                    "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+                    "-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest", path], check=True)
+
+
+def make_projects(bucket_root, projects, clips, seconds):
+    """Writes `clips` clips for each of `projects` projects of user loadtest-user."""
+    colors = ["red", "green", "blue", "yellow", "purple", "orange"]
+    for project in range(projects):
+        for clip in range(clips):
+            path = os.path.join(bucket_root, f"users/loadtest-user/projects/p{project}/videos/clip{clip}.mp4")
+            make_clip(path, seconds, colors[(project + clip) % len(colors)])
+
+
+def install_fakes(main, bucket_root, model_latency, processing_seconds, storage_latency, video_latency=0.0):
+    """Points main's service globals at the stand-ins, so init_services has nothing to do.
+
+    Like the real module, the stand-in goes through main's Gemini scheduler when it has one.
+    """
+    import fakes
+    from quota import ScheduledGenai
+    from clip_store import ClipStore
+
+    genai = fakes.FakeGenaiModule(processing_seconds=processing_seconds, latency=model_latency,
+                                  video_latency=video_latency)
+    if main.gemini_scheduler is not None:
+        genai = ScheduledGenai(genai, main.gemini_scheduler)
+    main.genai = genai
+    main.auth = fakes.FakeAuth()
+    main.firestore = fakes.FakeFirestore()
+    main.async_firestore = fakes.FakeFirestoreAsync(main.firestore)
+    main.storage = fakes.FakeStorage(bucket_root, latency=storage_latency)
+    main.context_cache = None
+    main.result_cache = None
+    main.clip_store = ClipStore(os.path.join(os.path.dirname(bucket_root), "clip_store"))
+    main.model = genai.GenerativeModel(main.MODEL_NAME, main.generation_config)
+
+
+def post(url, payload, timeout, headers=None):
+    start = time.perf_counter()
+    request = urllib.request.Request(url, data=json.dumps(payload).encode(),
+                                     headers={'Content-Type': 'application/json', **(headers or {})})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except OSError:
+        status = "connection error"
+    return status, time.perf_counter() - start
+
+
+def preprocess_projects(main, url, bucket_root, timeout):
+    """Sends a finalize event for every clip and waits until each project has prepared media."""
+    import fakes
+    projects = set()
+    for dir_path, _, file_names in os.walk(bucket_root):
+        for file_name in file_names:
+            name = os.path.relpath(os.path.join(dir_path, file_name), bucket_root)
+            post(f"{url}/events/storage_finalize", fakes.storage_finalize_event(name), timeout,
+                 headers={'X-Event-Token': main.STORAGE_EVENT_TOKEN})
+            projects.add(name.split("/")[3])
+
+    start = time.perf_counter()
+    documents = main.firestore.client().documents
+    while time.perf_counter() - start < timeout:
+        ready = [project for project in projects
+                 if "preparedMedia" in documents.get(f"users/loadtest-user/projects/{project}", {})]
+        if len(ready) == len(projects):
+            print(f"Prepared {len(projects)} projects from upload events in {time.perf_counter() - start:.2f}s")
+            return
+        time.sleep(0.1)
+    raise SystemExit(f"Projects were not prepared within {timeout}s")
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] if ordered else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--projects", type=int, default=8, help="distinct projects the requests cycle through")
+    parser.add_argument("--clips", type=int, default=3)
+    parser.add_argument("--clip-seconds", type=float, default=4)
+    parser.add_argument("--model-latency", type=float, default=1.0)
+    parser.add_argument("--processing-seconds", type=float, default=0.5)
+    parser.add_argument("--storage-latency", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--url", help="load an already running server instead of an in-process one")
+    parser.add_argument("--preprocess", action="store_true",
+                        help="prepare every project from storage finalize events before the load (in-process only)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        bucket_root = os.path.join(work_dir, "bucket")
+        print(f"Generating {args.projects} projects of {args.clips} clips...")
+        make_projects(bucket_root, args.projects, args.clips, args.clip_seconds)
+
+        server = None
+        url = args.url
+        if url is None:
+            from werkzeug.serving import make_server
+            # Storage events are only accepted with a token, which is read at import time
+            os.environ.setdefault("STORAGE_EVENT_TOKEN", "loadtest")
+            import main as app_module
+            install_fakes(app_module, bucket_root, args.model_latency, args.processing_seconds, args.storage_latency)
+            server = make_server("127.0.0.1", 0, app_module.create_app(warm_up=False), threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = f"http://127.0.0.1:{server.server_port}"
+            if args.preprocess:
+                preprocess_projects(app_module, url, bucket_root, args.timeout)
+
+        payloads = [{'user_id': 'loadtest-user', 'project_id': f"p{i % args.projects}", 'prompt_id': f"prompt{i}",
+                     'gemini_prompt': "Make an upbeat highlight reel"} for i in range(args.requests)]
+
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(executor.map(lambda payload: post(f"{url}/process_videos", payload, args.timeout),
+                                        payloads))
+        wall = time.perf_counter() - start
+
+        if server is not None:
+            server.shutdown()
+
+        latencies = [seconds for status, seconds in results if status == 200]
+        print(f"\n{args.requests} requests, concurrency {args.concurrency}: {wall:.2f}s, "
+              f"{args.requests / wall:.2f} requests/s")
+        print(f"status: {dict(Counter(status for status, _ in results))}")
+        print(f"latency of successful requests: p50 {percentile(latencies, 0.5):.2f}s, "
+              f"p95 {percentile(latencies, 0.95):.2f}s, p99 {percentile(latencies, 0.99):.2f}s")
+
+        if args.url is None:
+            import metrics
+            print("\nStage metrics of this process:")
+            for line in metrics.render_prometheus().splitlines():
+                if line.startswith(("pipeline_stage_queue_seconds_sum", "pipeline_stage_queue_seconds_count",
+                                    "pipeline_stage_timeouts_total", "pipeline_stage_seconds_sum")):
+                    print(f"  {line}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Compares single-call analysis of a long project with the chunked map-reduce analysis.
+
+Both run the real pipeline (download, concatenation, proxy, upload, prompt,
+decode) against local stand-ins for Firebase and Gemini. The Gemini stand-in
+takes --model-latency seconds per call plus --video-latency seconds per second
+of attached footage, so a single call over the whole project is slower than
+parallel calls over its parts:
+
+    python benchmarks/map_reduce_benchmark.py --clips 12 --clip-seconds 60
+    python benchmarks/map_reduce_benchmark.py --concurrency 2 --reduce heuristic
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clips", type=int, default=12)
+    parser.add_argument("--clip-seconds", type=float, default=60)
+    parser.add_argument("--chunk-seconds", type=float, default=180)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--reduce", choices=("model", "heuristic"), default="model")
+    parser.add_argument("--model-latency", type=float, default=1.0)
+    parser.add_argument("--video-latency", type=float, default=0.02, help="seconds per second of attached footage")
+    parser.add_argument("--processing-seconds", type=float, default=0.5)
+    args = parser.parse_args()
+
+    # Settings are read at import time, like in production
+    os.environ["MAP_REDUCE_MIN_SECONDS"] = "0"
+    os.environ["MAP_CHUNK_SECONDS"] = str(args.chunk_seconds)
+    os.environ["MAP_CONCURRENCY"] = str(args.concurrency)
+    os.environ["REDUCE_MODE"] = args.reduce
+    import loadtest
+    import main as app_module
+    import map_reduce
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        bucket_root = os.path.join(work_dir, "bucket")
+        print(f"Generating {args.clips} clips of {args.clip_seconds:.0f}s...")
+        loadtest.make_projects(bucket_root, 1, args.clips, args.clip_seconds)
+        loadtest.install_fakes(app_module, bucket_root, args.model_latency, args.processing_seconds, 0.0,
+                               video_latency=args.video_latency)
+        chunks, _ = app_module.plan_project({
+            os.path.join(bucket_root, f"users/loadtest-user/projects/p0/videos/clip{clip}.mp4"): None
+            for clip in range(args.clips)})
+
+        results = {}
+        for name, enabled in (("single call", False), ("map-reduce", True)):
+            map_reduce.MAP_REDUCE = enabled
+            # Separate prompts, so neither run reuses the other's memoized response
+            start = time.perf_counter()
+            result = app_module.run_pipeline("loadtest-user", "p0", None, f"Make a highlight reel ({name})")
+            results[name] = (time.perf_counter() - start, result['gemini_response'])
+
+        print(f"\n{args.clips * args.clip_seconds:.0f}s of footage, {len(chunks)} chunks, "
+              f"concurrency {args.concurrency}, reduce by {args.reduce}")
+        for name, (seconds, gemini_response) in results.items():
+            edits = gemini_response['video_edits']
+            length = sum(edit['end_time'] - edit['start_time'] for edit in edits)
+            print(f"{name:<12} {seconds:>7.2f}s  {len(edits)} edits, {length:.1f}s of video")
+
+
+if __name__ == "__main__":
+    main()
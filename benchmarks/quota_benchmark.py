@@ -0,0 +1,85 @@
+"""Compares Gemini calls with and without the quota scheduler under a per-minute quota.
+
+A stand-in for Gemini enforces --rpm generate requests per minute, with the
+minute shortened to --window seconds so a run takes seconds rather than
+minutes. Half of the calls are sent from the interactive lane and half from
+the background lane (as pre-processing does):
+
+    python benchmarks/quota_benchmark.py --rpm 30 --calls 60
+    python benchmarks/quota_benchmark.py --backend file --threads 32
+
+Without the scheduler every call over the quota fails with a 429. With it,
+calls wait for their bucket, 429s are retried after the delay Gemini asks
+for, and interactive calls are served before background ones.
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import concurrent.futures
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakes
+import quota
+
+
+def run(genai, calls, threads):
+    model = genai.GenerativeModel()
+
+    def call(index):
+        lane = quota.INTERACTIVE if index % 2 else quota.BACKGROUND
+        start = time.perf_counter()
+        try:
+            with quota.priority(lane):
+                model.generate_content("Make a highlight reel")
+            succeeded = True
+        except Exception:
+            succeeded = False
+        return lane, succeeded, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(call, range(calls)))
+    return results, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rpm", type=int, default=30, help="generate requests Gemini allows per minute")
+    parser.add_argument("--window", type=float, default=6, help="seconds that stand in for a minute")
+    parser.add_argument("--calls", type=int, default=60)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per Gemini response")
+    parser.add_argument("--backend", choices=("memory", "file"), default="memory")
+    args = parser.parse_args()
+
+    # The scheduler's minute is shortened like the stand-in's
+    scale = 60 / args.window
+    runs = {}
+    for name in ("unscheduled", "scheduled"):
+        genai = fakes.FakeGenaiModule(latency=args.latency, generate_rpm=args.rpm, quota_window=args.window)
+        if name == "scheduled":
+            backend = quota.FileQuotaBackend() if args.backend == "file" else quota.MemoryQuotaBackend()
+            scheduler = quota.QuotaScheduler(backend, {quota.GENERATE: args.rpm * scale},
+                                             burst_seconds=args.window / 6, initial_backoff=args.window / 30,
+                                             max_backoff=args.window)
+            genai = quota.ScheduledGenai(genai, scheduler)
+        results, seconds = run(genai, args.calls, args.threads)
+        rejected = genai.quota.rejected
+        runs[name] = (results, seconds, rejected)
+
+    print(f"{args.calls} calls from {args.threads} threads, quota {args.rpm} per {args.window:.0f}s\n")
+    print(f"{'':<12} {'ok':>4} {'failed':>7} {'429s':>5} {'total':>8} {'interactive':>12} {'background':>11}")
+    for name, (results, seconds, rejected) in runs.items():
+        succeeded = sum(1 for _, ok, _ in results if ok)
+        latency = {lane: statistics.mean([elapsed for result_lane, ok, elapsed in results
+                                          if ok and result_lane == lane] or [0])
+                   for lane in (quota.INTERACTIVE, quota.BACKGROUND)}
+        print(f"{name:<12} {succeeded:>4} {len(results) - succeeded:>7} {rejected:>5} {seconds:>7.2f}s "
+              f"{latency[quota.INTERACTIVE]:>11.2f}s {latency[quota.BACKGROUND]:>10.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Compares the single-pass ffmpeg renderer, the parallel segment renderer and a naive per-clip MoviePy render.
+
+Synthetic clips are generated with ffmpeg's test sources, so no project media
+or credentials are needed:
+
+    python benchmarks/render_benchmark.py --clips 8 --clip-seconds 6
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import ffmpeg
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import helpers
+from render import Renderer
+
+
+def make_clips(directory, count, seconds, size):
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"video_{i}.mp4")
+        video = ffmpeg.input(f"testsrc2=size={size}:rate=30", f='lavfi', t=seconds)
+        audio = ffmpeg.input(f"sine=frequency={220 + 40 * i}:sample_rate=44100", f='lavfi', t=seconds)
+        ffmpeg.output(video, audio, path, vcodec='libx264', pix_fmt='yuv420p', acodec='aac').overwrite_output().run(quiet=True)
+        paths.append(path)
+    return paths
+
+
+def make_edits(paths, seconds):
+    rng = random.Random(0)
+    effect_choices = [
+        helpers.return_effect("brightness", [0.2]),
+        helpers.return_effect("contrast", [0.3]),
+        helpers.return_effect("saturation", [0.5]),
+        helpers.return_effect("rotate", [90]),
+        helpers.return_effect("zoomIn", [1.5, 1]),
+        helpers.return_effect("vignette", [0.5, 0.5]),
+    ]
+    edits = []
+    for i, path in enumerate(paths):
+        start = rng.uniform(0.2, seconds / 3)
+        end = rng.uniform(seconds / 2, seconds - 0.2)
+        effects = rng.sample(effect_choices, 2)
+        text = [helpers.return_text(f"Clip {i}", 24, "#ffffff", "#80000000")]
+        transition = rng.choice(["fade", "", "slide"])
+        edits.append(helpers.return_video_edit(i + 1, path, start, end, effects, text, transition))
+    return edits
+
+
+def render_with_moviepy(edits, output_path, work_dir):
+    """The naive approach: every clip is decoded, edited and encoded on its own and
+    the intermediates are decoded and encoded again when they are joined."""
+    from moviepy.editor import VideoFileClip, concatenate_videoclips, vfx
+
+    intermediates = []
+    for edit in edits:
+        clip = VideoFileClip(edit['video_name']).subclip(edit['start_time'], edit['end_time'])
+        for effect in edit['effects']:
+            value = effect['adjustment'][0]
+            if effect['name'] == 'brightness':
+                clip = clip.fx(vfx.colorx, 1 + value)
+            elif effect['name'] == 'contrast':
+                clip = clip.fx(vfx.lum_contrast, contrast=value)
+            elif effect['name'] == 'rotate':
+                clip = clip.rotate(value)
+        intermediate = os.path.join(work_dir, f"segment_{edit['id']}.mp4")
+        clip.write_videofile(intermediate, logger=None)
+        clip.close()
+        intermediates.append(intermediate)
+
+    clips = [VideoFileClip(path) for path in intermediates]
+    final = concatenate_videoclips(clips, method="compose")
+    final.write_videofile(output_path, logger=None)
+    for clip in clips:
+        clip.close()
+    return output_path
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clips", type=int, default=6)
+    parser.add_argument("--clip-seconds", type=float, default=6)
+    parser.add_argument("--size", default="1280x720")
+    parser.add_argument("--skip-moviepy", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        paths = make_clips(work_dir, args.clips, args.clip_seconds, args.size)
+        edits = make_edits(paths, args.clip_seconds)
+
+        results = []
+        output = os.path.join(work_dir, "ffmpeg_graph.mp4")
+        results.append(("ffmpeg filter graph", timed(Renderer.render, edits, {}, output, video_paths=paths),
+                        os.path.getsize(output)))
+
+        # Cold segment render, then a re-prompt that changes a single edit
+        cache_dir = os.path.join(work_dir, "segments")
+        output = os.path.join(work_dir, "segments_cold.mp4")
+        seconds = timed(Renderer.render_segments, edits, {}, output, video_paths=paths, cache_dir=cache_dir)
+        results.append(("segments (cold)", seconds, os.path.getsize(output)))
+        edits[0]['effects'] = [helpers.return_effect("brightness", [-0.1])]
+        output = os.path.join(work_dir, "segments_warm.mp4")
+        seconds = timed(Renderer.render_segments, edits, {}, output, video_paths=paths, cache_dir=cache_dir)
+        results.append(("segments (1 changed)", seconds, os.path.getsize(output)))
+
+        if not args.skip_moviepy:
+            output = os.path.join(work_dir, "moviepy.mp4")
+            results.append(("moviepy per clip", timed(render_with_moviepy, edits, output, work_dir),
+                            os.path.getsize(output)))
+
+    print(f"{args.clips} clips of {args.clip_seconds}s at {args.size}")
+    print(f"{'renderer':<22}{'seconds':>10}{'bytes':>14}")
+    for name, seconds, size in results:
+        print(f"{name:<22}{seconds:>10.2f}{size:>14}")
+
+
+if __name__ == "__main__":
+    main()
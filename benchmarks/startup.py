@@ -0,0 +1,108 @@
+"""Profiles worker startup: per-module import cost and time to the first served request.
+
+    python benchmarks/startup.py                      # import profile of main
+    python benchmarks/startup.py --first-request      # also time a cold app to its first response
+    python benchmarks/startup.py --gunicorn --path /metrics
+
+Run it against the previous commit to compare before and after.
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import subprocess
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_profile(module, top):
+    """Runs `python -X importtime -c "import module"` and returns the slowest imports."""
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                               cwd=ROOT, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if completed.returncode != 0:
+        print(completed.stderr.splitlines()[-1] if completed.stderr else "import failed")
+
+    rows = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # Nested imports are indented below the single separator space
+        rows.append((int(cumulative_us), int(self_us), name[1:].rstrip()))
+
+    # Keep the module itself and what it imports directly; each nesting level adds two spaces
+    packages = {}
+    for cumulative, _, name in rows:
+        if len(name) - len(name.lstrip(" ")) <= 2:
+            packages[name.strip()] = max(packages.get(name.strip(), 0), cumulative)
+    return wall, sorted(packages.items(), key=lambda item: -item[1])[:top]
+
+
+def first_request(path):
+    """Times a fresh interpreter from start to its first response through the Flask test client."""
+    script = (
+        "import time; start = time.perf_counter()\n"
+        "import main\n"
+        "imported = time.perf_counter()\n"
+        "client = main.create_app().test_client()\n"
+        f"status = client.get({path!r}).status_code\n"
+        "print(imported - start, time.perf_counter() - start, status)\n"
+    )
+    completed = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise SystemExit(completed.stderr)
+    imported, total, status = completed.stdout.strip().splitlines()[-1].split()
+    return float(imported), float(total), int(status)
+
+
+def gunicorn_first_request(path, timeout=60):
+    """Starts one cold gunicorn worker and times until it answers path."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "gunicorn", "--workers", "1", "--bind", f"127.0.0.1:{port}",
+                                "main:create_app()"], cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=1) as response:
+                    return time.perf_counter() - start, response.status
+            except OSError:
+                time.sleep(0.02)
+        raise SystemExit(f"No response from gunicorn within {timeout}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--first-request", action="store_true")
+    parser.add_argument("--gunicorn", action="store_true")
+    parser.add_argument("--path", default="/metrics")
+    args = parser.parse_args()
+
+    wall, packages = import_profile(args.module, args.top)
+    print(f"import {args.module}: {wall:.3f}s wall (including interpreter start)")
+    print(f"{'package':<40}{'cumulative ms':>15}")
+    for name, cumulative in packages:
+        print(f"{name:<40}{cumulative / 1000:>15.1f}")
+
+    if args.first_request:
+        imported, total, status = first_request(args.path)
+        print(f"\ntest client: imported in {imported:.3f}s, first {args.path} answered ({status}) after {total:.3f}s")
+    if args.gunicorn:
+        total, status = gunicorn_first_request(args.path)
+        print(f"gunicorn: first {args.path} answered ({status}) {total:.3f}s after launch")
+
+
+if __name__ == "__main__":
+    main()
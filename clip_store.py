@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import fcntl
+import uuid
+import hashlib
+import tempfile
+import threading
+import contextvars
+import concurrent.futures
+from contextlib import contextmanager, asynccontextmanager
+import limits
+import metrics
+import async_runtime
+from firebase import Firebase, DOWNLOAD_MAX_WORKERS, DOWNLOAD_RETRIES
+
+
+# Settings for the persistent local store of downloaded project media
+CLIP_STORE_DIR = os.getenv("CLIP_STORE_DIR", os.path.join(tempfile.gettempdir(), "craite_clips"))
+CLIP_STORE_MAX_BYTES = int(os.getenv("CLIP_STORE_MAX_BYTES", 20 * 1024 ** 3))
+# Clips are pinned until the request using them releases its lease; leases of workers that died
+# expire after this long, by default the longest a request and a render that outlives it can run
+CLIP_STORE_PIN_SECONDS = float(os.getenv("CLIP_STORE_PIN_SECONDS", limits.REQUEST_TIMEOUT + limits.RENDER_TIMEOUT))
+
+# Blobs served from the store and blobs that had to be downloaded
+clip_store_events = metrics.Counter(
+    "clip_store_lookups_total",
+    "Clip store lookups by result",
+    labelnames=("result",),
+)
+clip_store_bytes_saved = metrics.Counter(
+    "clip_store_bytes_saved_total",
+    "Bytes served from the clip store instead of being downloaded",
+)
+
+
+# Function to identify a version of a blob
+def blob_version_key(blob):
+    """A blob's name plus its generation, which changes whenever the object is overwritten.
+
+    The MD5 hash is used when the generation is not available.
+    """
+    version = getattr(blob, 'generation', None) or getattr(blob, 'md5_hash', None) or ""
+    return f"{blob.name}#{version}"
+
+
+# Function to name one request's pins on the clips it uses
+def _new_lease():
+    return f"{os.getpid()}-{uuid.uuid4().hex}"
+
+
+class ClipStore:
+    """Keeps downloaded project media on local disk across requests.
+
+    Each version of a blob is stored once at a stable path that ends with the
+    blob's basename, so clip names seen by Gemini stay the same across
+    re-prompts. An index file records sizes and last use for least recently
+    used eviction once the store exceeds its quota. A file lock serializes
+    index updates across workers; downloads happen outside the lock and are
+    moved into place atomically. Clips synced under a lease are never evicted
+    until the lease is released or pin_seconds pass.
+    """
+
+    def __init__(self, directory=CLIP_STORE_DIR, max_bytes=CLIP_STORE_MAX_BYTES, pin_seconds=CLIP_STORE_PIN_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.pin_seconds = pin_seconds
+        self.index_path = os.path.join(directory, "index.json")
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock, open(f"{self.index_path}.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save(self, entries):
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(temp_path, self.index_path)
+
+    def path_for(self, blob):
+        digest = hashlib.sha256(blob_version_key(blob).encode()).hexdigest()
+        return os.path.join(self.directory, "objects", digest[:2], digest, blob.name.split('/')[-1])
+
+    def _evict(self, entries, now):
+        total = sum(entry['bytes'] for entry in entries.values())
+        for key, entry in sorted(entries.items(), key=lambda item: item[1]['last_used']):
+            if total <= self.max_bytes:
+                break
+            entry['pins'] = {lease: until for lease, until in entry.get('pins', {}).items() if until > now}
+            if entry['pins']:
+                continue
+            try:
+                os.remove(entry['path'])
+                os.rmdir(os.path.dirname(entry['path']))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Could not remove {entry['path']} from the clip store: {e}")
+            total -= entry['bytes']
+            del entries[key]
+
+    # Function to pin the clips a request syncs until the request is done with them
+    @contextmanager
+    def leased(self):
+        """Yields a lease to pass to sync and releases its pins when the block ends."""
+        lease = _new_lease()
+        try:
+            yield lease
+        finally:
+            self.release(lease)
+
+    # Function to pin clips for a coroutine, releasing them on the asyncio I/O executor
+    @asynccontextmanager
+    async def leased_async(self):
+        lease = _new_lease()
+        try:
+            yield lease
+        finally:
+            await async_runtime.run_io(self.release, lease)
+
+    def release(self, lease):
+        """Unpins the clips synced under lease and evicts any that are over the quota."""
+        with self._locked():
+            entries = self._load()
+            for entry in entries.values():
+                entry.get('pins', {}).pop(lease, None)
+            self._evict(entries, time.time())
+            self._save(entries)
+
+    # Function to make the given blobs available locally, downloading only new or changed ones
+    def sync(self, blobs, storage_bucket, max_workers=DOWNLOAD_MAX_WORKERS, retries=DOWNLOAD_RETRIES, lease=None):
+        """Returns local paths for the given blobs, downloading only versions not in the store.
+
+        Args:
+            blobs: Blobs from bucket.list_blobs, which carry their generation and MD5 hash.
+            storage_bucket: The Firebase Storage bucket.
+            max_workers: Maximum number of concurrent downloads.
+            retries: Number of retries per blob before the whole sync fails.
+            lease: A lease from leased(), which keeps the clips from being evicted
+                until it is released. Without one, they are pinned for pin_seconds.
+
+        Returns:
+            A tuple containing:
+                - The local file paths, in the same order as blobs.
+                - A dictionary with 'hits', 'downloads', 'bytes' downloaded,
+                  'bytes_saved', the download 'seconds' and 'throughput' in
+                  bytes per second, and the per-file download stats under 'files'.
+        """
+        now = time.time()
+        lease = lease or _new_lease()
+        pinned_until = now + self.pin_seconds
+        paths = [self.path_for(blob) for blob in blobs]
+        with self._locked():
+            entries = self._load()
+            missing, bytes_saved = [], 0
+            for blob, path in zip(blobs, paths):
+                entry = entries.get(blob_version_key(blob))
+                if entry is not None and os.path.exists(path):
+                    entry['last_used'] = now
+                    entry.setdefault('pins', {})[lease] = pinned_until
+                    bytes_saved += entry['bytes']
+                else:
+                    missing.append((blob, path))
+            self._save(entries)
+
+        hits = len(blobs) - len(missing)
+        clip_store_events.inc(hits, result="hit")
+        clip_store_events.inc(len(missing), result="miss")
+        clip_store_bytes_saved.inc(bytes_saved)
+
+        file_stats, seconds = [], 0
+        if missing:
+            start = time.monotonic()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # Each download runs in a copy of the caller's context, so its log line carries the request id
+                futures = [executor.submit(contextvars.copy_context().run, self._download, blob, path, storage_bucket,
+                                           retries)
+                           for blob, path in missing]
+                file_stats = [future.result() for future in futures]
+            seconds = time.monotonic() - start
+
+            with self._locked():
+                entries = self._load()
+                for (blob, path), stat in zip(missing, file_stats):
+                    entries[blob_version_key(blob)] = {'path': path, 'bytes': stat['bytes'], 'last_used': now,
+                                                       'pins': {lease: pinned_until}}
+                self._evict(entries, time.time())
+                self._save(entries)
+
+        total_bytes = sum(stat['bytes'] for stat in file_stats)
+        stats = {
+            'files': file_stats,
+            'hits': hits,
+            'downloads': len(missing),
+            'bytes': total_bytes,
+            'bytes_saved': bytes_saved,
+            'seconds': seconds,
+            'throughput': total_bytes / seconds if seconds else 0,
+        }
+        metrics.log_event("clip_store_sync", cached=hits, downloaded=len(missing), bytes=total_bytes,
+                          bytes_saved=bytes_saved, seconds=round(seconds, 3),
+                          throughput_mbps=round(stats['throughput'] / 1e6, 2))
+        return paths, stats
+
+    def _download(self, blob, path, storage_bucket, retries):
+        # Downloads next to the final path and renames, so readers never see a partial file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial_path = f"{path}.{os.getpid()}.{threading.get_ident()}.partial"
+        stat = Firebase.download_media_with_retries(blob.name, partial_path, storage_bucket, retries)
+        os.replace(partial_path, path)
+        stat['path'] = path
+        metrics.log_event("clip_download", blob=blob.name, bytes=stat['bytes'], seconds=round(stat['seconds'], 3),
+                          throughput_mbps=round(stat['throughput'] / 1e6, 2), attempts=stat['attempts'])
+        return stat
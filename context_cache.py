@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import metrics
+import prompts
+
+
+# Lifetime of a project's cached instructions and media; every hit extends it again
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", 3600))
+# Cached content this close to expiry is recreated rather than reused
+CONTEXT_CACHE_EXPIRY_MARGIN = timedelta(seconds=60)
+# After a model fails to create or find cached content (e.g. it does not support caching),
+# requests skip the cache for that model this long instead of failing again
+CONTEXT_CACHE_RETRY_SECONDS = float(os.getenv("CONTEXT_CACHE_RETRY_SECONDS", 600))
+# Projects whose cached content is remembered in each process; the least recently used are dropped first
+CONTEXT_CACHE_MAX_PROJECTS = int(os.getenv("CONTEXT_CACHE_MAX_PROJECTS", 1024))
+# A list of all cached content answers lookups of other projects this long, so projects
+# with no cached content (e.g. after a restart) do not each list the whole account again
+CONTEXT_CACHE_LIST_SECONDS = float(os.getenv("CONTEXT_CACHE_LIST_SECONDS", 60))
+DISPLAY_NAME_PREFIX = "craite"
+
+# Hits, misses and invalidations of the Gemini context cache
+context_cache_events = metrics.Counter(
+    "gemini_context_cache_total",
+    "Lookups of project context caches by result",
+    labelnames=("result",),
+)
+
+
+# Function to name a user's project in display names without the ids running into each other
+def project_key(user_id, project_id):
+    # Project ids are only unique per user
+    return hashlib.sha256(f"{user_id}/{project_id}".encode()).hexdigest()[:16]
+
+
+# Function to identify the cached content of a project's current media
+def context_fingerprint(model_name, media_parts, video_durations):
+    """Hashes everything stored in a project's cached content.
+
+    Uploaded files are deduplicated by content hash, so the file names change
+    exactly when the clips or the audio change.
+    """
+    content = {
+        'model': model_name,
+        'media': [part.name for part in media_parts],
+        'video_durations': video_durations,
+        'instructions': hashlib.sha256(prompts.EDIT_INSTRUCTIONS.encode()).hexdigest(),
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class ContextCache:
+    """Keeps the edit instructions and a project's media in a Gemini context cache.
+
+    There is at most one cached content object per project. Its display name
+    carries a key of the user and project id and a fingerprint of its content,
+    so every worker can find it with a list call and a change of clips
+    invalidates it. Objects found in this process are remembered to skip the
+    list call, for at most max_projects projects, and so are models the cache
+    failed for, for retry_seconds. One list call answers lookups of every
+    project for list_seconds, so a project missing from it is created without
+    listing again.
+    """
+
+    def __init__(self, genai, generation_config=None, ttl=CONTEXT_CACHE_TTL, retry_seconds=CONTEXT_CACHE_RETRY_SECONDS,
+                 max_projects=CONTEXT_CACHE_MAX_PROJECTS, list_seconds=CONTEXT_CACHE_LIST_SECONDS):
+        self.genai = genai
+        self.generation_config = generation_config
+        self.ttl = timedelta(seconds=ttl)
+        self.retry_seconds = retry_seconds
+        self.max_projects = max_projects
+        self.list_seconds = list_seconds
+        # Project keys mapped to their cached content, least recently used first
+        self._entries = OrderedDict()
+        # Project keys mapped to their lock and the number of requests holding or waiting for it
+        self._locks = {}
+        # Model names mapped to the time until which the cache is not tried for them
+        self._failed_until = {}
+        # Project keys mapped to the cached content of the last list call not yet used by a lookup
+        self._listing = None
+        self._listed_at = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _project_lock(self, key):
+        # Locks are dropped once no request uses them, so they only exist for projects being looked up
+        with self._lock:
+            lock, users = self._locks.get(key, (None, 0))
+            self._locks[key] = (lock or threading.Lock(), users + 1)
+            lock = self._locks[key][0]
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                users = self._locks[key][1] - 1
+                if users:
+                    self._locks[key] = (lock, users)
+                else:
+                    del self._locks[key]
+
+    def _entry(self, key):
+        with self._lock:
+            cached_content = self._entries.get(key)
+            if cached_content is not None:
+                self._entries.move_to_end(key)
+            return cached_content
+
+    def _remember(self, key, cached_content):
+        with self._lock:
+            self._entries[key] = cached_content
+            self._entries.move_to_end(key)
+            # Entries expire in the order they were last used, so expired ones are at the front
+            while self._entries and (len(self._entries) > self.max_projects
+                                     or not self._fresh(next(iter(self._entries.values())))):
+                self._entries.popitem(last=False)
+
+    def _forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _fresh(self, cached_content):
+        expire_time = cached_content.expire_time
+        if expire_time.tzinfo is None:
+            expire_time = expire_time.replace(tzinfo=timezone.utc)
+        return expire_time - CONTEXT_CACHE_EXPIRY_MARGIN > datetime.now(timezone.utc)
+
+    def _listed(self, key):
+        # Takes the project's cached content out of a recent list call, or lists the account again
+        with self._lock:
+            if self._listing is not None and time.monotonic() - self._listed_at < self.list_seconds:
+                return self._listing.pop(key, [])
+        listing = {}
+        prefix = f"{DISPLAY_NAME_PREFIX}-"
+        for cached_content in self.genai.caching.CachedContent.list():
+            if cached_content.display_name.startswith(prefix):
+                listed_key = cached_content.display_name[len(prefix):].split("-")[0]
+                listing.setdefault(listed_key, []).append(cached_content)
+        with self._lock:
+            self._listing, self._listed_at = listing, time.monotonic()
+            return self._listing.pop(key, [])
+
+    def _find(self, key, display_name):
+        # Looks for content created by any worker and deletes stale versions of the project's cache
+        found = None
+        for cached_content in self._listed(key):
+            if cached_content.display_name == display_name and found is None and self._fresh(cached_content):
+                found = cached_content
+            else:
+                self._delete(cached_content)
+        return found
+
+    def _delete(self, cached_content):
+        try:
+            cached_content.delete()
+            context_cache_events.inc(result="invalidated")
+            print(f"Deleted context cache {cached_content.display_name}")
+        except Exception as e:
+            print(f"Could not delete context cache {cached_content.name}: {e}")
+
+    def _failed_recently(self, name):
+        with self._lock:
+            return self._failed_until.get(name, 0) > time.monotonic()
+
+    def _remember_failure(self, name):
+        with self._lock:
+            now = time.monotonic()
+            self._failed_until = {failed: until for failed, until in self._failed_until.items() if until > now}
+            self._failed_until[name] = now + self.retry_seconds
+
+    # Function to get a model whose context already holds the instructions and media
+    def model_for(self, user_id, project_id, model, media_parts, video_durations):
+        """Returns a model backed by the project's cached content, creating it on a miss.
+
+        Args:
+            user_id: The user the project belongs to.
+            project_id: The project the media belongs to.
+            model: The genai.GenerativeModel the request would otherwise go to.
+            media_parts: The uploaded, ACTIVE video and audio files.
+            video_durations: The clip timestamp map.
+
+        Returns:
+            A tuple of the cached model and the number of cached input tokens, or
+            (None, 0) when the content cannot be cached (for example because it is
+            below the model's minimum cache size), in which case the caller should
+            send the full request. After a failure, the model (or, for content
+            that is too small, just this content) is not tried again for
+            retry_seconds.
+        """
+        key = project_key(user_id, project_id)
+        fingerprint = context_fingerprint(model.model_name, media_parts, video_durations)
+        display_name = f"{DISPLAY_NAME_PREFIX}-{key}-{fingerprint}"
+        if self._failed_recently(model.model_name) or self._failed_recently(display_name):
+            context_cache_events.inc(result="skipped")
+            return None, 0
+
+        with self._project_lock(key):
+            try:
+                cached_content = self._entry(key)
+                if cached_content is not None and (cached_content.display_name != display_name
+                                                   or not self._fresh(cached_content)):
+                    # Clips changed since the cache was created
+                    self._delete(cached_content)
+                    cached_content = None
+                if cached_content is None:
+                    cached_content = self._find(key, display_name)
+
+                if cached_content is not None:
+                    context_cache_events.inc(result="hit")
+                    cached_content.update(ttl=self.ttl)
+                else:
+                    context_cache_events.inc(result="miss")
+                    cached_content = self.genai.caching.CachedContent.create(
+                        model=model.model_name,
+                        display_name=display_name,
+                        system_instruction=prompts.EDIT_INSTRUCTIONS,
+                        contents=[{"role": "user", "parts": list(media_parts)}],
+                        ttl=self.ttl,
+                    )
+                    print(f"Created context cache {display_name}")
+                self._remember(key, cached_content)
+            except Exception as e:
+                context_cache_events.inc(result="error")
+                self._forget(key)
+                # Content below the model's minimum cache size says nothing about other projects
+                self._remember_failure(display_name if "too small" in str(e).lower() else model.model_name)
+                print(f"Context cache unavailable for project {project_id}: {e}")
+                return None, 0
+
+        cached_model = self.genai.GenerativeModel.from_cached_content(
+            cached_content, generation_config=self.generation_config)
+        return cached_model, cached_content.usage_metadata.total_token_count
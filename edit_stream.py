@@ -0,0 +1,86 @@
+import response_decoder
+
+
+class IncrementalEditParser:
+    """Extracts elements of the "video_edits" array from a JSON response as it streams in.
+
+    Chunks of model output are passed to feed(), which returns every edit whose
+    closing brace has arrived since the previous call. Only the scanner state is
+    kept between calls, so each character is looked at once. Text around the
+    JSON object (such as Markdown code fences) is ignored.
+    """
+
+    def __init__(self, key="video_edits", video_names=None):
+        self.key = key
+        self.video_names = video_names
+        self._buffer = ""
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escaped = False
+        self._string_start = None
+        self._last_key = None
+        self._array_depth = None
+        self._element_start = None
+
+    def feed(self, chunk):
+        """Consumes a chunk of text and returns the edits completed by it."""
+        self._buffer += chunk
+        completed = []
+
+        while self._pos < len(self._buffer):
+            char = self._buffer[self._pos]
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    # Remember keys of the top-level object so we know when the edits array starts
+                    if len(self._stack) == 1:
+                        self._last_key = self._buffer[self._string_start:self._pos]
+            elif char == '"':
+                self._in_string = True
+                self._string_start = self._pos + 1
+            elif char in '{[':
+                if char == '[' and len(self._stack) == 1 and self._last_key == self.key:
+                    self._array_depth = len(self._stack) + 1
+                if char == '{' and self._array_depth is not None and len(self._stack) == self._array_depth:
+                    self._element_start = self._pos
+                self._stack.append(char)
+            elif char in '}]':
+                if self._stack:
+                    self._stack.pop()
+                if char == '}' and self._element_start is not None and len(self._stack) == self._array_depth:
+                    completed.append(self._buffer[self._element_start:self._pos + 1])
+                    self._element_start = None
+                elif char == ']' and self._array_depth is not None and len(self._stack) < self._array_depth:
+                    self._array_depth = None
+            elif char == ',' and len(self._stack) == 1:
+                self._last_key = None
+
+            self._pos += 1
+
+        self._discard_consumed()
+        return [edit for edit in (self._decode(fragment) for fragment in completed) if edit is not None]
+
+    def _discard_consumed(self):
+        # Drop text that no pending edit or string can refer to any more
+        keep_from = self._pos if self._element_start is None else self._element_start
+        if self._in_string:
+            keep_from = min(keep_from, self._string_start)
+        self._buffer = self._buffer[keep_from:]
+        self._pos -= keep_from
+        if self._element_start is not None:
+            self._element_start -= keep_from
+        if self._string_start is not None:
+            self._string_start -= keep_from
+
+    def _decode(self, fragment):
+        try:
+            return response_decoder.decode_video_edit(fragment, self.video_names)
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Skipping malformed streamed video edit: {e}")
+            return None
@@ -0,0 +1,511 @@
+"""Local stand-ins for the external services the backend talks to.
+
+They implement just enough of each client's surface to run the pipeline
+offline, e.g. `Gemini.wait_for_files_active(files, FakeGenai())`.
+"""
+import os
+import re
+import ast
+import json
+import time
+import uuid
+import shutil
+import asyncio
+import threading
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+
+class FakeState:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeFile:
+    def __init__(self, name, display_name, mime_type, state="PROCESSING"):
+        self.name = name
+        self.display_name = display_name
+        self.mime_type = mime_type
+        self.uri = f"https://generativelanguage.googleapis.com/v1beta/{name}"
+        self.state = FakeState(state)
+        self.expiration_time = datetime.now(timezone.utc) + timedelta(hours=48)
+
+
+class FakeGenai:
+    """Stands in for the google.generativeai module's Files API.
+
+    Uploaded files stay PROCESSING for `processing_seconds` and then become
+    ACTIVE, or FAILED when their display name is listed in `failing_files`.
+    """
+
+    def __init__(self, processing_seconds=1.0, failing_files=()):
+        self.processing_seconds = processing_seconds
+        self.failing_files = set(failing_files)
+        self.get_file_calls = 0
+        self._files = {}
+        self._ready_at = {}
+        self._lock = threading.Lock()
+
+    def upload_file(self, path, mime_type=None, display_name=None):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        name = f"files/{uuid.uuid4().hex[:12]}"
+        file = FakeFile(name, display_name or os.path.basename(path), mime_type)
+        with self._lock:
+            self._files[name] = file
+            self._ready_at[name] = time.monotonic() + self.processing_seconds
+        return file
+
+    def get_file(self, name):
+        with self._lock:
+            self.get_file_calls += 1
+            if name not in self._files:
+                raise KeyError(f"File not found: {name}")
+            file = self._files[name]
+            if file.state.name == "PROCESSING" and time.monotonic() >= self._ready_at[name]:
+                file.state = FakeState("FAILED" if file.display_name in self.failing_files else "ACTIVE")
+            return file
+
+    def delete_file(self, name):
+        with self._lock:
+            self._files.pop(name, None)
+            self._ready_at.pop(name, None)
+
+
+class FakeBlob:
+    """A Firebase Storage blob backed by a file under FakeBucket.root."""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.root, self.name)
+
+    @property
+    def generation(self):
+        # Changes whenever the file is rewritten, like a real object generation
+        return str(os.stat(self.path).st_mtime_ns)
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def download_to_filename(self, file_path):
+        time.sleep(self.bucket.latency)
+        shutil.copyfile(self.path, file_path)
+
+    def upload_from_filename(self, file_path, content_type=None):
+        time.sleep(self.bucket.latency)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(file_path, self.path)
+        if self.bucket.on_finalize is not None:
+            self.bucket.on_finalize(storage_finalize_event(self.name, self.bucket.name, self.generation,
+                                                           content_type, self.size))
+
+
+# Function to build the payload of a Cloud Storage object finalize event
+def storage_finalize_event(name, bucket="craiteapp.appspot.com", generation=None, content_type=None, size=0):
+    """The object resource a storage trigger delivers, wrapped in a CloudEvent like Eventarc sends it.
+
+    POST it to /events/storage_finalize to drive upload-time preparation locally.
+    """
+    return {
+        'specversion': '1.0',
+        'type': 'google.cloud.storage.object.v1.finalized',
+        'source': f"//storage.googleapis.com/projects/_/buckets/{bucket}",
+        'subject': f"objects/{name}",
+        'id': uuid.uuid4().hex,
+        'data': {
+            'bucket': bucket,
+            'name': name,
+            'generation': str(generation or time.time_ns()),
+            'contentType': content_type or "video/mp4",
+            'size': str(size),
+        },
+    }
+
+
+class FakeBucket:
+    """Serves a local directory as a Storage bucket; object names are paths below root.
+
+    on_finalize, when given, is called with a storage_finalize_event after
+    every upload, like a storage trigger.
+    """
+
+    def __init__(self, root, latency=0.0, name="craiteapp.appspot.com", on_finalize=None):
+        self.root = root
+        self.latency = latency
+        self.name = name
+        self.on_finalize = on_finalize
+
+    def blob(self, name, chunk_size=None):
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix=""):
+        directory = os.path.join(self.root, prefix)
+        if not os.path.isdir(directory):
+            return []
+        names = []
+        for dir_path, _, file_names in os.walk(directory):
+            names += [os.path.relpath(os.path.join(dir_path, name), self.root) for name in file_names]
+        return [FakeBlob(self, name) for name in sorted(names)]
+
+
+class FakeStorage:
+    """Stands in for firebase_admin.storage."""
+
+    def __init__(self, root, latency=0.0, on_finalize=None):
+        self._bucket = FakeBucket(root, latency, on_finalize=on_finalize)
+
+    def bucket(self, name=None):
+        return self._bucket
+
+
+class FakeSnapshot:
+    def __init__(self, data):
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocument:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+
+    def collection(self, name):
+        return FakeCollection(self._client, f"{self.path}/{name}")
+
+    def get(self):
+        with self._client.lock:
+            return FakeSnapshot(self._client.documents.get(self.path))
+
+    def set(self, data, merge=False):
+        with self._client.lock:
+            current = self._client.documents.get(self.path, {}) if merge else {}
+            self._client.documents[self.path] = {**current, **data}
+
+    def update(self, data):
+        # Unlike Firestore, updating a missing document creates it, so prompts need not be seeded
+        self.set(data, merge=True)
+
+    def delete(self):
+        with self._client.lock:
+            self._client.documents.pop(self.path, None)
+
+
+class FakeCollection:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+
+    def document(self, document_id=None):
+        return FakeDocument(self._client, f"{self.path}/{document_id or uuid.uuid4().hex}")
+
+
+class FakeFirestoreClient:
+    """An in-memory Firestore client keyed by document path."""
+
+    def __init__(self):
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+
+class FakeFirestore:
+    """Stands in for firebase_admin.firestore."""
+
+    def __init__(self):
+        self._client = FakeFirestoreClient()
+
+    def client(self):
+        return self._client
+
+
+class FakeAsyncDocument:
+    def __init__(self, document):
+        self._document = document
+
+    def collection(self, name):
+        return FakeAsyncCollection(self._document.collection(name))
+
+    async def get(self):
+        return self._document.get()
+
+    async def set(self, data, merge=False):
+        self._document.set(data, merge=merge)
+
+    async def update(self, data):
+        self._document.update(data)
+
+
+class FakeAsyncCollection:
+    def __init__(self, collection):
+        self._collection = collection
+
+    def document(self, document_id=None):
+        return FakeAsyncDocument(self._collection.document(document_id))
+
+
+class FakeAsyncFirestoreClient:
+    def __init__(self, client):
+        self._client = client
+
+    def collection(self, name):
+        return FakeAsyncCollection(self._client.collection(name))
+
+
+class FakeFirestoreAsync:
+    """Stands in for firebase_admin.firestore_async, sharing the documents of a FakeFirestore."""
+
+    def __init__(self, firestore):
+        self._client = FakeAsyncFirestoreClient(firestore.client())
+
+    def client(self):
+        return self._client
+
+
+class FakeAuth:
+    """Stands in for firebase_admin.auth; every user id is valid unless listed in unknown_users."""
+
+    class UserNotFoundError(Exception):
+        pass
+
+    def __init__(self, unknown_users=()):
+        self.unknown_users = set(unknown_users)
+
+    def get_user(self, user_id):
+        if user_id in self.unknown_users:
+            raise FakeAuth.UserNotFoundError(f"No user record found for the provided user ID: {user_id}")
+        return {'uid': user_id}
+
+
+class FakeTokenCount:
+    def __init__(self, total_tokens):
+        self.total_tokens = total_tokens
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeRateLimitError(Exception):
+    """Shaped like google.api_core.exceptions.ResourceExhausted, Gemini's 429."""
+    code = 429
+
+
+class FakeQuota:
+    """A requests-per-minute quota enforced like Gemini's, over a sliding `window` seconds."""
+
+    def __init__(self, rpm, window=60.0):
+        self.rpm = rpm
+        self.window = window
+        self.rejected = 0
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def check(self):
+        if not self.rpm:
+            return
+        now = time.monotonic()
+        with self._lock:
+            while self._calls and now - self._calls[0] >= self.window:
+                self._calls.popleft()
+            if len(self._calls) >= self.rpm:
+                self.rejected += 1
+                retry_in = self.window - (now - self._calls[0])
+                raise FakeRateLimitError(f"429 Resource has been exhausted (e.g. check quota). "
+                                         f"Please retry in {retry_in:.3f}s.")
+            self._calls.append(now)
+
+
+class FakeChatSession:
+    def __init__(self, model, history=None):
+        self.model = model
+        self.parts = [part for turn in history or [] for part in turn['parts']]
+
+    def send_message(self, content, stream=False):
+        return self.model.generate_content(self.parts + [content], stream=stream)
+
+    async def send_message_async(self, content, stream=False):
+        return await self.model.generate_content_async(self.parts + [content], stream=stream)
+
+
+class FakeGenerativeModel:
+    """Stands in for genai.GenerativeModel.
+
+    Responses take `latency` seconds, plus `video_latency` seconds per second
+    of footage in the prompt's clip timestamp map when a video is attached, and
+    contain one edit per clip named in that map, so they pass response
+    validation. Map prompts (see map_reduce) get candidate moments instead.
+    Generation calls beyond a FakeQuota are rejected with FakeRateLimitError.
+    """
+
+    def __init__(self, model_name="models/fake-gemini", generation_config=None, latency=0.5, chunks=4,
+                 video_latency=0.0, quota=None):
+        self.model_name = model_name
+        self.generation_config = generation_config
+        self.latency = latency
+        self.chunks = chunks
+        self.video_latency = video_latency
+        self.quota = quota or FakeQuota(0)
+
+    def count_tokens(self, contents):
+        texts = contents if isinstance(contents, list) else [contents]
+        # Files are counted like Gemini's ~300 tokens per second of video, assuming short clips,
+        # and inline images at Gemini's flat 258 tokens each
+        return FakeTokenCount(sum(len(part) // 4 if isinstance(part, str) else 258 if isinstance(part, dict) else 3000
+                                  for part in texts))
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
+
+    def _respond(self, contents):
+        contents = [contents] if isinstance(contents, str) else contents
+        prompt = " ".join(p for p in contents if isinstance(p, str))
+        video_durations = self.video_durations(prompt)
+        latency = self.latency
+        if any(isinstance(part, FakeFile) for part in contents) and video_durations:
+            latency += self.video_latency * max(end for _, end in video_durations.values())
+        return json.dumps(self.response_for(prompt)), latency
+
+    def generate_content(self, contents, stream=False, generation_config=None):
+        self.quota.check()
+        text, latency = self._respond(contents)
+        if not stream:
+            time.sleep(latency)
+            return FakeResponse(text)
+        return self._stream(text, latency)
+
+    async def generate_content_async(self, contents, stream=False, generation_config=None):
+        self.quota.check()
+        text, latency = self._respond(contents)
+        if not stream:
+            await asyncio.sleep(latency)
+            return FakeResponse(text)
+        return self._stream_async(text, latency)
+
+    def _stream(self, text, latency):
+        size = -(-len(text) // self.chunks)
+        for start in range(0, len(text), size):
+            time.sleep(latency / self.chunks)
+            yield FakeResponse(text[start:start + size])
+
+    async def _stream_async(self, text, latency):
+        size = -(-len(text) // self.chunks)
+        for start in range(0, len(text), size):
+            await asyncio.sleep(latency / self.chunks)
+            yield FakeResponse(text[start:start + size])
+
+    @staticmethod
+    def video_durations(prompt):
+        match = re.search(r'"(\{.*?\})"', prompt, re.DOTALL)
+        return ast.literal_eval(match.group(1)) if match else {}
+
+    def response_for(self, prompt):
+        video_durations = self.video_durations(prompt)
+        if '"candidate_moments"' in prompt:
+            moments = []
+            for i, (video_name, (start, end)) in enumerate(video_durations.items()):
+                length = end - start
+                moments.append({'video_name': video_name, 'start_time': round(length * 0.2, 2),
+                                'end_time': round(min(length * 0.2 + 8, length), 2),
+                                'score': round(1 - (i % 5) / 10, 2), 'description': f"Highlight of clip {i + 1}"})
+            return {'candidate_moments': moments}
+        video_edits = []
+        for i, (video_name, (start, end)) in enumerate(video_durations.items()):
+            length = end - start
+            video_edits.append({
+                'id': i + 1,
+                'video_name': video_name,
+                'start_time': round(length * 0.1, 2),
+                'end_time': round(length * 0.9, 2),
+                'effects': [{'name': 'brightness', 'adjustment': 0.1}],
+                'text': [],
+                'transition': 'fade',
+            })
+        return {'video_edits': video_edits, 'audio_edits': {'start_time': 0, 'end_time': 30}}
+
+
+class FakeUsageMetadata:
+    def __init__(self, total_token_count):
+        self.total_token_count = total_token_count
+
+
+class FakeCachedContent:
+    def __init__(self, caching, model, display_name, ttl):
+        self.caching = caching
+        self.name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+        self.model = model
+        self.display_name = display_name
+        self.expire_time = datetime.now(timezone.utc) + ttl
+        self.usage_metadata = FakeUsageMetadata(40000)
+
+    def update(self, ttl):
+        self.expire_time = datetime.now(timezone.utc) + ttl
+
+    def delete(self):
+        with self.caching._lock:
+            self.caching._contents.remove(self)
+
+
+class FakeCaching:
+    """Stands in for google.generativeai.caching, shared by every worker using it.
+
+    `list_calls` and `create_calls` count the calls made to the account.
+    """
+
+    def __init__(self):
+        self.CachedContent = self
+        self.list_calls = 0
+        self.create_calls = 0
+        self._contents = []
+        self._lock = threading.Lock()
+
+    def create(self, model, display_name, system_instruction=None, contents=None, ttl=None):
+        cached_content = FakeCachedContent(self, model, display_name, ttl)
+        with self._lock:
+            self.create_calls += 1
+            self._contents.append(cached_content)
+        return cached_content
+
+    def list(self):
+        with self._lock:
+            self.list_calls += 1
+            return iter(list(self._contents))
+
+
+class FakeModelInfo:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeGenaiModule(FakeGenai):
+    """FakeGenai plus the parts of the module used to build and list models.
+
+    Every model it builds shares one generation quota of `generate_rpm` (0 for none).
+    """
+
+    def __init__(self, processing_seconds=1.0, failing_files=(), latency=0.5, video_latency=0.0, generate_rpm=0,
+                 quota_window=60.0):
+        super().__init__(processing_seconds, failing_files)
+        self.latency = latency
+        self.video_latency = video_latency
+        self.quota = FakeQuota(generate_rpm, quota_window)
+
+    def configure(self, api_key=None):
+        pass
+
+    def GenerativeModel(self, model_name="models/fake-gemini", generation_config=None):
+        return FakeGenerativeModel(model_name, generation_config, latency=self.latency,
+                                   video_latency=self.video_latency, quota=self.quota)
+
+    def list_models(self, page_size=None):
+        return iter([FakeModelInfo("models/fake-gemini")])
@@ -1,55 +1,213 @@
-import firebase_admin
-from firebase_admin import credentials, storage, auth, firestore
-from google.cloud import aiplatform
 import os
-import tempfile
-import requests  
-import google.generativeai as genai
-from google.generativeai.protos import HarmCategory, SafetySetting
-import concurrent.futures
-from time import sleep
-from dotenv import load_dotenv
-from moviepy.editor import VideoFileClip, concatenate_videoclips
-import uuid
-import textwrap
 import json
-import ffmpeg
-import traceback
+from time import sleep
+import random
+import time
+from datetime import datetime, timezone
+import async_runtime
+
+
+# Settings for concurrent downloads from Firebase Storage
+DOWNLOAD_MAX_WORKERS = int(os.getenv("DOWNLOAD_MAX_WORKERS", 8))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", 3))
+DOWNLOAD_BACKOFF_SECONDS = float(os.getenv("DOWNLOAD_BACKOFF_SECONDS", 0.5))
+# Chunked downloads use ranged requests; the chunk size must be a multiple of 256 KB
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
 
 
 class Firebase:
         
-    # Function to get all files in a Firebase cloud storage dir
+    # Function to get all blobs in a Firebase cloud storage dir, with their generation and hash
     @staticmethod
-    def get_all_file_paths(directory, storage_bucket):
-        bucket = storage_bucket
-        blobs = bucket.list_blobs(prefix=directory)
-        print(blobs)
-        return [blob.name for blob in blobs if not blob.name.endswith('/')]
+    def get_all_blobs(directory, storage_bucket):
+        return [blob for blob in storage_bucket.list_blobs(prefix=directory) if not blob.name.endswith('/')]
+
+    @staticmethod
+    async def get_all_blobs_async(directory, storage_bucket):
+        """get_all_blobs on the asyncio I/O executor; the Storage client has no asyncio API."""
+        return await async_runtime.run_io(Firebase.get_all_blobs, directory, storage_bucket)
     
-    # Function to download a video from Firebase Storage
+    # Function to download a blob with retries and exponential backoff
+    @staticmethod
+    def download_media_with_retries(media_path, file_path, storage_bucket, retries=DOWNLOAD_RETRIES,
+                                    backoff=DOWNLOAD_BACKOFF_SECONDS):
+        """Downloads a blob straight to file_path using chunked ranged requests.
+
+        Returns:
+            A dictionary with the local path, bytes written, seconds taken,
+            throughput in bytes per second and the number of attempts.
+        """
+        for attempt in range(retries + 1):
+            start = time.monotonic()
+            try:
+                blob = storage_bucket.blob(media_path, chunk_size=DOWNLOAD_CHUNK_SIZE)
+                blob.download_to_filename(file_path)
+                break
+            except Exception as e:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+                if attempt == retries:
+                    raise
+                delay = backoff * (2 ** attempt) + random.uniform(0, backoff)
+                print(f"Download of {media_path} failed ({e}), retrying in {delay:.1f}s")
+                sleep(delay)
+
+        seconds = time.monotonic() - start
+        size = os.path.getsize(file_path)
+        return {
+            'path': file_path,
+            'bytes': size,
+            'seconds': seconds,
+            'throughput': size / seconds if seconds else 0,
+            'attempts': attempt + 1,
+        }
+
+    # Function to get the Firestore document of a project
+    @staticmethod
+    def project_document(user_id, project_id, firestore_client):
+        return firestore_client.collection("users").document(user_id) \
+            .collection("projects").document(str(project_id))
+
+    # Function to get the Firestore document of a prompt
+    @staticmethod
+    def prompt_document(user_id, project_id, prompt_id, firestore_client):
+        # Assuming your Firestore structure is like: users/{userId}/projects/{projectId}/prompts/{promptId}
+        return Firebase.project_document(user_id, project_id, firestore_client) \
+            .collection("prompts").document(prompt_id)
+
+    # Function to record the media prepared for a project at upload time
     @staticmethod
-    def download_media(video_path, file_path, storage_bucket):
-        bucket = storage_bucket
-        blob = bucket.blob(video_path)
-        blob.download_to_filename(file_path)
-     
+    def store_prepared_media(user_id, project_id, record, firestore_client):
+        doc_ref = Firebase.project_document(user_id, project_id, firestore_client)
+        doc_ref.set({"preparedMedia": record}, merge=True)
+        print(f"Prepared media stored for project ID: {project_id}")
+
+    # Function to read the media prepared for a project, if any
+    @staticmethod
+    def get_prepared_media(user_id, project_id, firestore_client):
+        try:
+            snapshot = Firebase.project_document(user_id, project_id, firestore_client).get()
+            return (snapshot.to_dict() or {}).get("preparedMedia") if snapshot.exists else None
+        except Exception as e:
+            print(f"Error reading prepared media: {e}")
+            return None
+
+    @staticmethod
+    async def get_prepared_media_async(user_id, project_id, async_firestore_client):
+        try:
+            snapshot = await Firebase.project_document(user_id, project_id, async_firestore_client).get()
+            return (snapshot.to_dict() or {}).get("preparedMedia") if snapshot.exists else None
+        except Exception as e:
+            print(f"Error reading prepared media: {e}")
+            return None
+
+    # Function to upload a local file to Firebase Storage
+    @staticmethod
+    def upload_media(file_path, media_path, storage_bucket, content_type="video/mp4"):
+        blob = storage_bucket.blob(media_path, chunk_size=DOWNLOAD_CHUNK_SIZE)
+        blob.upload_from_filename(file_path, content_type=content_type)
+        print(f"Uploaded {file_path} to: {media_path}")
+        return media_path
+
+    @staticmethod
+    async def upload_media_async(file_path, media_path, storage_bucket, content_type="video/mp4"):
+        return await async_runtime.run_io(Firebase.upload_media, file_path, media_path, storage_bucket, content_type)
+
      # Function to store gemini response to firestore   
     @staticmethod
     def store_gemini_response(user_id, project_id, prompt_id, gemini_response, firestore_client):
         """Stores the Gemini response in Firestore."""
         try:
-            # Get firestore client
-            db = firestore_client
-
-            # Assuming your Firestore structure is like: users/{userId}/projects/{projectId}/prompts/{promptId}
-            doc_ref = db.collection("users").document(user_id) \
-                .collection("projects").document(str(project_id)) \
-                .collection("prompts").document(prompt_id)
-
+            doc_ref = Firebase.prompt_document(user_id, project_id, prompt_id, firestore_client)
             doc_ref.update({"geminiResponse": gemini_response})
             print(f"Gemini response stored for prompt ID: {prompt_id}")
         except Exception as e:
             print(f"Error storing Gemini response: {e}")
-        
-    
\ No newline at end of file
+
+    # Function to store the video edits received so far while a response is streaming
+    @staticmethod
+    def store_partial_video_edits(user_id, project_id, prompt_id, video_edits, firestore_client):
+        """Stores the partial list of video edits in Firestore."""
+        try:
+            doc_ref = Firebase.prompt_document(user_id, project_id, prompt_id, firestore_client)
+            doc_ref.update({"partialVideoEdits": video_edits})
+            print(f"{len(video_edits)} partial video edits stored for prompt ID: {prompt_id}")
+        except Exception as e:
+            print(f"Error storing partial video edits: {e}")
+
+    # Function to store the storage path of a server-side render
+    @staticmethod
+    def store_rendered_video(user_id, project_id, prompt_id, rendered_video_path, firestore_client):
+        """Stores the path of the rendered video in Firestore."""
+        try:
+            doc_ref = Firebase.prompt_document(user_id, project_id, prompt_id, firestore_client)
+            doc_ref.update({"renderedVideo": rendered_video_path})
+            print(f"Rendered video stored for prompt ID: {prompt_id}")
+        except Exception as e:
+            print(f"Error storing rendered video: {e}")
+
+    # Function to store the status of a background job on its prompt document
+    @staticmethod
+    def store_job_status(user_id, project_id, prompt_id, job, firestore_client):
+        """Stores the id, status and error of a processing job in Firestore."""
+        try:
+            doc_ref = Firebase.prompt_document(user_id, project_id, prompt_id, firestore_client)
+            doc_ref.update({
+                "jobId": job['job_id'],
+                "jobStatus": job['status'],
+                "jobError": job['error'],
+            })
+            print(f"Job {job['job_id']} status '{job['status']}' stored for prompt ID: {prompt_id}")
+        except Exception as e:
+            print(f"Error storing job status: {e}")
+
+    # Function to get the Firestore document of a background job
+    @staticmethod
+    def job_document(job_id, firestore_client):
+        return firestore_client.collection("jobs").document(job_id)
+
+    # Function to store a background job where every worker can read it
+    @staticmethod
+    def store_job(job, firestore_client, ttl):
+        """Stores a job record in jobs/{job_id}, so any worker can answer polls for it.
+
+        The result is kept as JSON text because Firestore cannot hold nested
+        arrays. expireAt is ttl seconds after the job finished and can drive a
+        Firestore TTL policy; get_job ignores records past it either way.
+        """
+        try:
+            record = {key: job[key] for key in ('job_id', 'status', 'metadata', 'created_at', 'started_at',
+                                                'finished_at', 'error')}
+            record['result'] = json.dumps(job['result']) if job['result'] is not None else None
+            record['expireAt'] = datetime.fromtimestamp((job['finished_at'] or job['created_at']) + ttl, timezone.utc)
+            Firebase.job_document(job['job_id'], firestore_client).set(record)
+        except Exception as e:
+            print(f"Error storing job {job['job_id']}: {e}")
+
+    # Function to read a background job stored by store_job
+    @staticmethod
+    def get_job(job_id, firestore_client):
+        snapshot = Firebase.job_document(job_id, firestore_client).get()
+        if not snapshot.exists:
+            return None
+        job = snapshot.to_dict()
+        if job['expireAt'] <= datetime.now(timezone.utc):
+            return None
+        job['result'] = json.loads(job['result']) if job.get('result') is not None else None
+        return job
+
+    # Function to update a prompt document through the asyncio Firestore client
+    @staticmethod
+    async def update_prompt_async(user_id, project_id, prompt_id, fields, async_firestore_client):
+        """Applies fields to the prompt document with firestore_async, logging instead of raising.
+
+        The asyncio counterpart of the store_* methods above; the document path
+        is built the same way, since the async client has the same collection
+        and document chain.
+        """
+        try:
+            doc_ref = Firebase.prompt_document(user_id, project_id, prompt_id, async_firestore_client)
+            await doc_ref.update(fields)
+            print(f"Stored {', '.join(fields)} for prompt ID: {prompt_id}")
+        except Exception as e:
+            print(f"Error storing {', '.join(fields)}: {e}")
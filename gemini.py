@@ -1,18 +1,25 @@
-from flask import Flask, request, jsonify
 import os
-import tempfile
-import requests  
-from google.generativeai.protos import HarmCategory, SafetySetting
-import concurrent.futures
-from time import sleep
-from dotenv import load_dotenv
-from moviepy.editor import VideoFileClip, concatenate_videoclips
-import uuid
-import textwrap
-import json
-import ffmpeg
-import traceback
+import asyncio
 import helpers
+import metrics
+import prompts
+import async_runtime
+import response_decoder
+from edit_stream import IncrementalEditParser
+import random
+import time
+
+
+# Settings for waiting on uploaded files to finish processing
+FILE_WAIT_TIMEOUT = float(os.getenv("FILE_WAIT_TIMEOUT", 600))
+FILE_POLL_INITIAL_INTERVAL = float(os.getenv("FILE_POLL_INITIAL_INTERVAL", 0.5))
+FILE_POLL_MAX_INTERVAL = float(os.getenv("FILE_POLL_MAX_INTERVAL", 15))
+
+# Time from sending a streamed prompt until its first video edit is complete
+first_edit_latency = metrics.Histogram(
+    "gemini_first_edit_seconds",
+    "Seconds from sending a streamed prompt until the first video edit is parsed",
+)
 
 
 class Gemini:
@@ -29,376 +36,281 @@ class Gemini:
             file = genai.upload_file(path, mime_type=mime_type)
             print(f"Uploaded file '{file.display_name}' as: {file.uri}")
             return file
-        
-        
-    # Function to prompt the Gemini API 
+
+    # Function to wait until an uploaded file is ready to be used in a prompt
     @staticmethod
-    def prompt_gemini_api(video_file, gemini_prompt, video_durations, audio_file, model):
-        user_prompt = "You are a video editor. Given a video (which might be a concatenation of multiple clips), \\n\"" + str(video_durations) + "\"\\nThis is what the user wants for their final video final video: \"" + gemini_prompt + "\"\\nEven though you have been provided a single video, using the above video names and timestamps, treat each as a single video and understand whats going on based on the sound, actions and interactions. The goal is for you to create a video not more than 60 seconds long.\n Make sure you identify each clip by looking at its video name above and check its corresponding timeframe based on its start and ending timestamp in the inputted video. After identifying a video, treat it as an independent video. Forexample if you identify a video from the 10th to the 15th second, treat that video as a independent 5 second video. All the videos you identify and isolate will be considered as the videoclips where you will carryout various edit functionalities on them"
+    def wait_for_file_active(file, genai, timeout=FILE_WAIT_TIMEOUT, initial_interval=FILE_POLL_INITIAL_INTERVAL,
+                             max_interval=FILE_POLL_MAX_INTERVAL):
+        """Blocking wrapper of wait_for_file_active_async for threaded callers."""
+        return asyncio.run(Gemini.wait_for_file_active_async(file, genai, timeout, initial_interval, max_interval))
 
-        prompt = textwrap.dedent("""
-        You are to create edit settings by understanding what is happening in each of the video clips you identified as stated above as well as what the user wants for the final video and suggest various edit functionalities in a purely json format. Even if the user did not specify did not specify how the video should look like or it isn't clear, make sure you can identify relevant parts or clips of the video that will match the audio and if how the video should look like was specified, make sure your suggestions matches it too. 
-        The goal is to capture and suggest the key moments and best parts of the video(s) while making sure they all sum up to at most the time limit. You are to suggest the text overlays, perform video editing like changes in brightness, contrast, saturation, or any of the other effects listed above if you wish. Different edit functionalities can be performed on a single video clip at different time intervals and the videos must not appear in the order they came in. You decide how they appear based on the message you are trying to pass. You can trim a single video clip multiple times at different timestamps if possible. 
-        
-        If an audio has been provided, you are  also to suggest some edits on it. For the audio edits, you are simply to trim it in such a way that it matches or syncs with the final video. Make sure you calculate the start and end time of the audio to match the length of the resulting video after the video edits have been applied.
-
-        Here is a sample of how the json response you must return should look like:
-        "video_edits": [
-                {
-                    "id": 1,
-                    "video_name": "/tmp/tmpn45wu176/video_0_1718959816080.mp4",
-                    "start_time": 0.734861348165432,
-                    "end_time": 3.530177287369108,
-                    "effects": [
-                        {
-                            "name": "brightness",
-                            "adjustment": [0.3333637]
-                        }
-                    ],
-                    "text": [
-                        {
-                            "text": "Having some coffee with my sister",
-                            "font_size": 28,
-                            "text_color": "#3de490",
-                            "background_color": "#80000000"
-                        }
-                        
-                    ],
-                    "transition": "fade"
-                    
-                },
-                {
-                    "id": 2,
-                    "video_name": "/tmp/tmpn45wu176/video_1_1718959816136.mp4",
-                    "start_time": 0.401773244161053,
-                    "end_time": 2.8618605101782535,
-                    "effects": [
-                        {
-                            "name": "brightness",
-                            "adjustment": [-0.46320993]
-                        },
-                        {
-                            "name": "contrast",
-                            "adjustment": [0.3143587]
-                        },
-                        {
-                            "name": "saturation",
-                            "adjustment": [1.4236718]
-                        }
-                    ],
-                    "text": [
-                        {
-                            "text": "The coffee tasted delicious",
-                            "font_size": 26,
-                            "text_color": "#223a18",
-                            "background_color": "#80000000"
-                        }
-                        
-                    ],
-                    "transition": ""
-                    
-                },
-                {
-                    "id": 3,
-                    "video_name": "/tmp/tmpn45wu176/video_3_1718959816192.mp4",
-                    "start_time": 3.49878691889803517,
-                    "end_time": 6.981376295379518,
-                    "effects": [
-                        {
-                            "name": "brightness",
-                            "adjustment": [-0.46320993]
-                        },
-                        {
-                            "name": "saturation",
-                            "adjustment": [1.3028498]
-                        }
-                    ],
-                    "text": [
-                        {
-                            "text": "Guess who walked in? My brother",
-                            "font_size": 26,
-                            "text_color": "#171f34",
-                            "background_color": "#80000000"
-                        }
-                        
-                    ],
-                    "transition": "fade"
-                    
-                },
-                {
-                    "id": 4,
-                    "video_name": "/tmp/tmpn45wu176/video_4_1718959816213.mp4",
-                    "start_time": 0.665023107211262,
-                    "end_time": 2.9066618703894362,
-                    "effects": [
-                        {
-                            "name": "saturation",
-                            "adjustment": [0.506017]
-                        },
-                        {
-                            "name": "rotate",
-                            "adjustment": 90
-                        }
-                    ],
-                    "text": [],
-                    "transition": "slide"
-                    
-                },
-                {
-                    "id": 5,
-                    "video_name": "/tmp/tmpn45wu176/video_4_1718959816213.mp4",
-                    "start_time": 4.268023107211265,
-                    "end_time": 8.5066638703894361,
-                    "effects": [
-                        {
-                            "name": "brightness",
-                            "adjustment": [0.032896698]
-                        },
-                        {
-                            "name": "contrast",
-                            "adjustment": [0.018022478]
-                        }
-                    ],
-                    "text": [],
-                    "transition": "cross-fade"
-                    
-                },
-                {
-                    "id": 6,
-                    "video_name": "/tmp/tmpn45wu176/video_5_1718959816192.mp4",
-                    "start_time": 0.8979263059372027,
-                    "end_time": 3.355789246300705,
-                    "effects": [
-                        {
-                            "name": "brightness",
-                            "adjustment": [-0.40000975]
-                        },
-                        {
-                            "name": "contrast",
-                            "adjustment": [0.8433415]
-                        },
-                        {
-                            "name": "saturation",
-                            "adjustment": [1.0755221]
-                        },
-                        {
-                            "name": "vignette",
-                            "adjustment": [0.5, 0.5]
-                        },
-                        {
-                            "name": "zoomIn",
-                            "adjustment": [2.0, 1L]
-                        }
-                    ],
-                    "text": [
-                        {
-                            "text": "We all had such a great time",
-                            "font_size": 22,
-                            "text_color": "#f97b5d",
-                            "background_color": "#80000000"
-                        }
-                        
-                    ],
-                    "transition": "fade"
-                    
-                }
-            ],
-            "audio_edits": {
-                "start_time": 0.004576,
-                "end_time": 6.98762344
-            }
-        }
-
-        Let's break down this JSON response and understand what each part of the video edit settings means:
-        Think of this JSON like a recipe for editing a bunch of videos and stitching them together. Each item in the video_edits list is like instructions for a single video clip.
-        Let's look at one of these video edit instructions:
-
-        {
-            "id": 1,
-            "video_name": "/tmp/tmpn45wu176/video_0_1718959816080.mp4",
-            "start_time": 0.734861348165432,
-            "end_time": 3.530177287369108,
-            "effects": [
-                {
-                    "name": "brightness",
-                    "adjustment": [0.3333637]
-                }
-            ],
-            "text": [
-                {
-                    "text": "Having some coffee with my sister",
-                    "font_size": 28,
-                    "text_color": "#3de490",
-                    "background_color": "#80000000"
-                }
-            ],
-            "transition": "fade"
-        }
-
-        Here's what each part means:
-        - id: This is like a unique number tag for the trimmed version of this video clip. So, after we trim this video, we'll think of it as "video clip number 1". This is important for putting the clips in the right order later. It's always a whole number (an integer).
-        - video_name: This is the video name assigneed to that video clip. It's like saying, "Hey, go find this specific video to work with." Each video has a unique name, so we don't get them mixed up.
-        - start_time: This tells us where to start chopping the video, measured in seconds. It's a decimal number (a float) because we might want to start at a very precise moment, like 0.734 seconds in. The start_time MUST not begin at 0
-        - end_time: This tells us where to stop chopping the video, also in seconds and also a float for precision. So, for this clip, we're only using the part of the video between 0.734 seconds and 3.530 seconds. The end_time MUST not begin at the last second.
-
-
-        effects: This is a list of special visual tweaks we want to apply to the video clip. Think of it like adding filters on Instagram. Right now, we only have three options:
-        - **`brightness`:** This controls how bright or dark the clip looks.  The adjustment value is a number between -1 and 1.  Zero means no change, positive numbers make it brighter, and negative numbers make it darker.  In this example, 0.333 makes the clip a bit brighter.
-        - **`contrast`:** This controls the difference between the darkest and lightest parts of the clip.  Again, the adjustment is between -1 and 1.  Zero means no change, positive numbers increase the contrast (making darks darker and lights lighter), and negative numbers decrease the contrast (making everything look more similar in brightness).
-        - **`saturation`:** This controls how vivid the colors in the clip are.  0 is the neutral point and the color stays thesame. Positive numbers like like 0.5, 1, 2, etc will make the colors in the video more intense and vibrant. The higher the number, the more saturated and punchy the colors become. Negative numbers like like -0.5, -1, etc will make the colors more muted and washed out. The further negative you go, the closer you get to a black and white look.
-        - **`vignette`**: This effect creates a soft, darkened border around the edges of the video, drawing attention to the center. The strength of the effect is controlled by two values between 0 and 1: outerRadius (how far the darkening extends) and innerRadius (the size of the unaffected center area). It should be a list of 2 float values like this: [outerRadius, innerRadius]
-        - **`fisheye`**: This effect distorts the video to create a wide-angle, rounded look, similar to a fisheye lens. The strength of the distortion is controlled by a value between 0 (no distortion) and 1 (maximum distortion). The adjustment value should be a single float in a list.
-        - **`colorTint`**: This effect applies a tint of a specific color over the entire video. The color is specified using a hex color code (e.g., "#FF0000" for red, "#0000FF" for blue).
-        - **`rotate`**: This effect rotates the video by a specified number of degrees (e.g., 90 degrees). This will be a list containing and integer value specifying the number of degrees.
-        - **`zoomIn`**: It takes a list containing 2 values, [zoomFactor, durationSeconds]. This effect gradually zooms into the video over a specified duration.
-            -zoomFactor (Float): How much to zoom in. A value of 2.0 means zooming in to twice the original size.
-            -durationSeconds (Long): How long the zoom-in effect should last, in seconds.
-        - **`zoomOut`**: This effect gradually zooms out of the video over a specified duration.
-            - zoomFactor (Float): How much to zoom out. A value of 0.5 means zooming out to half the original size.
-            - durationSeconds (Long): How long the zoom-out effect should last, in seconds.
-        text: This is a list of text overlays we want to put on top of the video. Each text overlay has:
-        - **`text`:** The actual words to display.
-        - **`font_size`:** How big the text should be in pixels for a mobile device
-        - **`text_color`:** The color of the text, written as a hex code (like #3de490 for a greenish color).
-        - **`background_color`:** The color behind the text, also a hex code.  "#80000000" means a semi-transparent black, so the video can still be seen a bit behind the text.
-
-        transition: This tells us how to smoothly blend this clip with the next one in the sequence. "fade" means the clip will slowly fade out as the next one fades in. There are other options like "slide" or "cross-fade". If it's empty (like in the second video edit), there's no special transition.
-        
-        
-        Let's look at the audio edits:
-        "audio_edits": {
-                "start_time": 0.004576,
-                "end_time": 6.98762344
-            }
-        The `start_time` signfies the time where the trimming of the audio will start while the `end_time` signifies the time where the trimming of the audio will end.
-        
+    @staticmethod
+    async def wait_for_file_active_async(file, genai, timeout=FILE_WAIT_TIMEOUT,
+                                         initial_interval=FILE_POLL_INITIAL_INTERVAL,
+                                         max_interval=FILE_POLL_MAX_INTERVAL):
+        """Polls genai.get_file with exponential backoff until the file leaves PROCESSING.
 
+        Polling starts at sub-second intervals and doubles up to max_interval, with
+        jitter so workers that uploaded together do not poll in lockstep. The
+        time-to-ACTIVE is recorded in metrics.file_active_latency. Only the
+        get_file calls use a thread; the waits in between hold none.
 
-        Important Notes:
-        - Multiple Edits on One Video: You noticed that video IDs 4 and 5 use the same video_name. This means we can take different chunks of the same video clip and edit them separately!
-        - No Text Required: Some video edits might not have any text overlays, like video ID 5. That's totally fine!
-        No Effects Required: Some videos might also not have any effects.
-        - When suggesting the start_time and end_time for a video clip to be trimmed, remember to isolate that clip. If that clip happened to be between the 10th and the 15th second of the original clip, consider it a 0 to 5 seconds video and suggest edits on it like you will suggest on a 0 to 5 seconds video. For example for this clip we can condider to have start time at 1.00345 and end time at 4.55789 rather than at 11.00345 and 14.55789 respectfully. Know that in this video clip you are identifying interesting parts relevant to the final video you are trying to create so the start time must not be exactly at the 0th second neither must the end time necesarily be at the last second of the video clip. Try to be flexible.
-        - The IDs are integers that dictate the sequence in which the new video clips must appear in the final video
-        - when proposing the edit settings sum up the different timeframes making sure it doesn't exceed the duration limit above.
-        - All the effects must not be used. The point of the effects is to modify the video or make it more interesting
+        Args:
+            file: The Genai file object to wait for.
+            genai: The google.generativeai module (or a stand-in such as fakes.FakeGenai).
+            timeout: Maximum waiting time in seconds.
 
+        Returns:
+            The refreshed, ACTIVE file object.
 
-        You are to carry out this by proposing time stamp intervals for each video and the edit fuctionalities to be performed during that interval. You decide on which edits go where based on what is expected of you and the goal is to make the result as interesting, creative and as engaging as possible. Try as much as possible to identify the specified content type if mentioned and work towards delivering something creative in that area or get creative and come up wit what you believe is best. Some of this content type include comedy skits, dance trends, lip-syncing, tutorials, product demons, vlogs, reviews, etc. You will suggest how the videos are displayed and what to include or exclude so as to pass the information needed or make it as interesting and creative as possible.  
-        
-        NB: Make sure you identify each video in the input concatenated videos and treat it independent of the other assuming the its actual start time os 0 and its end time is its end time in the concatenated video minis its start time in the concatenated video. Remember you are applying edits to each independent video you succeed to identify by suggesting parts of this video to trim (using its new start time and end time)
-        
-        Before you suggest any edits, make sure you identify each clip by looking at its video name above and check its corresponding timeframe based on its start and ending timestamp in the inputted video. You have also been given the start and ending timestamp of each video in the input video. After identifying a video, treat it as an independent video. Forexample if you identify a video from the 10th to the 15th second, treat that video as a independent 5 second video. All the videos you identify and isolate will be considered as the videoclips where you will carryout various edit functionalities on them"
-        
-        Lets look at our example again to understand whats expected for each video edit:
-        
-        {
-            "id": 1,
-            "video_name": "/tmp/tmpn45wu176/video_0_1718959816080.mp4",
-            "start_time": 0.734861348165432,
-            "end_time": 3.530177287369108,
-            "effects": [
-                {
-                    "name": "brightness",
-                    "adjustment": [0.3333637]
-                }
-            ],
-            "text": [
-                {
-                    "text": "Having some coffee with my sister",
-                    "font_size": 28,
-                    "text_color": "#3de490",
-                    "background_color": "#80000000"
-                }
-            ],
-            "transition": "fade"
-        }
-        
-        Here's what some part mean:
-        - id: This is like a unique number tag for the trimmed version of this video clip. So, after we trim this video, we'll think of it as "video clip number 1". This is important for putting the clips in the right order later. It's always a whole number (an integer).
-        - video_name: This is the video name assigneed to that video clip. It's like saying, "Hey, go find this specific video to work with." Each video has a unique name, so we don't get them mixed up.
-        - start_time: This tells us where to start chopping the video, measured in seconds. It's a decimal number (a float) because we might want to start at a very precise moment, like 0.734 seconds in. The start_time MUST not begin at 0
-        - end_time: This tells us where to stop chopping the video, also in seconds and also a float for precision. So, for this clip, we're only using the part of the video between 0.734 seconds and 3.530 seconds. The end_time MUST not begin at the last second.
-        
-        effects: This is a list of special visual tweaks we want to apply to the video clip. Think of it like adding filters on Instagram. Right now, we only have three options:
-        - **`brightness`:** This controls how bright or dark the clip looks.  The adjustment value is a number between -1 and 1.  Zero means no change, positive numbers make it brighter, and negative numbers make it darker.  In this example, 0.333 makes the clip a bit brighter.
-        - **`contrast`:** This controls the difference between the darkest and lightest parts of the clip.  Again, the adjustment is between -1 and 1.  Zero means no change, positive numbers increase the contrast (making darks darker and lights lighter), and negative numbers decrease the contrast (making everything look more similar in brightness).
-        - **`saturation`:** This controls how vivid the colors in the clip are.  0 is the neutral point and the color stays thesame. Positive numbers like like 0.5, 1, 2, etc will make the colors in the video more intense and vibrant. The higher the number, the more saturated and punchy the colors become. Negative numbers like like -0.5, -1, etc will make the colors more muted and washed out. The further negative you go, the closer you get to a black and white look.
-        - **`vignette`**: This effect creates a soft, darkened border around the edges of the video, drawing attention to the center. The strength of the effect is controlled by two values between 0 and 1: outerRadius (how far the darkening extends) and innerRadius (the size of the unaffected center area). It should be a list of 2 float values like this: [outerRadius, innerRadius]
-        - **`fisheye`**: This effect distorts the video to create a wide-angle, rounded look, similar to a fisheye lens. The strength of the distortion is controlled by a value between 0 (no distortion) and 1 (maximum distortion). The adjustment value should be a single float in a list.
-        - **`colorTint`**: This effect applies a tint of a specific color over the entire video. The color is specified using a hex color code (e.g., "#FF0000" for red, "#0000FF" for blue).
-        - **`rotate`**: This effect rotates the video by a specified number of degrees (e.g., 90 degrees). This will be a list containing and integer value specifying the number of degrees.
-        - **`zoomIn`**: It takes a list containing 2 values, [zoomFactor, durationSeconds]. This effect gradually zooms into the video over a specified duration.
-            -zoomFactor (Float): How much to zoom in. A value of 2.0 means zooming in to twice the original size.
-            -durationSeconds (Long): How long the zoom-in effect should last, in seconds.
-        - **`zoomOut`**: This effect gradually zooms out of the video over a specified duration.
-            - zoomFactor (Float): How much to zoom out. A value of 0.5 means zooming out to half the original size.
-            - durationSeconds (Long): How long the zoom-out effect should last, in seconds.
-        text: This is a list of text overlays we want to put on top of the video. Each text overlay has:
-        - **`text`:** The actual words to display.
-        - **`font_size`:** How big the text should be in pixels for a mobile device
-        - **`text_color`:** The color of the text, written as a hex code (like #3de490 for a greenish color).
-        - **`background_color`:** The color behind the text, also a hex code.  "#80000000" means a semi-transparent black, so the video can still be seen a bit behind the text.
+        Raises:
+            TimeoutError: If the file is still processing when the deadline passes.
+            ValueError: If the file ends up in any state other than ACTIVE.
+        """
+        start = time.monotonic()
+        deadline = start + timeout
+        interval = initial_interval
+
+        while file.state.name == "PROCESSING":
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"File {file.name} was still processing after {timeout}s")
+            await asyncio.sleep(min(interval / 2 + random.uniform(0, interval / 2), remaining))
+            interval = min(interval * 2, max_interval)
+            file = await async_runtime.run_io(genai.get_file, file.name)
+
+        if file.state.name != "ACTIVE":
+            raise ValueError(f"File {file.name} failed to process: {file.state.name}")
+
+        elapsed = time.monotonic() - start
+        metrics.file_active_latency.observe(elapsed)
+        print(f"File {file.name} ready after {elapsed:.1f}s")
+        return file
+
+    # Function to wait for several uploaded files at once
+    @staticmethod
+    def wait_for_files_active(files, genai, timeout=FILE_WAIT_TIMEOUT):
+        """Blocking wrapper of wait_for_files_active_async for threaded callers."""
+        return asyncio.run(Gemini.wait_for_files_active_async(files, genai, timeout))
+
+    @staticmethod
+    async def wait_for_files_active_async(files, genai, timeout=FILE_WAIT_TIMEOUT):
+        """Waits for all given files concurrently under a single shared deadline.
+
+        None entries are passed through unchanged so optional files such as the
+        audio track can be handed in directly.
+
+        Returns:
+            The refreshed file objects, in the same order as files.
+        """
+        pending = [file for file in files if file is not None]
+        if not pending:
+            return list(files)
+
+        ready = iter(await asyncio.gather(*(Gemini.wait_for_file_active_async(file, genai, timeout)
+                                            for file in pending)))
+        return [next(ready) if file is not None else None for file in files]
+
+    # Function to reuse a previous upload of identical content
+    @staticmethod
+    def upload_to_gemini_cached(path, genai, cache, mime_type=None):
+        """Uploads the given file to Gemini unless identical content is already there.
+
+        The cache is keyed by the SHA-256 of the file content. A cached file is
+        only reused after genai.get_file confirms it still exists remotely; an
+        expired, deleted or failed file is treated as a miss and uploaded again.
+
+        Returns:
+            A tuple of the Gemini file and True when it is already ACTIVE, in
+            which case there is no need to wait for processing.
+        """
+        key = helpers.file_sha256(path)
+        entry = cache.get(key)
+        if entry is not None:
+            try:
+                file = genai.get_file(entry['name'])
+            except Exception as e:
+                print(f"Cached Gemini file {entry['name']} is no longer available: {e}")
+                file = None
+
+            if file is not None and file.state.name in ("ACTIVE", "PROCESSING"):
+                print(f"Reusing Gemini file {file.name} for {path} ({file.state.name})")
+                return file, file.state.name == "ACTIVE"
+            cache.remove(key)
+
+        file = Gemini.upload_to_gemini(path, genai, mime_type=mime_type)
+        cache.put(key, file)
+        return file, False
         
         
-        Also remember the start and end time of the audio edits should be calculated in such a way that if all those video edits are applied and the audio is trimmed its length would be the length of the new video
+    @staticmethod
+    async def upload_to_gemini_cached_async(path, genai, cache, mime_type=None):
+        """upload_to_gemini_cached on the asyncio I/O executor; the Files API has no asyncio client."""
+        return await async_runtime.run_io(Gemini.upload_to_gemini_cached, path, genai, cache, mime_type)
 
+    # Function to parse one streamed chunk and hand out the video edits it completes
+    @staticmethod
+    def _feed_chunk(chunk, parser, chunks, edits, on_video_edit, start):
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. only finish metadata) carry nothing to parse
+            return
+        chunks.append(text)
+        for edit in parser.feed(text):
+            if not edits:
+                first_edit_latency.observe(time.monotonic() - start)
+            edits.append(edit)
+            try:
+                on_video_edit(edit, list(edits))
+            except Exception as e:
+                print(f"Error handling streamed video edit: {e}")
 
-        If for whatsoever reason you cannot produce a response or come up with video editing functionalities, generate a json response with empty values for all the videos'. Otherwise, the response should be in pure raw json given the structure above. The response should begin with a '{' and end with '}'. Make sure you don't exceed the maximum output tokens of 100000 and no matter what, provide a complete response.
-    
-    
-    
-    """)
-        new_prompt = user_prompt + prompt
-        
+    # Function to stream a response and hand out video edits as they complete
+    @staticmethod
+    def stream_video_edits(chat_session, prompt, on_video_edit, video_names=None):
+        """Sends the prompt with streaming enabled and returns the full response text.
+
+        Each completed element of "video_edits" is validated and passed to
+        on_video_edit(edit, edits_so_far) while the rest is still generating.
+        """
+        start = time.monotonic()
+        parser = IncrementalEditParser(video_names=video_names)
+        chunks, edits = [], []
+        for chunk in chat_session.send_message(prompt, stream=True):
+            Gemini._feed_chunk(chunk, parser, chunks, edits, on_video_edit, start)
+        return "".join(chunks)
+
+    @staticmethod
+    async def stream_video_edits_async(chat_session, prompt, on_video_edit, video_names=None):
+        """Like stream_video_edits, using the SDK's asyncio streaming call."""
+        start = time.monotonic()
+        parser = IncrementalEditParser(video_names=video_names)
+        chunks, edits = [], []
+        async for chunk in await chat_session.send_message_async(prompt, stream=True):
+            Gemini._feed_chunk(chunk, parser, chunks, edits, on_video_edit, start)
+        return "".join(chunks)
+
+    # Function to build the chat session and prompt text of a request
+    @staticmethod
+    def start_chat(video_file, gemini_prompt, video_durations, audio_file, model, context_cache=None,
+                   project_id=None, keyframes=None, audio_summary=None, user_id=None):
+        """Returns a tuple of the chat session to send the prompt to and the prompt text.
+
+        When a context_cache is given, the instructions and media are kept in the
+        cached content of the user's project and only the per-request prompt is sent.
+
+        When keyframes (parts from keyframes.keyframe_parts) are given, they are
+        sent instead of the video and video_file is the clips' soundtrack, or None.
+
+        An audio_summary (from audio_analysis.timing_summary) is added to the
+        per-request prompt, whether or not audio_file is sent too.
+        """
+        if keyframes is not None:
+            return Gemini._start_keyframe_chat(keyframes, video_file, gemini_prompt, video_durations, audio_file,
+                                               model, audio_summary)
+
+        media_parts = [part for part in (video_file, audio_file) if part is not None]
+
+        cached_model, cached_tokens = None, 0
+        if context_cache is not None and project_id is not None and user_id is not None:
+            with metrics.timed("context_cache"):
+                cached_model, cached_tokens = context_cache.model_for(user_id, project_id, model, media_parts,
+                                                                      video_durations)
+
+        # Fill the precompiled prompt template and check the request against the token budget
+        if cached_model is not None:
+            new_prompt, input_token_count = prompts.fit_to_budget(model, [], video_durations, gemini_prompt,
+                                                                  build=prompts.build_request,
+                                                                  cached_tokens=cached_tokens,
+                                                                  audio_summary=audio_summary)
+            return cached_model.start_chat(), new_prompt
+
+        new_prompt, input_token_count = prompts.fit_to_budget(model, media_parts, video_durations, gemini_prompt,
+                                                              audio_summary=audio_summary)
         chat_session = model.start_chat(
-            history=[
-            {
-                "role": "user",
-                "parts": [
-                video_file,
-                ],
-            },
-            {
-                "role": "user",
-                "parts": [
-                audio_file,
-                ],
-            },
-        ]
+            history=[{"role": "user", "parts": [part]} for part in media_parts]
         )
+        return chat_session, new_prompt
+
+    @staticmethod
+    def _start_keyframe_chat(keyframes, soundtrack_file, gemini_prompt, video_durations, audio_file, model,
+                             audio_summary=None):
+        # Inline images cannot go into a context cache, so everything is sent as one turn
+        media_parts = list(keyframes)
+        if soundtrack_file is not None:
+            media_parts += ["The clips' soundtrack:", soundtrack_file]
+        if audio_file is not None:
+            media_parts += ["The audio to edit:", audio_file]
+        new_prompt, input_token_count = prompts.fit_to_budget(model, media_parts, video_durations, gemini_prompt,
+                                                              build=prompts.build_keyframe_prompt,
+                                                              audio_summary=audio_summary)
+        return model.start_chat(history=[{"role": "user", "parts": media_parts}]), new_prompt
+
+    # Function to prompt the Gemini API 
+    @staticmethod
+    def prompt_gemini_api(video_file, gemini_prompt, video_durations, audio_file, model, on_video_edit=None,
+                          context_cache=None, project_id=None, keyframes=None, audio_summary=None, user_id=None):
+        """Prompts Gemini with the uploaded media and returns the parsed edit settings.
+
+        When on_video_edit is given the response is streamed, and the callback is
+        called with each validated video edit and the list of edits so far as soon
+        as the edit's closing brace arrives.
+
+        When a context_cache is given, the instructions and media are kept in the
+        cached content of the user's project and only the per-request prompt is sent.
+
+        For keyframes and audio_summary, see start_chat.
+
+        Returns:
+            The edit settings, or None when the response could not be decoded.
+
+        Raises:
+            quota.QuotaExhausted: If Gemini keeps rejecting the request for quota.
+            Any other error of the Gemini API, so the caller can report it.
+        """
+        chat_session, new_prompt = Gemini.start_chat(video_file, gemini_prompt, video_durations, audio_file, model,
+                                                     context_cache, project_id, keyframes, audio_summary, user_id)
         try:
-            response = chat_session.send_message(new_prompt)
-
-            # Directly parse the response as JSON
-            gemini_response_json = json.loads(response.text.strip()) 
-
-            # Process Gemini response and create video edits using function calls
-            video_edits = []
-            for edit in gemini_response_json['video_edits']:
-                video_name = edit['video_name']
-                _id = edit['id']
-                start_time = edit['start_time']
-                end_time = edit['end_time']
-                effects = [helpers.return_effect(effect['name'], effect['adjustment']) for effect in edit['effects']]
-                text = [helpers.return_text(text['text'], text['font_size'], text['text_color'], text['background_color']) for text in edit['text']]
-                transition = edit['transition']
-                video_edits.append(helpers.return_video_edit(_id, video_name, start_time, end_time, effects, text, transition))
-            
-            audio_edits = {
-                "start_time": "",
-                "end_time": ""
-            } 
-            if gemini_response_json['audio_edits']:
-                audio_edits = gemini_response_json['audio_edits']
-            
-
-            return {
-                'video_edits': video_edits,
-                'audio_edits': audio_edits
-            }
-        except Exception as e:
-            print(e)
-            
-        
-        
\ No newline at end of file
+            with metrics.timed("generate") as stage:
+                if on_video_edit is None:
+                    response_text = chat_session.send_message(new_prompt).text
+                else:
+                    response_text = Gemini.stream_video_edits(chat_session, new_prompt, on_video_edit,
+                                                              video_names=list(video_durations))
+                stage['response_chars'] = len(response_text)
+
+            # Parse, repair and validate the response, re-asking only for invalid fragments
+            with metrics.timed("parse"):
+                return response_decoder.decode_response(response_text, model, video_names=list(video_durations))
+        except response_decoder.ResponseDecodeError as e:
+            print(f"Gemini returned no usable edit settings: {e}")
+            return None
+
+    @staticmethod
+    async def prompt_gemini_api_async(video_file, gemini_prompt, video_durations, audio_file, model,
+                                      on_video_edit=None, context_cache=None, project_id=None, keyframes=None,
+                                      audio_summary=None, user_id=None):
+        """Like prompt_gemini_api, but generation holds no thread while Gemini is working.
+
+        Token counting, the context cache and the decoder's repair calls use the
+        blocking SDK and run on the asyncio I/O executor.
+        """
+        chat_session, new_prompt = await async_runtime.run_io(Gemini.start_chat, video_file, gemini_prompt,
+                                                              video_durations, audio_file, model, context_cache,
+                                                              project_id, keyframes, audio_summary, user_id)
+        try:
+            with metrics.timed("generate") as stage:
+                if on_video_edit is None:
+                    response_text = (await chat_session.send_message_async(new_prompt)).text
+                else:
+                    response_text = await Gemini.stream_video_edits_async(chat_session, new_prompt, on_video_edit,
+                                                                          video_names=list(video_durations))
+                stage['response_chars'] = len(response_text)
+
+            with metrics.timed("parse"):
+                return await async_runtime.run_io(response_decoder.decode_response, response_text, model,
+                                                  video_names=list(video_durations))
+        except response_decoder.ResponseDecodeError as e:
+            print(f"Gemini returned no usable edit settings: {e}")
+            return None
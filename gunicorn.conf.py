@@ -0,0 +1,45 @@
+"""Gunicorn settings for serving the backend in production.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Every worker process runs its own job pool and its own CPU and I/O stage
+limits (see limits.py), so size WEB_WORKERS * CPU_STAGE_CONCURRENCY to the
+cores of the machine.
+
+A job runs in the worker that accepted it, but its status and result are
+written to Firestore, so any worker can answer polls for it. The other
+per-worker state (context cache handles, the memory result cache and its
+single-flight) only saves work: a request that lands on another worker
+repeats it and gets the same response. Set RESULT_CACHE_BACKEND=firestore
+to share results between workers. The clip store, segment cache, upload
+cache and file-backed quota buckets are shared through the local disk.
+"""
+import os
+import multiprocessing
+
+bind = os.getenv("BIND", f"0.0.0.0:{os.getenv('PORT', '5000')}")
+
+# Worker processes, each serving WEB_THREADS requests at once
+workers = int(os.getenv("WEB_WORKERS", max(1, multiprocessing.cpu_count() // 2)))
+threads = int(os.getenv("WEB_THREADS", 8))
+worker_class = "gthread"
+
+# Requests are bounded by REQUEST_TIMEOUT in the pipeline; the worker timeout only catches hung workers
+timeout = int(float(os.getenv("REQUEST_TIMEOUT", 900))) + 60
+# Time in-flight requests and background jobs get to finish after SIGTERM
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 120))
+keepalive = 5
+
+# Recycle workers now and then so memory held by decoders and clients does not build up
+max_requests = 500
+max_requests_jitter = 50
+
+accesslog = "-"
+
+
+def worker_exit(server, worker):
+    # Let background jobs finish; the ones that cannot before the arbiter kills the worker are marked failed
+    import main
+    finished = main.job_manager.shutdown(wait=True, timeout=max(graceful_timeout - 10, 0))
+    if not finished:
+        server.log.warning("Worker %s exited with jobs still running", worker.pid)
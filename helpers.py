@@ -1,3 +1,6 @@
+import hashlib
+
+
 def return_empty_response():
   effects = [return_effect("", "")]
   text = [return_text("", "", "", "")]
@@ -33,6 +36,15 @@ def return_video_edit(_id, video_name, start_time, end_time, effects, text, tran
     'transition': transition
   }
 
+def video_edit_from_json(edit):
+  """Builds a video edit from a decoded model response element.
+
+  Raises KeyError or TypeError when a required field is missing.
+  """
+  effects = [return_effect(effect['name'], effect['adjustment']) for effect in edit['effects']]
+  text = [return_text(text['text'], text['font_size'], text['text_color'], text['background_color']) for text in edit['text']]
+  return return_video_edit(edit['id'], edit['video_name'], edit['start_time'], edit['end_time'], effects, text, edit['transition'])
+
 def return_effect(name, adjustment):
   return {
     'name': name,
@@ -51,4 +63,12 @@ def return_audio_edits(start_time, end_time):
   return {
     "start_time": start_time,
     "end_time": end_time
-  }
\ No newline at end of file
+  }
+
+def file_sha256(path, chunk_size=1024 * 1024):
+  """Returns the hex SHA-256 digest of a file's content."""
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
@@ -0,0 +1,328 @@
+import os
+import hmac
+import time
+import uuid
+import queue
+import hashlib
+import secrets
+import concurrent.futures
+import threading
+import contextvars
+import traceback
+import async_runtime
+
+
+# Settings for the background job worker pool
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", 8))
+# Finished jobs are kept this long so clients can fetch their results
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", 3600))
+# Jobs the asyncio pipeline keeps in flight at once in one worker process
+ASYNC_JOB_CONCURRENCY = int(os.getenv("ASYNC_JOB_CONCURRENCY", 256))
+
+# Error of jobs that were still running when their worker had to exit
+INTERRUPTED_ERROR = "Server shut down while the job was running, please resubmit it"
+
+PENDING = "pending"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class JobRejected(Exception):
+    """Raised when the worker pool and its queue are both full."""
+
+
+# Function to create the record of a submitted job
+def new_job(metadata=None):
+    return {
+        'job_id': uuid.uuid4().hex,
+        'status': PENDING,
+        'metadata': metadata or {},
+        'created_at': time.time(),
+        'started_at': None,
+        'finished_at': None,
+        'result': None,
+        'error': None,
+    }
+
+
+# Function to create the secret that lets the submitter of a job read it
+def new_job_token():
+    """Returns a random token for the submitter and its hash, which is what the job keeps."""
+    token = secrets.token_urlsafe(32)
+    return token, hash_job_token(token)
+
+
+def hash_job_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+# Function to check the token a client presents for a job
+def job_token_matches(job, token):
+    expected = (job or {}).get('metadata', {}).get('token_hash')
+    return bool(token and expected) and hmac.compare_digest(hash_job_token(token), expected)
+
+
+class InMemoryJobBackend:
+    """Keeps job records and the work queue in process memory.
+
+    Suitable for a single worker process and for local testing. The queue is
+    bounded by max_pending, which is what gives the manager admission control.
+    """
+
+    def __init__(self, max_pending=JOB_MAX_PENDING, result_ttl=JOB_RESULT_TTL):
+        self.result_ttl = result_ttl
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def add(self, job):
+        with self._lock:
+            self._expire_finished()
+            self._jobs[job['job_id']] = job
+
+    def remove(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def enqueue(self, job, task):
+        self.add(job)
+        try:
+            self._queue.put_nowait((job['job_id'], task))
+        except queue.Full:
+            self.remove(job['job_id'])
+            raise JobRejected("Too many jobs in progress, try again later")
+
+    def dequeue(self, timeout=None):
+        return self._queue.get(timeout=timeout)
+
+    def task_done(self):
+        self._queue.task_done()
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(fields)
+            return dict(job)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _expire_finished(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job['finished_at'] and now - job['finished_at'] > self.result_ttl]:
+            del self._jobs[job_id]
+
+
+class JobManager:
+    """Runs submitted pipeline jobs on a bounded pool of worker threads.
+
+    At most `workers` jobs run at once and at most the backend's queue size wait
+    behind them; anything beyond that is rejected with JobRejected. Every status
+    change is passed to on_status so it can be mirrored elsewhere (e.g. Firestore).
+    """
+
+    def __init__(self, backend=None, workers=JOB_WORKERS, on_status=None):
+        self.backend = backend or InMemoryJobBackend()
+        self.on_status = on_status
+        self._stopping = threading.Event()
+        self._abandon = threading.Event()
+        self._running = set()
+        self._lock = threading.Lock()
+        self._workers = [threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    # Function to queue a job and return its record immediately
+    def submit(self, fn, *args, metadata=None):
+        if self._stopping.is_set():
+            raise JobRejected("Server is shutting down")
+
+        job = new_job(metadata)
+        submitted = dict(job)
+        # Reported before a worker can pick the job up, so its later statuses are never overwritten
+        self._notify(submitted)
+        # Run the job in a copy of the caller's context so its request id follows it into the worker
+        context = contextvars.copy_context()
+        try:
+            self.backend.enqueue(job, (context.run, (fn, *args)))
+        except JobRejected as e:
+            self._notify({**job, 'status': FAILED, 'error': str(e), 'finished_at': time.time()})
+            raise
+        return submitted
+
+    def get(self, job_id):
+        return self.backend.get(job_id)
+
+    def shutdown(self, wait=True, timeout=None):
+        """Stops accepting jobs and lets the workers finish what is already queued.
+
+        Args:
+            wait: Whether to block until the workers have stopped.
+            timeout: Seconds all workers together may take. Once it passes, queued
+                jobs that have not started and jobs still running are marked
+                failed, so clients polling them know to resubmit them.
+
+        Returns:
+            True if every worker stopped, False if some were still running a job.
+        """
+        self._stopping.set()
+        if not wait:
+            return False
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in self._workers:
+            worker.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        if any(worker.is_alive() for worker in self._workers):
+            self._abandon.set()
+            print("Shutdown timeout passed; failing queued jobs that have not started")
+            while True:
+                try:
+                    job_id, _ = self.backend.dequeue(timeout=0)
+                except queue.Empty:
+                    break
+                self._abandon_job(job_id)
+        with self._lock:
+            running = list(self._running)
+        for job_id in running:
+            # A job that still finishes before the process exits overwrites this
+            self._notify(self.backend.update(job_id, status=FAILED, error=INTERRUPTED_ERROR, finished_at=time.time()))
+        return not any(worker.is_alive() for worker in self._workers)
+
+    def _work(self):
+        while True:
+            try:
+                job_id, (fn, args) = self.backend.dequeue(timeout=0.5)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+
+            if self._abandon.is_set():
+                self._abandon_job(job_id)
+                continue
+
+            with self._lock:
+                self._running.add(job_id)
+            self._notify(self.backend.update(job_id, status=RUNNING, started_at=time.time()))
+            try:
+                result = fn(*args)
+                job = self.backend.update(job_id, status=SUCCEEDED, result=result, finished_at=time.time())
+            except Exception as e:
+                traceback.print_exc()
+                job = self.backend.update(job_id, status=FAILED, error=str(e), finished_at=time.time())
+            finally:
+                self.backend.task_done()
+                with self._lock:
+                    self._running.discard(job_id)
+            self._notify(job)
+
+    def _abandon_job(self, job_id):
+        # Record that the job never ran instead of starting it while the server goes down
+        job = self.backend.update(job_id, status=FAILED, finished_at=time.time(),
+                                  error="Server shut down before the job started, please resubmit it")
+        self.backend.task_done()
+        self._notify(job)
+
+    def _notify(self, job):
+        if self.on_status is None:
+            return
+        try:
+            self.on_status(job)
+        except Exception as e:
+            print(f"Error reporting status of job {job['job_id']}: {e}")
+
+
+class AsyncJobManager:
+    """Runs submitted pipeline coroutines as tasks on the worker's shared event loop.
+
+    Jobs start as soon as they are submitted and spend their waits on the loop
+    rather than on threads, so up to max_jobs can be in flight in one process;
+    further submissions are rejected with JobRejected. Records live in the same
+    kind of backend as JobManager's and status changes go to on_status, which
+    is called on the asyncio I/O executor.
+    """
+
+    def __init__(self, backend=None, max_jobs=ASYNC_JOB_CONCURRENCY, on_status=None):
+        self.backend = backend or InMemoryJobBackend()
+        self.max_jobs = max_jobs
+        self.on_status = on_status
+        self._stopping = threading.Event()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    # Function to start a job and return its record immediately
+    def submit(self, coroutine_function, *args, metadata=None):
+        if self._stopping.is_set():
+            raise JobRejected("Server is shutting down")
+
+        job = new_job(metadata)
+        with self._lock:
+            if len(self._in_flight) >= self.max_jobs:
+                raise JobRejected("Too many jobs in progress, try again later")
+            self.backend.add(job)
+            # Stored under the lock, so the job cannot finish and remove itself first
+            self._in_flight[job['job_id']] = async_runtime.submit(self._run(job, coroutine_function, args))
+        return dict(job)
+
+    def get(self, job_id):
+        return self.backend.get(job_id)
+
+    def shutdown(self, wait=True, timeout=None):
+        """Stops accepting jobs and waits for the ones in flight.
+
+        Jobs still running when timeout passes are marked failed, so clients
+        polling them know to resubmit them.
+
+        Returns:
+            True if every job finished within timeout.
+        """
+        self._stopping.set()
+        with self._lock:
+            in_flight = dict(self._in_flight)
+        if not wait or not in_flight:
+            return not in_flight
+        done, not_done = concurrent.futures.wait(in_flight.values(), timeout)
+        for job_id, future in in_flight.items():
+            if future in not_done:
+                # Reported from this thread, since the loop may be too busy to run the report
+                job = self.backend.update(job_id, status=FAILED, error=INTERRUPTED_ERROR, finished_at=time.time())
+                if self.on_status is not None:
+                    try:
+                        self.on_status(job)
+                    except Exception as e:
+                        print(f"Error reporting status of job {job_id}: {e}")
+        return not not_done
+
+    async def _run(self, job, coroutine_function, args):
+        job_id = job['job_id']
+        try:
+            await self._notify(job)
+            await self._notify(self.backend.update(job_id, status=RUNNING, started_at=time.time()))
+            try:
+                result = await coroutine_function(*args)
+                job = self.backend.update(job_id, status=SUCCEEDED, result=result, finished_at=time.time())
+            except Exception as e:
+                traceback.print_exc()
+                job = self.backend.update(job_id, status=FAILED, error=str(e), finished_at=time.time())
+            await self._notify(job)
+        finally:
+            # Still in flight until reported, so shutdown waits for the final status to be stored
+            with self._lock:
+                self._in_flight.pop(job_id, None)
+
+    async def _notify(self, job):
+        if self.on_status is None:
+            return
+        try:
+            await async_runtime.run_io(self.on_status, job)
+        except Exception as e:
+            print(f"Error reporting status of job {job['job_id']}: {e}")
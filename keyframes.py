@@ -0,0 +1,227 @@
+import io
+import os
+import time
+import concurrent.futures
+import ffmpeg
+import numpy as np
+from PIL import Image
+import metrics
+from video import Video
+
+
+# Settings for the keyframe input mode (INPUT_MODE=keyframes)
+KEYFRAME_WIDTH = int(os.getenv("KEYFRAME_WIDTH", 384))
+# Frames per second decoded from each clip; scene cuts are found at this resolution in time
+KEYFRAME_SAMPLE_FPS = float(os.getenv("KEYFRAME_SAMPLE_FPS", 2))
+# Side of the pixel blocks averaged into the thumbnails that are compared for cuts
+KEYFRAME_BLOCK = int(os.getenv("KEYFRAME_BLOCK", 8))
+# Minimum mean luma change (0-255) between samples that counts as a cut
+KEYFRAME_CUT_THRESHOLD = float(os.getenv("KEYFRAME_CUT_THRESHOLD", 12))
+KEYFRAME_MIN_GAP_SECONDS = float(os.getenv("KEYFRAME_MIN_GAP_SECONDS", 1))
+# Static shots still get a keyframe this often
+KEYFRAME_MAX_GAP_SECONDS = float(os.getenv("KEYFRAME_MAX_GAP_SECONDS", 4))
+KEYFRAME_MAX_PER_CLIP = int(os.getenv("KEYFRAME_MAX_PER_CLIP", 12))
+KEYFRAME_JPEG_QUALITY = int(os.getenv("KEYFRAME_JPEG_QUALITY", 70))
+KEYFRAME_WORKERS = int(os.getenv("KEYFRAME_WORKERS", 4))
+# Send the clips' own sound along with the keyframes
+KEYFRAME_SOUNDTRACK = os.getenv("KEYFRAME_SOUNDTRACK", "1") == "1"
+SOUNDTRACK_BITRATE = os.getenv("SOUNDTRACK_BITRATE", "32k")
+SOUNDTRACK_SAMPLE_RATE = 16000
+
+# Luma weights of ITU-R BT.601
+LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+keyframes_selected = metrics.Histogram(
+    "keyframes_per_clip",
+    "Keyframes selected from one clip",
+    buckets=(1, 2, 4, 6, 8, 12, 16, 24),
+)
+
+
+# Function to decode a clip once into downscaled RGB frames
+def decode_frames(probe, width=KEYFRAME_WIDTH, fps=KEYFRAME_SAMPLE_FPS):
+    """Decodes a clip at `fps` frames per second, scaled to `width` pixels wide.
+
+    Returns:
+        A tuple of a uint8 array of shape (frames, height, width, 3) and the
+        timestamp of each frame in seconds from the start of the clip.
+    """
+    # ffmpeg applies the rotation tag while decoding, so size the output for the displayed frame
+    source_width, source_height = probe['width'], probe['height']
+    if probe['rotation'] in (90, 270):
+        source_width, source_height = source_height, source_width
+    height = max(2, int(round(width * source_height / source_width / 2)) * 2)
+
+    out, _ = (
+        ffmpeg
+        .input(probe['path'])
+        .video
+        .filter('fps', fps=fps)
+        .filter('scale', width, height)
+        .output('pipe:', format='rawvideo', pix_fmt='rgb24')
+        .run(capture_stdout=True, quiet=True)
+    )
+    frames = np.frombuffer(out, np.uint8).reshape(-1, height, width, 3)
+    return frames, np.arange(len(frames)) / fps
+
+
+# Function to reduce frames to small luma thumbnails for comparison
+def luma_thumbnails(frames, block=KEYFRAME_BLOCK):
+    count, height, width, _ = frames.shape
+    rows, cols = height // block, width // block
+    blocks = frames[:, :rows * block, :cols * block].reshape(count, rows, block, cols, block, 3)
+    return blocks.mean(axis=(2, 4), dtype=np.float32) @ LUMA
+
+
+# Function to pick the frames that start a new shot
+def select_keyframes(thumbnails, fps=KEYFRAME_SAMPLE_FPS, threshold=KEYFRAME_CUT_THRESHOLD,
+                     min_gap=KEYFRAME_MIN_GAP_SECONDS, max_gap=KEYFRAME_MAX_GAP_SECONDS,
+                     max_keyframes=KEYFRAME_MAX_PER_CLIP):
+    """Returns the sorted indices of the frames to send for one clip.
+
+    A frame is a cut when its mean absolute luma difference to the previous
+    sample exceeds both `threshold` and the clip's own noise level (median
+    plus three median absolute deviations), so handheld shake is not mistaken
+    for cuts. The first frame is always kept, cuts closer than min_gap to a
+    stronger one are dropped, stretches longer than max_gap are filled with
+    evenly spaced frames, and only the strongest max_keyframes survive.
+    """
+    count = len(thumbnails)
+    if count == 0:
+        return []
+
+    scores = np.zeros(count, dtype=np.float32)
+    scores[1:] = np.abs(np.diff(thumbnails, axis=0)).mean(axis=(1, 2))
+    if count > 2:
+        median = np.median(scores[1:])
+        threshold = max(threshold, median + 3 * np.median(np.abs(scores[1:] - median)))
+
+    min_frames = max(1, int(round(min_gap * fps)))
+    candidates = np.flatnonzero(scores > threshold)
+    keep = [0]
+    for index in candidates[np.argsort(-scores[candidates], kind='stable')]:
+        if np.all(np.abs(np.array(keep) - index) >= min_frames):
+            keep.append(int(index))
+    keep.sort()
+
+    # Fill long stretches without cuts; their frames rank below every real cut
+    max_frames = max(1, int(round(max_gap * fps)))
+    bounds = keep + [count]
+    fill = [index for start, end in zip(bounds, bounds[1:]) for index in range(start + max_frames, end, max_frames)]
+    ranked = [0] + sorted(keep[1:], key=lambda index: -scores[index]) + fill
+    return sorted(ranked[:max_keyframes])
+
+
+# Function to encode one frame as JPEG
+def encode_jpeg(frame, quality=KEYFRAME_JPEG_QUALITY):
+    buffer = io.BytesIO()
+    Image.fromarray(frame).save(buffer, format='JPEG', quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+# Function to find and encode the keyframes of one clip
+def clip_keyframes(probe):
+    """Returns a list of (seconds into the clip, JPEG bytes) and the number of frames decoded."""
+    frames, timestamps = decode_frames(probe)
+    indices = select_keyframes(luma_thumbnails(frames))
+    keyframes_selected.observe(len(indices))
+    return [(float(timestamps[index]), encode_jpeg(frames[index])) for index in indices], len(frames)
+
+
+# Function to extract the keyframes of every clip
+def extract_keyframes(video_paths, max_workers=KEYFRAME_WORKERS):
+    """Decodes every clip once and selects its keyframes, without concatenating anything.
+
+    Returns:
+        A tuple containing:
+            - A dictionary with video names as keys and lists of (seconds, JPEG bytes).
+            - The clip timestamp map, as Video.concatenate_videos would return it.
+            - The total duration in seconds.
+            - The clip probes, in the same order as video_paths.
+            - A dictionary with 'frames_decoded', 'keyframes', 'jpeg_bytes' and 'extract_seconds'.
+    """
+    start = time.monotonic()
+    probes = Video.probe_videos(video_paths)
+
+    durations, total_duration = {}, 0
+    for path, probe in zip(video_paths, probes):
+        durations[path] = [total_duration, total_duration + probe['duration']]
+        total_duration += probe['duration']
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(probes)))) as executor:
+        results = list(executor.map(clip_keyframes, probes))
+    keyframes = {path: frames for path, (frames, _) in zip(video_paths, results)}
+
+    stats = {
+        'frames_decoded': sum(decoded for _, decoded in results),
+        'keyframes': sum(len(frames) for frames in keyframes.values()),
+        'jpeg_bytes': sum(len(jpeg) for frames in keyframes.values() for _, jpeg in frames),
+        'extract_seconds': time.monotonic() - start,
+    }
+    print(f"Selected {stats['keyframes']} keyframes ({stats['jpeg_bytes']} bytes) from "
+          f"{stats['frames_decoded']} decoded frames in {stats['extract_seconds']:.2f}s")
+    return keyframes, durations, total_duration, probes, stats
+
+
+# Function to build the prompt parts that show the keyframes to Gemini
+def keyframe_parts(keyframes, video_durations):
+    """Returns inline JPEG parts, each preceded by a text part naming its clip and timestamps."""
+    parts = []
+    for video_name, frames in keyframes.items():
+        clip_start = video_durations[video_name][0]
+        for seconds, jpeg in frames:
+            parts.append(f"Keyframe of {video_name} at {seconds:.2f}s into the clip "
+                         f"({clip_start + seconds:.2f}s on the timeline):")
+            parts.append({'mime_type': 'image/jpeg', 'data': jpeg})
+    return parts
+
+
+# Function to join the clips' own sound into one small audio file
+def extract_soundtrack(probes, output_path, bitrate=SOUNDTRACK_BITRATE):
+    """Concatenates the audio of every clip into mono AAC (ADTS), with silence for clips without sound.
+
+    Each clip's audio is padded or trimmed to its duration, so the soundtrack
+    follows the same timeline as the clip timestamp map.
+
+    Returns:
+        output_path, or None when no clip has sound.
+    """
+    if not any(probe['has_audio'] for probe in probes):
+        return None
+
+    streams = []
+    for probe in probes:
+        if probe['has_audio']:
+            audio = ffmpeg.input(probe['path']).audio
+        else:
+            audio = ffmpeg.input(f"anullsrc=r={SOUNDTRACK_SAMPLE_RATE}:cl=mono", f='lavfi').audio
+        streams.append(
+            audio
+            .filter('aformat', sample_rates=SOUNDTRACK_SAMPLE_RATE, channel_layouts='mono')
+            .filter('apad', whole_dur=probe['duration'])
+            .filter('atrim', duration=probe['duration'])
+        )
+
+    (
+        ffmpeg
+        .concat(*streams, v=0, a=1)
+        .output(output_path, format='adts', acodec='aac', audio_bitrate=bitrate)
+        .overwrite_output()
+        .run(quiet=True)
+    )
+    return output_path
+
+
+# Function to build everything the keyframe input mode sends in place of the video
+def prepare_keyframe_input(video_paths, output_dir, soundtrack=KEYFRAME_SOUNDTRACK):
+    """Extracts the keyframes of every clip and, optionally, the clips' soundtrack.
+
+    Returns:
+        A tuple of the keyframe parts, the clip timestamp map, the soundtrack
+        path (None without one) and the stats of extract_keyframes plus
+        'soundtrack_bytes'.
+    """
+    keyframes, video_durations, total_duration, probes, stats = extract_keyframes(video_paths)
+    soundtrack_path = extract_soundtrack(probes, os.path.join(output_dir, "soundtrack.aac")) if soundtrack else None
+    stats['soundtrack_bytes'] = os.path.getsize(soundtrack_path) if soundtrack_path else 0
+    return keyframe_parts(keyframes, video_durations), video_durations, soundtrack_path, stats
@@ -0,0 +1,193 @@
+import os
+import time
+import asyncio
+import threading
+import contextvars
+import concurrent.futures
+from contextlib import contextmanager
+import metrics
+
+
+# Per-worker concurrency of the CPU-heavy stages (concatenation, proxy encoding, rendering)
+CPU_STAGE_CONCURRENCY = int(os.getenv("CPU_STAGE_CONCURRENCY", max(1, (os.cpu_count() or 2) // 2)))
+# Per-worker concurrency of the I/O-bound stages (downloads, uploads, polling, generation)
+IO_STAGE_CONCURRENCY = int(os.getenv("IO_STAGE_CONCURRENCY", 16))
+
+# Overall time a request may take; stages fail early once it has passed
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", 900))
+# Timeouts of individual stages
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", 300))
+CONCAT_TIMEOUT = float(os.getenv("CONCAT_TIMEOUT", 300))
+UPLOAD_TIMEOUT = float(os.getenv("UPLOAD_TIMEOUT", 300))
+GENERATE_TIMEOUT = float(os.getenv("GENERATE_TIMEOUT", 300))
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", 600))
+
+CPU = "cpu"
+IO = "io"
+# How often a coroutine checks for a free slot; slots are shared with the threaded pipeline
+SLOT_POLL_SECONDS = 0.05
+
+# Time spent waiting for a free slot before a stage could start
+stage_queue_seconds = metrics.Histogram(
+    "pipeline_stage_queue_seconds",
+    "Seconds a stage waited for a free concurrency slot",
+    labelnames=("kind",),
+)
+stage_timeouts = metrics.Counter(
+    "pipeline_stage_timeouts_total",
+    "Stages that failed because a stage or request timeout passed",
+    labelnames=("stage",),
+)
+
+_slots = {
+    CPU: threading.BoundedSemaphore(CPU_STAGE_CONCURRENCY),
+    IO: threading.BoundedSemaphore(IO_STAGE_CONCURRENCY),
+}
+# Stages hold their slot until they really finish, so this many threads are enough
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=CPU_STAGE_CONCURRENCY + IO_STAGE_CONCURRENCY,
+                                                  thread_name_prefix="stage")
+_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+class StageTimeout(TimeoutError):
+    """Raised when a stage or the whole request runs out of time."""
+
+
+# Function to start the time budget of the current request or job
+def start_request(timeout=REQUEST_TIMEOUT):
+    _deadline.set(time.monotonic() + timeout)
+
+
+# Function to get the seconds left before the current request's deadline
+def remaining(default=None):
+    deadline = _deadline.get()
+    if deadline is None:
+        return default
+    return deadline - time.monotonic()
+
+
+# Function to run one pipeline stage within the worker's concurrency and time limits
+def run_stage(name, kind, fn, *args, timeout=None, **kwargs):
+    """Runs fn in a slot of the given kind and returns its result.
+
+    Waiting for a slot counts against the request deadline. The stage itself
+    is given the smaller of its own timeout and what is left of the request.
+    A stage that times out keeps its slot until it actually finishes, so the
+    limits always reflect the work in progress; its result is discarded.
+
+    Raises:
+        StageTimeout: If no slot frees up or the stage does not finish in time.
+    """
+    left = remaining()
+    if left is not None and left <= 0:
+        stage_timeouts.inc(stage=name)
+        raise StageTimeout(f"Request deadline passed before stage '{name}'")
+
+    slot = _slots[kind]
+    waited_from = time.monotonic()
+    if not slot.acquire(timeout=left):
+        stage_timeouts.inc(stage=name)
+        raise StageTimeout(f"No free {kind} slot for stage '{name}' before the request deadline")
+    stage_queue_seconds.observe(time.monotonic() - waited_from, kind=kind)
+
+    # Run in a copy of the caller's context so the request id and deadline follow the stage
+    context = contextvars.copy_context()
+    try:
+        future = _executor.submit(context.run, fn, *args, **kwargs)
+    except BaseException:
+        slot.release()
+        raise
+    future.add_done_callback(lambda _: slot.release())
+
+    budgets = [value for value in (timeout, remaining()) if value is not None]
+    limit = max(min(budgets), 0) if budgets else None
+    try:
+        return future.result(timeout=limit)
+    except concurrent.futures.TimeoutError:
+        if future.done():
+            # The stage raised a TimeoutError of its own
+            raise
+        stage_timeouts.inc(stage=name)
+        raise StageTimeout(f"Stage '{name}' did not finish within {limit:.1f}s")
+
+
+# Function to borrow free slots for a stage that fans its work out further
+@contextmanager
+def extra_slots(kind, wanted):
+    """Takes up to `wanted` more slots of the given kind without waiting and yields how many it got.
+
+    A stage holds one slot; work it spreads over more processes must hold a
+    slot for each of them, so concurrent stages cannot oversubscribe the machine.
+    """
+    slot = _slots[kind]
+    acquired = 0
+    while acquired < wanted and slot.acquire(blocking=False):
+        acquired += 1
+    try:
+        yield acquired
+    finally:
+        for _ in range(acquired):
+            slot.release()
+
+
+# Function to run one pipeline stage from a coroutine within the worker's concurrency and time limits
+async def run_stage_async(name, kind, fn, *args, timeout=None, **kwargs):
+    """Like run_stage, but waits for the slot and the result without blocking the event loop.
+
+    Slots are shared with run_stage, so threaded and asyncio pipelines in the
+    same worker are limited together.
+    """
+    left = remaining()
+    if left is not None and left <= 0:
+        stage_timeouts.inc(stage=name)
+        raise StageTimeout(f"Request deadline passed before stage '{name}'")
+
+    slot = _slots[kind]
+    waited_from = time.monotonic()
+    while not slot.acquire(blocking=False):
+        if left is not None and time.monotonic() - waited_from >= left:
+            stage_timeouts.inc(stage=name)
+            raise StageTimeout(f"No free {kind} slot for stage '{name}' before the request deadline")
+        await asyncio.sleep(SLOT_POLL_SECONDS)
+    stage_queue_seconds.observe(time.monotonic() - waited_from, kind=kind)
+
+    context = contextvars.copy_context()
+    try:
+        future = _executor.submit(context.run, fn, *args, **kwargs)
+    except BaseException:
+        slot.release()
+        raise
+    future.add_done_callback(lambda _: slot.release())
+
+    budgets = [value for value in (timeout, remaining()) if value is not None]
+    limit = max(min(budgets), 0) if budgets else None
+    try:
+        # Shielded, so a timeout stops the wait but the stage still finishes and frees its slot
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), limit)
+    except asyncio.TimeoutError:
+        if future.done():
+            raise
+        stage_timeouts.inc(stage=name)
+        raise StageTimeout(f"Stage '{name}' did not finish within {limit:.1f}s")
+
+
+# Function to await an I/O stage under its timeout and the request deadline
+async def wait_async(name, awaitable, timeout=None):
+    """Awaits a native coroutine, cancelling it when its time is up.
+
+    I/O stages of the asyncio pipeline hold no thread while they wait, so they
+    are not counted against IO_STAGE_CONCURRENCY.
+
+    Raises:
+        StageTimeout: If the stage does not finish in time.
+    """
+    budgets = [value for value in (timeout, remaining()) if value is not None]
+    limit = max(min(budgets), 0) if budgets else None
+    task = asyncio.ensure_future(awaitable)
+    try:
+        return await asyncio.wait_for(task, limit)
+    except asyncio.TimeoutError:
+        if task.done() and not task.cancelled():
+            raise
+        stage_timeouts.inc(stage=name)
+        raise StageTimeout(f"Stage '{name}' did not finish within {limit:.1f}s")
@@ -1,201 +1,874 @@
-from flask import Flask, request, jsonify
-import firebase_admin
-from firebase_admin import credentials, storage, auth, firestore
-from google.cloud import aiplatform
+from flask import Flask, Response, request, jsonify
 import os
+import hmac
+import math
+import time
 import tempfile
-import requests  
-import google.generativeai as genai
-from google.generativeai.protos import HarmCategory, SafetySetting
-import concurrent.futures
-from time import sleep
+import threading
 from dotenv import load_dotenv
-from moviepy.editor import VideoFileClip, concatenate_videoclips
+
+# Load .env before the modules below read their settings from the environment
+load_dotenv()
+
 import uuid
-import textwrap
-import json
-import ffmpeg
+import asyncio
 import traceback
 from firebase import Firebase
 from gemini import Gemini
+from video import Video
+from render import Renderer, RENDER_MODE
+from upload_cache import UploadCache
+from clip_store import ClipStore, blob_version_key
+from context_cache import ContextCache
+from result_cache import create_result_cache, result_key, rebase_video_names, RESULT_CACHE_BACKEND
+from keyframes import prepare_keyframe_input
+from audio_analysis import (analyze_audio, timing_summary, snap_audio_edits, AUDIO_ANALYSIS, AUDIO_UPLOAD,
+                            SNAP_AUDIO_EDITS)
+from preprocess import (Preprocessor, parse_storage_event, media_fingerprint, prepared_record, ready_media,
+                        PREPROCESS, STORAGE_EVENT_TOKEN, PREPARED_MEDIA_LOOKUP)
+from response_decoder import ResponseDecodeError
+from quota import create_scheduler, ScheduledGenai, QuotaExhausted, GEMINI_SCHEDULER
+import metrics
+import limits
+import async_runtime
+import map_reduce
+from jobs import (JobManager, AsyncJobManager, JobRejected, new_job_token, job_token_matches, FAILED, SUCCEEDED,
+                  JOB_RESULT_TTL)
 
 # Initialize Flask app
 app = Flask(__name__)
 
-load_dotenv()
-
-# Initialize Firebase
-cred = credentials.Certificate(os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"))
-firebase_admin.initialize_app(cred, {
-    'storageBucket': 'craiteapp.appspot.com'
-})
-
-# Initialize Gemini API client
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-
 # Create the model
 generation_config = {
   "temperature": 0.7,
   "top_p": 0.95,
   "top_k": 64,
   "max_output_tokens": 200000,
+  # Ask for raw JSON; the edit schema is validated locally by response_decoder because
+  # "adjustment" mixes numbers, lists and colour strings, which the API schema subset cannot express
+  "response_mime_type": "application/json",
 }
 
 
-model = genai.GenerativeModel(
-  model_name="gemini-1.5-pro-exp-0801",
-  generation_config=generation_config
-)
+# Upload a downscaled proxy of the concatenated video instead of the full resolution file
+ANALYSIS_PROXY = os.getenv("ANALYSIS_PROXY", "1") == "1"
 
 
-# Route to handle requests from the Android app
-@app.route('/process_videos', methods=['POST'])
-def process_videos():
-    try:
-        # Get data from the request (assuming JSON format)
-        data = request.get_json()
-        user_id = data.get('user_id')
-        gemini_prompt = data.get('gemini_prompt')
-        project_id = data.get('project_id')
-        prompt_id = data.get('prompt_id')
+# Reuse concatenations of the same leading clips when clips are appended to a project
+INCREMENTAL_CONCAT = os.getenv("INCREMENTAL_CONCAT", "1") == "1"
+
+# Stream Gemini responses and store video edits on the prompt document as they arrive
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "1") == "1"
+
+# How clips are shown to Gemini: "video" uploads the concatenated video, "keyframes" sends
+# scene-change keyframes and the clips' soundtrack instead
+INPUT_MODE = os.getenv("INPUT_MODE", "video")
+
+# The audio file is only left out when its timing summary is sent instead
+UPLOAD_AUDIO_FILE = AUDIO_UPLOAD or not AUDIO_ANALYSIS
+
+# Run pipelines as coroutines on one event loop per worker instead of one thread each
+ASYNC_PIPELINE = os.getenv("ASYNC_PIPELINE", "0") == "1"
+
+# Cache of uploaded Gemini files keyed by content hash
+upload_cache = UploadCache()
+
+# Rate limits and 429 retries shared by every Gemini call (GEMINI_QUOTA_BACKEND is memory or file)
+gemini_scheduler = create_scheduler() if GEMINI_SCHEDULER else None
+
+# Project media kept on local disk across requests
+clip_store = ClipStore()
 
-        if not (project_id and user_id and gemini_prompt):
-            return jsonify({'error': 'Missing required parameters'}), 400
+MODEL_NAME = "gemini-1.5-pro-exp-0801"
 
-        # Verify user
+# Keep the instructions and each project's media in a Gemini context cache across re-prompts
+CONTEXT_CACHE = os.getenv("CONTEXT_CACHE", "1") == "1"
+
+# Initialize Firebase and Gemini in a background thread as soon as the app is created
+WARM_UP = os.getenv("WARM_UP", "1") == "1"
+
+# SDK modules and clients set by init_services; the SDKs are slow to import, so this
+# happens on first use or in the warm-up hook rather than when a worker boots
+genai = None
+auth = None
+firestore = None
+# firebase_admin.firestore_async, used by the asyncio pipeline
+async_firestore = None
+storage = None
+model = None
+context_cache = None
+# Memoized edit settings of identical requests (RESULT_CACHE_BACKEND is memory, disk, firestore or none)
+result_cache = None
+_services_lock = threading.Lock()
+
+
+# Function to initialize Firebase and Gemini and the clients built on them
+def init_services():
+    """Imports the Firebase Admin SDK and google.generativeai and creates the shared clients.
+
+    Safe to call from any thread and on every request; only the first call does any work.
+    """
+    global genai, auth, firestore, async_firestore, storage, model, context_cache, result_cache
+    if model is not None:
+        return
+
+    with _services_lock:
+        if model is not None:
+            return
+        start = time.monotonic()
+        import firebase_admin
+        from firebase_admin import credentials
+        from firebase_admin import auth as firebase_auth, firestore as firebase_firestore, storage as firebase_storage
+        import google.generativeai as google_genai
+
+        # Initialize Firebase
         try:
-            user = auth.get_user(user_id)
-        except auth.UserNotFoundError:
-            return jsonify({'error': 'Invalid user ID'}), 401
-          
-        # Download audio if any and prepare for the Gemini API
-        bucket = storage.bucket()
-        audio_directory = f"users/{user_id}/projects/{project_id}/audios"
-        audio_paths = Firebase.get_all_file_paths(audio_directory, bucket)
-        downloaded_audio_paths = dict()
-        
-
-        # Download videos and prepare data for Gemini API
-        video_directory = f"users/{user_id}/projects/{project_id}/videos"
-        video_paths = Firebase.get_all_file_paths(video_directory, bucket)
-        downloaded_video_paths = dict()
-        video_data = []
+            firebase_admin.get_app()
+        except ValueError:
+            cred = credentials.Certificate(os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"))
+            firebase_admin.initialize_app(cred, {
+                'storageBucket': 'craiteapp.appspot.com'
+            })
+
+        # Initialize Gemini API client
+        google_genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+
+        if gemini_scheduler is not None:
+            google_genai = ScheduledGenai(google_genai, gemini_scheduler)
+        genai, auth, firestore, storage = google_genai, firebase_auth, firebase_firestore, firebase_storage
+        if ASYNC_PIPELINE:
+            from firebase_admin import firestore_async
+            async_firestore = firestore_async
+        context_cache = ContextCache(genai, generation_config=generation_config) if CONTEXT_CACHE else None
+        result_cache = create_result_cache(firestore.client() if RESULT_CACHE_BACKEND == "firestore" else None)
+        # Set last: other threads treat a model as the sign that everything is ready
+        model = genai.GenerativeModel(
+          model_name=MODEL_NAME,
+          generation_config=generation_config
+        )
+        metrics.log_event("services_initialized", seconds=round(time.monotonic() - start, 3))
+
+
+# Function to open connections before the first request needs them
+def warm_up_services():
+    start = time.monotonic()
+    try:
+        init_services()
+        firestore.client()
+        storage.bucket()
+        # Establishes the channel to the Gemini API without using any quota
+        next(iter(genai.list_models(page_size=1)), None)
+        metrics.log_event("warm_up", seconds=round(time.monotonic() - start, 3))
+    except Exception as e:
+        print(f"Warm-up failed, services will be initialized on first use: {e}")
+
+
+# Function to build the app for a WSGI server, e.g. gunicorn "main:create_app()"
+def create_app(warm_up=WARM_UP):
+    """Returns the Flask app, warming up Firebase and Gemini in the background.
+
+    The worker starts serving right away; requests that need the clients before
+    the warm-up has finished wait for it in init_services.
+    """
+    if warm_up:
+        threading.Thread(target=warm_up_services, name="warm-up", daemon=True).start()
+    return app
+
+
+# Function to identify a request's media for the result cache without reading the files
+def media_identity(file_paths, media_blobs):
+    """Returns (file name, content hash) pairs from what storage already knows about each blob:
+    its MD5 hash, or its name and generation when it has none (e.g. composite objects)."""
+    return [(os.path.basename(path), getattr(blob, 'md5_hash', None) or blob_version_key(blob))
+            for path, blob in zip(file_paths, media_blobs)]
+
+
+# Function to validate a processing request and verify its user
+def read_process_request(data):
+    """Returns the pipeline arguments of a request, or an error response and status code."""
+    init_services()
+    user_id = data.get('user_id')
+    gemini_prompt = data.get('gemini_prompt')
+    project_id = data.get('project_id')
+    prompt_id = data.get('prompt_id')
+    render = bool(data.get('render', False))
+
+    if not (project_id and user_id and gemini_prompt):
+        return None, (jsonify({'error': 'Missing required parameters'}), 400)
+
+    # Verify user
+    try:
+        user = auth.get_user(user_id)
+    except auth.UserNotFoundError:
+        return None, (jsonify({'error': 'Invalid user ID'}), 401)
+
+    return (user_id, project_id, prompt_id, gemini_prompt, render), None
+
+
+# Function to turn a project's downloaded media into Gemini files ready to be prompted
+def prepare_media(downloaded_video_paths, audio_file_path, temp_dir):
+    """Concatenates the clips, encodes the analysis proxy, uploads the video and
+    audio to Gemini and waits until both are ACTIVE.
+
+    Returns:
+        A tuple of the Gemini video file, the clip timestamp map and the Gemini
+        audio file (None without audio).
+    """
+    # Concatenate video
+    with metrics.timed("concatenate", clips=len(downloaded_video_paths)) as stage:
+        concatenated_video_path, video_durations, total_duration = limits.run_stage(
+            "concatenate", limits.CPU, concatenate_videos, downloaded_video_paths, temp_dir,
+            timeout=limits.CONCAT_TIMEOUT)
+        stage['duration'] = total_duration
+
+    # Encode a small analysis copy so the upload and Gemini processing are faster
+    upload_video_path = concatenated_video_path
+    if ANALYSIS_PROXY:
+        with metrics.timed("proxy") as stage:
+            upload_video_path, proxy_stats = limits.run_stage(
+                "proxy", limits.CPU, Video.create_analysis_proxy, concatenated_video_path, temp_dir,
+                timeout=limits.CONCAT_TIMEOUT)
+            stage.update(proxy_stats)
+
+    # upload concatenated video and audio to Gemini, reusing earlier uploads of identical content
+    gemini_video, gemini_audio = upload_files([(upload_video_path, None), (audio_file_path, None)])
+    return gemini_video, video_durations, gemini_audio
+
+
+# Function to show a project's clips to Gemini as keyframes instead of a video
+def prepare_keyframes(downloaded_video_paths, audio_file_path, temp_dir):
+    """Extracts keyframes and the clips' soundtrack and uploads the soundtrack and audio.
+
+    Returns:
+        A tuple of the keyframe parts, the Gemini soundtrack file (None without
+        one), the clip timestamp map and the Gemini audio file.
+    """
+    with metrics.timed("keyframes", clips=len(downloaded_video_paths)) as stage:
+        keyframes, video_durations, soundtrack_path, keyframe_stats = limits.run_stage(
+            "keyframes", limits.CPU, prepare_keyframe_input, list(downloaded_video_paths), temp_dir,
+            timeout=limits.CONCAT_TIMEOUT)
+        stage.update(keyframe_stats)
+    gemini_soundtrack, gemini_audio = upload_files([(soundtrack_path, "audio/aac"), (audio_file_path, None)])
+    return keyframes, gemini_soundtrack, video_durations, gemini_audio
+
+
+# Function to upload files to Gemini, reusing earlier uploads of identical content, and wait until they are ACTIVE
+def upload_files(files):
+    """Uploads (path, mime type) pairs in order; a missing path gives None.
+
+    Returns:
+        The ACTIVE Gemini files, in the same order as files.
+    """
+    uploaded = []
+    with metrics.timed("upload") as stage:
+        uploaded_bytes = 0
+        for path, mime_type in files:
+            if not path:
+                uploaded.append((None, True))
+                continue
+            file, cached = limits.run_stage("upload", limits.IO, Gemini.upload_to_gemini_cached, path, genai,
+                                            upload_cache, mime_type, timeout=limits.UPLOAD_TIMEOUT)
+            uploaded_bytes += 0 if cached else os.path.getsize(path)
+            uploaded.append((file, cached))
+        stage['bytes'] = uploaded_bytes
+    metrics.bytes_transferred.inc(uploaded_bytes, direction="upload")
+
+    # Wait for whichever uploads are still processing
+    with metrics.timed("file_wait"):
+        ready = limits.run_stage("file_wait", limits.IO, Gemini.wait_for_files_active,
+                                 [file if not cached else None for file, cached in uploaded], genai)
+    return [ready_file or file for ready_file, (file, _) in zip(ready, uploaded)]
+
+
+# Function to split a long project into chunks of clips for map_reduce, or keep it whole
+def plan_project(downloaded_video_paths):
+    """Returns the chunks from map_reduce.plan_chunks and the clip durations they were planned from."""
+    if not map_reduce.MAP_REDUCE:
+        return [list(downloaded_video_paths)], {}
+    probes = Video.probe_videos(list(downloaded_video_paths))
+    clip_seconds = {path: probe['duration'] for path, probe in zip(downloaded_video_paths, probes)}
+    return map_reduce.plan_chunks(clip_seconds), clip_seconds
+
+
+# Function to prepare one chunk of clips for the map step of map_reduce
+def prepare_chunk(chunk, temp_dir):
+    """Returns the chunk_media tuple of map_reduce.map_chunk; the audio is not needed to find moments."""
+    chunk_dir = tempfile.mkdtemp(dir=temp_dir)
+    clips = {path: path for path in chunk}
+    if INPUT_MODE == "keyframes":
+        keyframes, gemini_soundtrack, video_durations, _ = prepare_keyframes(clips, False, chunk_dir)
+        return keyframes, gemini_soundtrack, video_durations
+    gemini_video, video_durations, _ = prepare_media(clips, False, chunk_dir)
+    return None, gemini_video, video_durations
+
+
+# Function to prepare one chunk of clips from a coroutine
+async def prepare_chunk_async(chunk, temp_dir):
+    chunk_dir = tempfile.mkdtemp(dir=temp_dir)
+    clips = {path: path for path in chunk}
+    if INPUT_MODE == "keyframes":
+        keyframes, gemini_soundtrack, video_durations, _ = await prepare_keyframes_async(clips, False, chunk_dir)
+        return keyframes, gemini_soundtrack, video_durations
+    gemini_video, video_durations, _ = await prepare_media_async(clips, False, chunk_dir)
+    return None, gemini_video, video_durations
+
+
+# Function to run the whole processing pipeline for a project
+def run_pipeline(user_id, project_id, prompt_id, gemini_prompt, render=False):
+    """Downloads, concatenates and uploads a project's media, prompts Gemini and
+    stores the response. With render set, the edit list is also rendered on the
+    server and the result uploaded next to the project's media.
+
+    Returns:
+        A dictionary with 'gemini_response' and, when rendering, 'rendered_video'.
+
+    Raises:
+        PermissionError: If one of the project's videos does not belong to the user.
+        limits.StageTimeout: If a stage or the whole request runs out of time.
+    """
+    limits.start_request()
+    # Download audio if any and prepare for the Gemini API
+    bucket = storage.bucket()
+    audio_directory = f"users/{user_id}/projects/{project_id}/audios"
+    video_directory = f"users/{user_id}/projects/{project_id}/videos"
+    with metrics.timed("list_blobs") as stage:
+        audio_blobs = Firebase.get_all_blobs(audio_directory, bucket)
+        video_blobs = Firebase.get_all_blobs(video_directory, bucket)
+        audio_paths = [blob.name for blob in audio_blobs]
+        video_paths = [blob.name for blob in video_blobs]
+        stage['clips'] = len(video_paths)
+        stage['audios'] = len(audio_paths)
+    downloaded_video_paths = dict()
+    # Check that every video belongs to the user before downloading anything
+    for video_path in video_paths:
+        if not video_belongs_to_user(video_path, user_id):
+            raise PermissionError('Unauthorized access to video')
+
+    # The downloaded clips stay pinned in the local store until the pipeline is done with them
+    with tempfile.TemporaryDirectory() as temp_dir, clip_store.leased() as lease:
+        # Download the videos and the last audio file, reusing clips already in the local store
+        media_blobs = video_blobs + audio_blobs[-1:]
+        with metrics.timed("download", files=len(media_blobs)) as stage:
+            file_paths, download_stats = limits.run_stage("download", limits.IO, clip_store.sync, media_blobs, bucket,
+                                                          lease=lease, timeout=limits.DOWNLOAD_TIMEOUT)
+            stage.update(bytes=download_stats['bytes'], cached=download_stats['hits'],
+                         bytes_saved=download_stats['bytes_saved'])
+        metrics.bytes_transferred.inc(download_stats['bytes'], direction="download")
+        metrics.clips_processed.inc(len(video_paths))
+
+        # adds key-value pairs of file_name: file_path to a downloaded_video_paths dictionary
+        for file_path in file_paths[:len(video_paths)]:
+            downloaded_video_paths[file_path] = file_path
+
+        audio_file_path = file_paths[-1] if audio_paths else False
+
+        # Push video edits to the prompt document as they stream in so the app can start rendering early
+        db = firestore.client()
+        on_video_edit = None
+        if STREAM_RESPONSES and prompt_id:
+            def on_video_edit(edit, video_edits):
+                Firebase.store_partial_video_edits(user_id, project_id, prompt_id, video_edits, db)
+
+        # Prompt Gemini once with the media of the whole project
+        def analyze_whole(audio_timing):
+            upload_audio_path = audio_file_path if UPLOAD_AUDIO_FILE else False
+            keyframes = None
+            if INPUT_MODE == "keyframes":
+                keyframes, gemini_video, video_durations, gemini_audio = prepare_keyframes(
+                    downloaded_video_paths, upload_audio_path, temp_dir)
+            else:
+                # Media prepared when the clips were uploaded leaves only the model call on the critical path
+                prepared = None
+                if PREPARED_MEDIA_LOOKUP:
+                    record = Firebase.get_prepared_media(user_id, project_id, db)
+                    prepared = ready_media(record, media_fingerprint(media_blobs, media_variant()),
+                                           list(downloaded_video_paths), genai)
+                if prepared is None:
+                    prepared = prepare_media(downloaded_video_paths, upload_audio_path, temp_dir)
+                gemini_video, video_durations, gemini_audio = prepared
+            print(f"final vid = {gemini_video}")
+
+            # Prompt the Gemini API with all videos and the prompt
+            audio_summary = timing_summary(audio_timing, attached=gemini_audio is not None) if audio_timing else None
+            return limits.run_stage("generate", limits.IO, Gemini.prompt_gemini_api,
+                                    gemini_video, gemini_prompt, video_durations, gemini_audio, model,
+                                    on_video_edit=on_video_edit, context_cache=context_cache,
+                                    project_id=project_id, keyframes=keyframes,
+                                    audio_summary=audio_summary, user_id=user_id, timeout=limits.GENERATE_TIMEOUT)
+
+        # Prepare the media and prompt Gemini; skipped when the response is memoized
+        def analyze():
+            # Measure the audio's beats, onsets and loudness locally for the prompt and for snapping
+            audio_timing = None
+            if audio_file_path and AUDIO_ANALYSIS:
+                with metrics.timed("audio_analysis"):
+                    audio_timing = limits.run_stage("audio_analysis", limits.CPU, analyze_audio, audio_file_path,
+                                                    timeout=limits.CONCAT_TIMEOUT)
+
+            # Long projects are analyzed in chunks of clips by parallel calls instead of in one long call
+            chunks, clip_seconds = plan_project(downloaded_video_paths)
+            if len(chunks) > 1:
+                print(f"Analyzing {len(clip_seconds)} clips in {len(chunks)} chunks")
+                audio_summary = timing_summary(audio_timing, attached=False) if audio_timing else None
+                try:
+                    gemini_response = map_reduce.run(chunks, clip_seconds,
+                                                     lambda chunk: prepare_chunk(chunk, temp_dir), gemini_prompt,
+                                                     model, bool(audio_file_path), audio_summary)
+                except ResponseDecodeError as e:
+                    # Same outcome as an undecodable single-call response
+                    print(f"Gemini returned no usable edit settings: {e}")
+                    gemini_response = None
+            else:
+                gemini_response = analyze_whole(audio_timing)
+
+            if gemini_response and audio_timing and SNAP_AUDIO_EDITS:
+                gemini_response['audio_edits'] = snap_audio_edits(gemini_response['audio_edits'], audio_timing)
+            print(gemini_response)
+            return gemini_response
+
+        # Reuse the edit settings of an identical earlier request (same clips, audio, prompt and model)
+        if result_cache is not None:
+            with metrics.timed("result_key"):
+                cache_key = result_key(media_identity(file_paths, media_blobs), gemini_prompt, model.model_name,
+                                       generation_config, INPUT_MODE, audio_mode(), analysis_mode())
+            gemini_response, source = result_cache.get_or_compute(cache_key, analyze)
+            if gemini_response is not None and source != "miss":
+                print(f"Using memoized Gemini response ({source})")
+                gemini_response = rebase_video_names(gemini_response, list(downloaded_video_paths))
+        else:
+            gemini_response = analyze()
+
+        result = {'gemini_response': gemini_response}
+
+        # Store Gemini response in Firestore
+        if prompt_id:
+            with metrics.timed("firestore_write"):
+                Firebase.store_gemini_response(user_id, project_id, prompt_id, gemini_response, db)
+
+        # Optionally apply the edit list on the server and upload the rendered video
+        if render and gemini_response:
+            with metrics.timed("render", edits=len(gemini_response['video_edits'])) as stage:
+                rendered_path = os.path.join(temp_dir, f"render_{prompt_id or uuid.uuid4()}.mp4")
+                render_function = Renderer.render_segments if RENDER_MODE == "segments" else Renderer.render
+                limits.run_stage("render", limits.CPU, render_function, gemini_response['video_edits'],
+                                 gemini_response['audio_edits'], rendered_path, audio_path=audio_file_path or None,
+                                 video_paths=list(downloaded_video_paths), timeout=limits.RENDER_TIMEOUT)
+                stage['bytes'] = os.path.getsize(rendered_path)
+            rendered_blob_path = f"users/{user_id}/projects/{project_id}/renders/{os.path.basename(rendered_path)}"
+            Firebase.upload_media(rendered_path, rendered_blob_path, bucket)
+            result['rendered_video'] = rendered_blob_path
+            if prompt_id:
+                Firebase.store_rendered_video(user_id, project_id, prompt_id, rendered_blob_path, db)
+
+    return result
+
+
+# Function to prepare a project's media from a coroutine
+async def prepare_media_async(downloaded_video_paths, audio_file_path, temp_dir):
+    """The asyncio counterpart of prepare_media, uploading the video and audio at the same time."""
+    with metrics.timed("concatenate", clips=len(downloaded_video_paths)) as stage:
+        concatenated_video_path, video_durations, total_duration = await limits.run_stage_async(
+            "concatenate", limits.CPU, concatenate_videos, downloaded_video_paths, temp_dir,
+            timeout=limits.CONCAT_TIMEOUT)
+        stage['duration'] = total_duration
+
+    upload_video_path = concatenated_video_path
+    if ANALYSIS_PROXY:
+        with metrics.timed("proxy") as stage:
+            upload_video_path, proxy_stats = await limits.run_stage_async(
+                "proxy", limits.CPU, Video.create_analysis_proxy, concatenated_video_path, temp_dir,
+                timeout=limits.CONCAT_TIMEOUT)
+            stage.update(proxy_stats)
+
+    gemini_video, gemini_audio = await upload_files_async([(upload_video_path, None), (audio_file_path, None)])
+    return gemini_video, video_durations, gemini_audio
+
+
+# Function to prepare a project's keyframe input from a coroutine
+async def prepare_keyframes_async(downloaded_video_paths, audio_file_path, temp_dir):
+    with metrics.timed("keyframes", clips=len(downloaded_video_paths)) as stage:
+        keyframes, video_durations, soundtrack_path, keyframe_stats = await limits.run_stage_async(
+            "keyframes", limits.CPU, prepare_keyframe_input, list(downloaded_video_paths), temp_dir,
+            timeout=limits.CONCAT_TIMEOUT)
+        stage.update(keyframe_stats)
+    gemini_soundtrack, gemini_audio = await upload_files_async([(soundtrack_path, "audio/aac"),
+                                                                (audio_file_path, None)])
+    return keyframes, gemini_soundtrack, video_durations, gemini_audio
+
+
+# Function to upload files to Gemini from a coroutine
+async def upload_files_async(files):
+    """The asyncio counterpart of upload_files, uploading all files at the same time."""
+    async def upload(path, mime_type):
+        if not path:
+            return None, True
+        return await Gemini.upload_to_gemini_cached_async(path, genai, upload_cache, mime_type)
+
+    with metrics.timed("upload") as stage:
+        uploaded = await limits.wait_async("upload", asyncio.gather(*(upload(*file) for file in files)),
+                                           timeout=limits.UPLOAD_TIMEOUT)
+        uploaded_bytes = sum(os.path.getsize(path) for (path, _), (_, cached) in zip(files, uploaded) if not cached)
+        stage['bytes'] = uploaded_bytes
+    metrics.bytes_transferred.inc(uploaded_bytes, direction="upload")
+
+    with metrics.timed("file_wait"):
+        ready = await limits.wait_async("file_wait", Gemini.wait_for_files_active_async(
+            [file if not cached else None for file, cached in uploaded], genai))
+    return [ready_file or file for ready_file, (file, _) in zip(ready, uploaded)]
+
+
+# Function to run the processing pipeline as a coroutine on the worker's event loop
+async def run_pipeline_async(user_id, project_id, prompt_id, gemini_prompt, render=False):
+    """The asyncio counterpart of run_pipeline, with the same stages, arguments and result.
+
+    Waits on Gemini generation, Files API polling and Firestore hold no thread.
+    Storage and other SDK calls without an asyncio API run on the bounded
+    asyncio I/O executor, and ffmpeg work takes a CPU slot as in run_pipeline.
+    """
+    limits.start_request()
+    bucket = storage.bucket()
+    audio_directory = f"users/{user_id}/projects/{project_id}/audios"
+    video_directory = f"users/{user_id}/projects/{project_id}/videos"
+    with metrics.timed("list_blobs") as stage:
+        audio_blobs, video_blobs = await asyncio.gather(Firebase.get_all_blobs_async(audio_directory, bucket),
+                                                        Firebase.get_all_blobs_async(video_directory, bucket))
+        video_paths = [blob.name for blob in video_blobs]
+        stage['clips'] = len(video_paths)
+        stage['audios'] = len(audio_blobs)
+    # Check that every video belongs to the user before downloading anything
+    for video_path in video_paths:
+        if not video_belongs_to_user(video_path, user_id):
+            raise PermissionError('Unauthorized access to video')
+
+    async with clip_store.leased_async() as lease:
         with tempfile.TemporaryDirectory() as temp_dir:
-            for video_path in video_paths:
-                # Check if the video belongs to the user
-                if not video_belongs_to_user(video_path, user_id):
-                    return jsonify({'error': 'Unauthorized access to video'}), 403
-
-                # Download the video
-                file_name = video_path.split('/')[-1]
-                file_path = os.path.join(temp_dir, file_name)
-                Firebase.download_media(video_path, file_path, bucket)
-
-                # adds key-value pairs of file_name: file_path to a downloaded_video_paths dictionary
-                downloaded_video_paths[file_path] = file_path
-
-                # Uploads video to Gemini
-            file_name, audio_file_path = False, False
-            if len(audio_paths) > 0:
-              file_name = audio_paths[-1].split('/')[-1]
-              audio_file_path = os.path.join(temp_dir, file_name)
-              Firebase.download_media(audio_paths[-1], audio_file_path, bucket)
-
-            # Concatenate video
-            concatenated_video_path, video_durations, total_duration = concatenate_videos(downloaded_video_paths, temp_dir)
-            
-            # upload concatenated video and audio to Gemini
-            gemini_video = Gemini.upload_to_gemini(path=concatenated_video_path, genai=genai)
-            if audio_file_path:
-              gemini_audio = Gemini.upload_to_gemini(path=audio_file_path, genai=genai)
+            media_blobs = video_blobs + audio_blobs[-1:]
+            with metrics.timed("download", files=len(media_blobs)) as stage:
+                file_paths, download_stats = await limits.wait_async(
+                    "download", async_runtime.run_io(clip_store.sync, media_blobs, bucket, lease=lease),
+                    timeout=limits.DOWNLOAD_TIMEOUT)
+                stage.update(bytes=download_stats['bytes'], cached=download_stats['hits'],
+                             bytes_saved=download_stats['bytes_saved'])
+            metrics.bytes_transferred.inc(download_stats['bytes'], direction="download")
+            metrics.clips_processed.inc(len(video_paths))
+
+            downloaded_video_paths = {file_path: file_path for file_path in file_paths[:len(video_paths)]}
+            audio_file_path = file_paths[-1] if audio_blobs else False
+
+            db = async_firestore.client()
+            # Partial edits are written one at a time, always the newest list, so a slow write never reorders them
+            partial = {'edits': None, 'writer': None}
+            on_video_edit = None
+            if STREAM_RESPONSES and prompt_id:
+                async def write_partial_edits():
+                    while partial['edits'] is not None:
+                        video_edits, partial['edits'] = partial['edits'], None
+                        await Firebase.update_prompt_async(user_id, project_id, prompt_id,
+                                                           {"partialVideoEdits": video_edits}, db)
+
+                def on_video_edit(edit, video_edits):
+                    partial['edits'] = video_edits
+                    if partial['writer'] is None or partial['writer'].done():
+                        partial['writer'] = asyncio.ensure_future(write_partial_edits())
+
+            upload_audio_path = audio_file_path if UPLOAD_AUDIO_FILE else False
+
+            async def analyze_audio_track():
+                if not (audio_file_path and AUDIO_ANALYSIS):
+                    return None
+                with metrics.timed("audio_analysis"):
+                    return await limits.run_stage_async("audio_analysis", limits.CPU, analyze_audio, audio_file_path,
+                                                        timeout=limits.CONCAT_TIMEOUT)
+
+            async def prepare():
+                if INPUT_MODE == "keyframes":
+                    return await prepare_keyframes_async(downloaded_video_paths, upload_audio_path, temp_dir)
+                prepared = None
+                if PREPARED_MEDIA_LOOKUP:
+                    record = await Firebase.get_prepared_media_async(user_id, project_id, db)
+                    prepared = await async_runtime.run_io(ready_media, record,
+                                                          media_fingerprint(media_blobs, media_variant()),
+                                                          list(downloaded_video_paths), genai)
+                if prepared is None:
+                    prepared = await prepare_media_async(downloaded_video_paths, upload_audio_path, temp_dir)
+                return (None,) + tuple(prepared)
+
+            async def analyze_whole(audio_timing_task):
+                # The audio is analyzed while the media is being prepared
+                keyframes, gemini_video, video_durations, gemini_audio = await prepare()
+                audio_timing = await audio_timing_task
+                audio_summary = (timing_summary(audio_timing, attached=gemini_audio is not None)
+                                 if audio_timing else None)
+                return await limits.wait_async("generate", Gemini.prompt_gemini_api_async(
+                    gemini_video, gemini_prompt, video_durations, gemini_audio, model, on_video_edit=on_video_edit,
+                    context_cache=context_cache, project_id=project_id, keyframes=keyframes,
+                    audio_summary=audio_summary, user_id=user_id), timeout=limits.GENERATE_TIMEOUT)
+
+            async def analyze():
+                audio_timing_task = asyncio.ensure_future(analyze_audio_track())
+                try:
+                    chunks, clip_seconds = await async_runtime.run_io(plan_project, downloaded_video_paths)
+                    if len(chunks) > 1:
+                        print(f"Analyzing {len(clip_seconds)} clips in {len(chunks)} chunks")
+
+                        async def prepare_chunk_in_temp_dir(chunk):
+                            return await prepare_chunk_async(chunk, temp_dir)
+
+                        audio_timing = await audio_timing_task
+                        audio_summary = timing_summary(audio_timing, attached=False) if audio_timing else None
+                        try:
+                            gemini_response = await map_reduce.run_async(
+                                chunks, clip_seconds, prepare_chunk_in_temp_dir, gemini_prompt, model,
+                                bool(audio_file_path), audio_summary)
+                        except ResponseDecodeError as e:
+                            print(f"Gemini returned no usable edit settings: {e}")
+                            gemini_response = None
+                    else:
+                        gemini_response = await analyze_whole(audio_timing_task)
+                    audio_timing = await audio_timing_task
+                finally:
+                    audio_timing_task.cancel()
+
+                if gemini_response and audio_timing and SNAP_AUDIO_EDITS:
+                    gemini_response['audio_edits'] = snap_audio_edits(gemini_response['audio_edits'], audio_timing)
+                return gemini_response
+
+            if result_cache is not None:
+                with metrics.timed("result_key"):
+                    cache_key = result_key(media_identity(file_paths, media_blobs), gemini_prompt, model.model_name,
+                                           generation_config, INPUT_MODE, audio_mode(), analysis_mode())
+                gemini_response, source = await result_cache.get_or_compute_async(cache_key, analyze)
+                if gemini_response is not None and source != "miss":
+                    print(f"Using memoized Gemini response ({source})")
+                    gemini_response = rebase_video_names(gemini_response, list(downloaded_video_paths))
             else:
-              gemini_audio = None
-            
-            
-            video_data.append(gemini_video)
-            video_data.append(video_durations)
-            video_data.append(total_duration)
-            video_data.append(gemini_audio)
-
-        wait_for_file_active(video_data[0])
-        print(f"final vid = {video_data[0]}")
-        
-        if video_data[3]:
-          wait_for_file_active(video_data[3])
-          print(f"final vid = {video_data[3]}")
-        
-        
-
-        # Prompt the Gemini API with all videos and the prompt
-        try:
-          gemini_response = Gemini.prompt_gemini_api(video_data[0], gemini_prompt, video_data[1], video_data[3], model)
-          print(gemini_response)
+                gemini_response = await analyze()
+
+            result = {'gemini_response': gemini_response}
+
+            if partial['writer'] is not None:
+                await partial['writer']
+            if prompt_id:
+                with metrics.timed("firestore_write"):
+                    await Firebase.update_prompt_async(user_id, project_id, prompt_id,
+                                                       {"geminiResponse": gemini_response}, db)
+
+            if render and gemini_response:
+                with metrics.timed("render", edits=len(gemini_response['video_edits'])) as stage:
+                    rendered_path = os.path.join(temp_dir, f"render_{prompt_id or uuid.uuid4()}.mp4")
+                    render_function = Renderer.render_segments if RENDER_MODE == "segments" else Renderer.render
+                    await limits.run_stage_async("render", limits.CPU, render_function, gemini_response['video_edits'],
+                                                 gemini_response['audio_edits'], rendered_path,
+                                                 audio_path=audio_file_path or None,
+                                                 video_paths=list(downloaded_video_paths),
+                                                 timeout=limits.RENDER_TIMEOUT)
+                    stage['bytes'] = os.path.getsize(rendered_path)
+                rendered_blob_path = f"users/{user_id}/projects/{project_id}/renders/{os.path.basename(rendered_path)}"
+                await Firebase.upload_media_async(rendered_path, rendered_blob_path, bucket)
+                result['rendered_video'] = rendered_blob_path
+                if prompt_id:
+                    await Firebase.update_prompt_async(user_id, project_id, prompt_id,
+                                                       {"renderedVideo": rendered_blob_path}, db)
+
+    return result
+
+
+# Function to describe the settings that change the media uploaded to Gemini
+def media_variant():
+    return f"proxy={int(ANALYSIS_PROXY)},audio={int(UPLOAD_AUDIO_FILE)}"
+
+
+# Function to describe how the audio reaches Gemini and whether its edits are snapped, for memoization
+def audio_mode():
+    return f"upload={int(UPLOAD_AUDIO_FILE)},analysis={int(AUDIO_ANALYSIS)},snap={int(SNAP_AUDIO_EDITS)}"
+
+
+# Function to describe whether long projects are analyzed in chunks and how they are reduced, for memoization
+def analysis_mode():
+    if not map_reduce.MAP_REDUCE:
+        return "single"
+    return (f"map_reduce,min={map_reduce.MAP_REDUCE_MIN_SECONDS:g},chunk={map_reduce.MAP_CHUNK_SECONDS:g},"
+            f"moments={map_reduce.MAP_MAX_MOMENTS},reduce={map_reduce.REDUCE_MODE}")
+
+
+# Function to prepare a project's media ahead of its prompt and record the result
+def prepare_project(user_id, project_id):
+    """Downloads, concatenates and uploads the project's current media and stores
+    the Gemini files on the project document, where run_pipeline picks them up.
+
+    Runs in the background after storage finalize events (see Preprocessor).
+    """
+    init_services()
+    limits.start_request()
+    bucket = storage.bucket()
+    video_blobs = Firebase.get_all_blobs(f"users/{user_id}/projects/{project_id}/videos", bucket)
+    audio_blobs = Firebase.get_all_blobs(f"users/{user_id}/projects/{project_id}/audios", bucket)
+    if not video_blobs:
+        return None
+
+    media_blobs = video_blobs + audio_blobs[-1:]
+    with tempfile.TemporaryDirectory() as temp_dir, clip_store.leased() as lease:
+        file_paths, _ = limits.run_stage("download", limits.IO, clip_store.sync, media_blobs, bucket, lease=lease,
+                                         timeout=limits.DOWNLOAD_TIMEOUT)
+        downloaded_video_paths = {file_path: file_path for file_path in file_paths[:len(video_blobs)]}
+        audio_file_path = file_paths[-1] if audio_blobs and UPLOAD_AUDIO_FILE else False
+        gemini_video, video_durations, gemini_audio = prepare_media(downloaded_video_paths, audio_file_path,
+                                                                    temp_dir)
+    record = prepared_record(media_fingerprint(media_blobs, media_variant()), gemini_video, video_durations,
+                             gemini_audio)
+    Firebase.store_prepared_media(user_id, project_id, record, firestore.client())
+    return record
+
+
+# Background preparation of uploaded media, fed by /events/storage_finalize
+preprocessor = Preprocessor(prepare_project)
+
+
+# Function to store job status changes where every worker can read them, and on the prompt document
+def store_job_status(job):
+    init_services()
+    Firebase.store_job(job, firestore.client(), JOB_RESULT_TTL)
+    metadata = job['metadata']
+    if metadata.get('prompt_id'):
+        Firebase.store_job_status(metadata['user_id'], metadata['project_id'], metadata['prompt_id'],
+                                  job, firestore.client())
+
 
-            # Store Gemini response in Firestore
-          db = firestore.client()
-          if prompt_id:
-            Firebase.store_gemini_response(user_id, project_id, prompt_id, gemini_response, db)
+# Background workers for the asynchronous job API; with ASYNC_PIPELINE jobs run on the event loop
+job_manager = AsyncJobManager(on_status=store_job_status) if ASYNC_PIPELINE else JobManager(on_status=store_job_status)
 
 
-          # Return the response to the Android app
-          print(gemini_response)
-          return {'gemini_response': gemini_response}
-        except Exception as e:
-          print(f"Error calling Gemini API: {e}")
+# Tag every request with an id so its log lines can be correlated
+@app.before_request
+def assign_request_id():
+    metrics.new_request_id(request.headers.get('X-Request-ID'))
 
-        
 
+@app.after_request
+def return_request_id(response):
+    response.headers['X-Request-ID'] = metrics.request_id_var.get()
+    return response
+
+
+# Route to export pipeline metrics in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def export_metrics():
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+# Route to handle requests from the Android app
+@app.route('/process_videos', methods=['POST'])
+def process_videos():
+    try:
+        # Get data from the request (assuming JSON format)
+        pipeline_args, error = read_process_request(request.get_json())
+        if error:
+            return error
+
+        if ASYNC_PIPELINE:
+            result = async_runtime.run(run_pipeline_async(*pipeline_args))
+        else:
+            result = run_pipeline(*pipeline_args)
+        metrics.requests_total.inc(status="ok")
+
+        # Return the response to the Android app
+        return result
+
+    except PermissionError as e:
+        metrics.requests_total.inc(status="forbidden")
+        return jsonify({'error': str(e)}), 403
+    except QuotaExhausted as e:
+        metrics.requests_total.inc(status="throttled")
+        metrics.log_event("request_throttled", error=str(e))
+        headers = {'Retry-After': str(math.ceil(e.retry_after))} if e.retry_after else {}
+        return jsonify({'error': str(e)}), 429, headers
+    except limits.StageTimeout as e:
+        metrics.requests_total.inc(status="timeout")
+        metrics.log_event("request_timed_out", error=str(e))
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
+        metrics.requests_total.inc(status="error")
+        metrics.log_event("request_failed", error=str(e))
         print(f"Error processing videos: {e}")
         traceback.print_exc()  # Print the full traceback
         return jsonify({'error': str(e)}), 500
 
 
-def wait_for_files_active(files):
-  """Waits for the given files to be active.
+# Route for Cloud Storage object finalize events, e.g. delivered by Eventarc or a storage trigger
+@app.route('/events/storage_finalize', methods=['POST'])
+def storage_finalize():
+    # Without a configured token nobody may make the server download and transcode bucket objects
+    if not STORAGE_EVENT_TOKEN:
+        return jsonify({'error': 'Storage events are disabled: STORAGE_EVENT_TOKEN is not set'}), 403
+    if not hmac.compare_digest(request.headers.get('X-Event-Token', ''), STORAGE_EVENT_TOKEN):
+        return jsonify({'error': 'Invalid event token'}), 401
+    target = parse_storage_event(request.get_json(silent=True))
+    # Other objects are acknowledged so the event is not redelivered
+    if not PREPROCESS or INPUT_MODE != "video" or target is None:
+        return jsonify({'status': 'ignored'}), 200
+
+    scheduled = preprocessor.schedule(*target)
+    return jsonify({'status': 'scheduled' if scheduled else 'coalesced'}), 202
+
+
+# Route to queue a processing job and return its id right away
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    pipeline_args, error = read_process_request(request.get_json())
+    if error:
+        return error
+
+    user_id, project_id, prompt_id, gemini_prompt, render = pipeline_args
+    # Only the submitter gets the token, and only its hash is stored
+    job_token, token_hash = new_job_token()
+    metadata = {'user_id': user_id, 'project_id': project_id, 'prompt_id': prompt_id, 'token_hash': token_hash}
+    try:
+        pipeline = run_pipeline_async if ASYNC_PIPELINE else run_pipeline
+        job = job_manager.submit(pipeline, *pipeline_args, metadata=metadata)
+    except JobRejected as e:
+        return jsonify({'error': str(e)}), 429
 
-  Some files uploaded to the Gemini API need to be processed before they can be
-  used as prompt inputs. The status can be seen by querying the file's "state"
-  field.
+    return jsonify({'job_id': job['job_id'], 'job_token': job_token, 'status': job['status']}), 202
 
-  This implementation uses a simple blocking polling loop. Production code
-  should probably employ a more sophisticated approach.
-  """
-  print("Waiting for file processing...")
-  for name in (file.name for file in files):
-    file = genai.get_file(name)
-    while file.state.name == "PROCESSING":
-      print(".", end="", flush=True)
-      time.sleep(10)
-      file = genai.get_file(name)
-    if file.state.name != "ACTIVE":
-      raise Exception(f"File {file.name} failed to process")
-  print("...all files ready")
 
+# Function to look up a job on behalf of the client that submitted it
+def get_user_job(job_id):
+    """Returns the job, or None when it does not exist or the request's X-Job-Token is not its token.
 
-def wait_for_file_active(file, timeout=1000):
-  """Waits for the given file to become active in Gemini.
+    Jobs running in this worker are read from memory; the others from the
+    Firestore records every worker keeps up to date.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        init_services()
+        job = Firebase.get_job(job_id, firestore.client())
+    if not job_token_matches(job, request.headers.get('X-Job-Token')):
+        return None
+    return job
 
-  Uses asynchronous waiting to avoid blocking the main thread.
 
-  Args:
-      file: The Genai file object to wait for.
-      timeout: Maximum waiting time in seconds (default: 60).
+# Route to check the status of a processing job
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = get_user_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job ID'}), 404
 
-  Raises:
-      Exception: If the file fails to process within the timeout or encounters
-                  an unexpected error.
-  """
+    return jsonify({key: job[key] for key in ('job_id', 'status', 'created_at', 'started_at', 'finished_at', 'error')})
 
-  while file.state.name == "PROCESSING":
-    print('.', end='')
-    sleep(240)
-    file = genai.get_file(file.name)
 
-  if file.state.name == "FAILED":
-    raise ValueError(file.state.name)
+# Route to fetch the result of a finished processing job
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = get_user_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job ID'}), 404
+    if job['status'] == FAILED:
+        return jsonify({'error': job['error']}), 500
+    if job['status'] != SUCCEEDED:
+        return jsonify({'job_id': job_id, 'status': job['status']}), 202
 
-    print("...file ready")
+    return job['result']
 
 
 # Function to check if a video belongs to the user
@@ -208,9 +881,14 @@ def concatenate_videos(video_data, output_dir):
   """Concatenates multiple videos from a dictionary and returns the output path,
   durations, and total duration.
 
+  Durations are read from container metadata and the clips are joined with
+  stream copy whenever their formats allow it (see Video.concatenate_videos).
+  With INCREMENTAL_CONCAT, earlier concatenations of the same leading clips
+  are reused (see Video.concatenate_videos_incremental).
+
   Args:
       video_data: A dictionary with video names as keys and their paths as values.
-      output_path: The path to save the concatenated video.
+      output_dir: The directory to save the concatenated video in.
 
   Returns:
       A tuple containing:
@@ -218,32 +896,14 @@ def concatenate_videos(video_data, output_dir):
           - A dictionary with video names as keys and lists of [start_timestamp, end_timestamp] for durations.
           - The total duration of the concatenated video in seconds.
   """
-
-  clips = []
-  durations = {}
-  total_duration = 0
-
-  for video_name, video_path in video_data.items():
-    clip = VideoFileClip(video_path)
-    clips.append(clip)
-    duration = clip.duration
-    durations[video_name] = [total_duration, total_duration + duration]
-    total_duration += duration
-
-  basename, extension = os.path.splitext(os.path.basename(next(iter(video_data.values()))))
-  new_filename = f"{basename}_{uuid.uuid4()}{extension}"
-  output_clip_path = os.path.join(output_dir, new_filename)
-
-  final_clip = concatenate_videoclips(clips)
-  final_clip.write_videofile(output_clip_path)
-  print(f"Concatenated videos saved to: {output_clip_path}")
-  print(final_clip.size)
-
-  return output_clip_path, durations, total_duration
+  if INCREMENTAL_CONCAT:
+      return Video.concatenate_videos_incremental(video_data, output_dir)
+  return Video.concatenate_videos(video_data, output_dir)
     
 
+# Development server only; in production run: gunicorn -c gunicorn.conf.py wsgi:app
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0')
+    create_app().run(debug=os.getenv("FLASK_DEBUG") == "1", host='0.0.0.0')
 
 
     
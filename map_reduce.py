@@ -0,0 +1,314 @@
+import os
+import json
+import asyncio
+import contextvars
+import concurrent.futures
+import helpers
+import limits
+import async_runtime
+import metrics
+import prompts
+import response_decoder
+
+
+# Analyze long projects in chunks of clips with parallel Gemini calls, then assemble the edit
+MAP_REDUCE = os.getenv("MAP_REDUCE", "0") == "1"
+# Projects shorter than this (in seconds of footage) are analyzed in a single call
+MAP_REDUCE_MIN_SECONDS = float(os.getenv("MAP_REDUCE_MIN_SECONDS", 600))
+# Target length of a chunk; a longer clip gets a chunk of its own
+MAP_CHUNK_SECONDS = float(os.getenv("MAP_CHUNK_SECONDS", 180))
+# Chunks prepared and analyzed at the same time per request
+MAP_CONCURRENCY = int(os.getenv("MAP_CONCURRENCY", 4))
+MAP_MAX_MOMENTS = int(os.getenv("MAP_MAX_MOMENTS", 8))
+# "model" assembles the edit with a text-only Gemini call, "heuristic" picks the best moments locally
+REDUCE_MODE = os.getenv("REDUCE_MODE", "model")
+# Length limit of the final video, as stated in the prompt templates
+MAX_VIDEO_SECONDS = 60
+
+map_reduce_events = metrics.Counter(
+    "map_reduce_total",
+    "Steps of chunked analyses by outcome",
+    labelnames=("step", "result"),
+)
+
+
+# Function to group consecutive clips into chunks for the map step
+def plan_chunks(clip_seconds, chunk_seconds=MAP_CHUNK_SECONDS, min_seconds=MAP_REDUCE_MIN_SECONDS):
+    """Splits the project at clip boundaries into chunks of about chunk_seconds.
+
+    Args:
+        clip_seconds: Clip names mapped to their durations, in project order.
+        chunk_seconds: The most footage a chunk holds, unless one clip alone is longer.
+        min_seconds: Projects with less footage stay in one chunk.
+
+    Returns:
+        A list of chunks, each a list of clip names in project order.
+    """
+    if sum(clip_seconds.values()) < min_seconds:
+        return [list(clip_seconds)]
+
+    chunks, current, current_seconds = [], [], 0
+    for name, seconds in clip_seconds.items():
+        if current and current_seconds + seconds > chunk_seconds:
+            chunks.append(current)
+            current, current_seconds = [], 0
+        current.append(name)
+        current_seconds += seconds
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+# Function to build a clip timestamp map from clip durations, as Video.concatenate_videos would
+def timeline(clip_seconds):
+    video_durations, total = {}, 0
+    for name, seconds in clip_seconds.items():
+        video_durations[name] = [total, total + seconds]
+        total += seconds
+    return video_durations
+
+
+# Function to turn a map response into validated candidate moments
+def parse_moments(text, video_durations):
+    """Returns the usable moments of a map response; the rest are dropped.
+
+    Clip names are matched like response_decoder matches them, times are
+    clamped to the clip and moments shorter than half a second are dropped.
+    """
+    try:
+        document = json.loads(response_decoder.repair_json_text(text))
+    except ValueError:
+        return []
+    candidates = document.get('candidate_moments') if isinstance(document, dict) else None
+    if not isinstance(candidates, list):
+        return []
+
+    lengths = {name: end - start for name, (start, end) in video_durations.items()}
+    by_basename = {os.path.basename(name): name for name in lengths}
+    moments = []
+    for moment in candidates:
+        if not isinstance(moment, dict):
+            continue
+        name = moment.get('video_name')
+        name = name if name in lengths else by_basename.get(os.path.basename(str(name)))
+        try:
+            start, end = float(moment['start_time']), float(moment['end_time'])
+            score = float(moment.get('score', 0.5))
+        except (KeyError, TypeError, ValueError):
+            continue
+        if name is None:
+            continue
+        start, end = max(start, 0.0), min(end, lengths[name])
+        if end - start < 0.5:
+            continue
+        moments.append({
+            'video_name': name,
+            'start_time': round(start, 3),
+            'end_time': round(end, 3),
+            'score': min(max(score, 0.0), 1.0),
+            'description': str(moment.get('description', ""))[:300],
+        })
+    return moments
+
+
+def _map_request(chunk_media, gemini_prompt, model, max_moments):
+    keyframes, media_file, video_durations = chunk_media
+    if keyframes is not None:
+        parts = list(keyframes) + (["The clips' soundtrack:", media_file] if media_file is not None else [])
+    else:
+        parts = [media_file]
+    chat_session = model.start_chat(history=[{"role": "user", "parts": parts}])
+    return chat_session, prompts.build_map_prompt(video_durations, gemini_prompt, max_moments)
+
+
+# Function to ask Gemini for the candidate moments of one chunk
+def map_chunk(chunk_media, gemini_prompt, model, max_moments=MAP_MAX_MOMENTS):
+    """Returns the candidate moments Gemini finds in one chunk.
+
+    Args:
+        chunk_media: A tuple of the chunk's keyframe parts (None for video
+            input), its Gemini video or soundtrack file and its clip timestamp map.
+        gemini_prompt: The user's prompt.
+        model: The genai.GenerativeModel to prompt.
+        max_moments: The most moments to ask for.
+    """
+    chat_session, prompt = _map_request(chunk_media, gemini_prompt, model, max_moments)
+    return parse_moments(chat_session.send_message(prompt).text, chunk_media[2])
+
+
+# Function to ask Gemini for the candidate moments of one chunk from a coroutine
+async def map_chunk_async(chunk_media, gemini_prompt, model, max_moments=MAP_MAX_MOMENTS):
+    chat_session, prompt = _map_request(chunk_media, gemini_prompt, model, max_moments)
+    response = await chat_session.send_message_async(prompt)
+    return parse_moments(response.text, chunk_media[2])
+
+
+def _in_project_order(moments, video_durations):
+    order = {name: index for index, name in enumerate(video_durations)}
+    return sorted(moments, key=lambda moment: (order[moment['video_name']], moment['start_time']))
+
+
+# Function to keep the edit within the length limit
+def fit_to_length(gemini_response, max_seconds=MAX_VIDEO_SECONDS):
+    """Trims the last video edits until the total length is at most max_seconds,
+    shortening the audio trim by the same amount."""
+    video_edits, total = [], 0
+    for edit in gemini_response['video_edits']:
+        room = max_seconds - total
+        if room < 0.5:
+            break
+        end_time = min(edit['end_time'], edit['start_time'] + room)
+        video_edits.append({**edit, 'end_time': round(end_time, 3)})
+        total += end_time - edit['start_time']
+
+    audio_edits = gemini_response['audio_edits']
+    if isinstance(audio_edits.get('start_time'), (int, float)) and isinstance(audio_edits.get('end_time'), (int, float)):
+        end_time = min(audio_edits['end_time'], audio_edits['start_time'] + total)
+        audio_edits = helpers.return_audio_edits(audio_edits['start_time'], round(end_time, 3))
+    return {**gemini_response, 'video_edits': video_edits, 'audio_edits': audio_edits}
+
+
+# Function to assemble the edit from candidate moments without another model call
+def reduce_heuristic(moments, video_durations, has_audio, max_seconds=MAX_VIDEO_SECONDS):
+    """Keeps the best scoring moments that fit in max_seconds and plays them in project order."""
+    chosen, total = [], 0
+    for moment in sorted(moments, key=lambda moment: -moment['score']):
+        room = max_seconds - total
+        if room < 1:
+            break
+        length = min(moment['end_time'] - moment['start_time'], room)
+        chosen.append({**moment, 'end_time': round(moment['start_time'] + length, 3)})
+        total += length
+
+    chosen = _in_project_order(chosen, video_durations)
+    video_edits = [
+        helpers.return_video_edit(index + 1, moment['video_name'], moment['start_time'], moment['end_time'], [], [],
+                                  "fade" if index < len(chosen) - 1 else "")
+        for index, moment in enumerate(chosen)
+    ]
+    audio_edits = helpers.return_audio_edits(0, round(total, 3)) if has_audio else helpers.return_audio_edits("", "")
+    return {'video_edits': video_edits, 'audio_edits': audio_edits}
+
+
+def _reduce_prompt(moments, video_durations, gemini_prompt, audio_summary):
+    candidate_moments = json.dumps(_in_project_order(moments, video_durations), indent=1)
+    return prompts.build_reduce_prompt(video_durations, gemini_prompt, candidate_moments, audio_summary)
+
+
+# Function to assemble the edit from candidate moments with a text-only Gemini call
+def reduce_with_model(moments, video_durations, gemini_prompt, model, audio_summary=None):
+    response = model.generate_content(_reduce_prompt(moments, video_durations, gemini_prompt, audio_summary))
+    return response_decoder.decode_response(response.text, model, video_names=list(video_durations))
+
+
+# Function to assemble the edit from candidate moments with a text-only Gemini call from a coroutine
+async def reduce_with_model_async(moments, video_durations, gemini_prompt, model, audio_summary=None):
+    response = await model.generate_content_async(_reduce_prompt(moments, video_durations, gemini_prompt,
+                                                                 audio_summary))
+    # Repairs re-ask the model with the blocking SDK, so decoding runs on the I/O executor
+    return await async_runtime.run_io(response_decoder.decode_response, response.text, model,
+                                      video_names=list(video_durations))
+
+
+# Function to run the reduce step, falling back to the local heuristic
+def reduce(moments, video_durations, gemini_prompt, model, has_audio, audio_summary=None, mode=None):
+    """Returns the final edit settings, at most MAX_VIDEO_SECONDS long.
+
+    If the model call fails or returns nothing usable, the edit is assembled
+    by reduce_heuristic instead, so a request that got through the map step
+    still gets a result. mode defaults to REDUCE_MODE.
+    """
+    if (mode or REDUCE_MODE) == "model":
+        try:
+            with metrics.timed("reduce", moments=len(moments)):
+                gemini_response = limits.run_stage("reduce", limits.IO, reduce_with_model, moments,
+                                                   video_durations, gemini_prompt, model, audio_summary,
+                                                   timeout=limits.GENERATE_TIMEOUT)
+            map_reduce_events.inc(step="reduce", result="model")
+            return fit_to_length(gemini_response)
+        except Exception as e:
+            print(f"Reducing candidate moments with the model failed, using the heuristic: {e}")
+            map_reduce_events.inc(step="reduce", result="model_failed")
+    map_reduce_events.inc(step="reduce", result="heuristic")
+    return reduce_heuristic(moments, video_durations, has_audio)
+
+
+# Function to run the reduce step from a coroutine
+async def reduce_async(moments, video_durations, gemini_prompt, model, has_audio, audio_summary=None,
+                       mode=None):
+    if (mode or REDUCE_MODE) == "model":
+        try:
+            with metrics.timed("reduce", moments=len(moments)):
+                gemini_response = await limits.wait_async("reduce", reduce_with_model_async(
+                    moments, video_durations, gemini_prompt, model, audio_summary), timeout=limits.GENERATE_TIMEOUT)
+            map_reduce_events.inc(step="reduce", result="model")
+            return fit_to_length(gemini_response)
+        except Exception as e:
+            print(f"Reducing candidate moments with the model failed, using the heuristic: {e}")
+            map_reduce_events.inc(step="reduce", result="model_failed")
+    map_reduce_events.inc(step="reduce", result="heuristic")
+    return reduce_heuristic(moments, video_durations, has_audio)
+
+
+# Function to analyze a project chunk by chunk and assemble one edit
+def run(chunks, clip_seconds, prepare_chunk, gemini_prompt, model, has_audio, audio_summary=None,
+        concurrency=MAP_CONCURRENCY):
+    """Prepares and maps up to `concurrency` chunks at a time, then reduces all their moments.
+
+    Args:
+        chunks: Lists of clip names from plan_chunks.
+        clip_seconds: Clip names mapped to their durations, in project order.
+        prepare_chunk: Called with a chunk's clip names; returns the chunk_media
+            tuple map_chunk expects. Its stages use the worker's stage limits.
+        gemini_prompt: The user's prompt.
+        model: The genai.GenerativeModel to prompt.
+        has_audio: Whether the project has an audio track to trim.
+        audio_summary: The audio's timing summary for the reduce prompt, if any.
+        concurrency: Chunks in flight at a time.
+
+    Returns:
+        The edit settings, in the format of Gemini.prompt_gemini_api.
+
+    Raises:
+        response_decoder.ResponseDecodeError: If no chunk produced a usable moment.
+    """
+    def map_step(chunk):
+        chunk_media = prepare_chunk(chunk)
+        with metrics.timed("map", clips=len(chunk)) as stage:
+            moments = limits.run_stage("map", limits.IO, map_chunk, chunk_media, gemini_prompt, model,
+                                       timeout=limits.GENERATE_TIMEOUT)
+            stage['moments'] = len(moments)
+        map_reduce_events.inc(step="map", result="moments" if moments else "empty")
+        return moments
+
+    # Each chunk runs in its own copy of the request's context, so the deadline and request id follow it
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(chunks))),
+                                               thread_name_prefix="map") as executor:
+        futures = [executor.submit(contextvars.copy_context().run, map_step, chunk) for chunk in chunks]
+        moments = [moment for future in futures for moment in future.result()]
+    if not moments:
+        raise response_decoder.ResponseDecodeError("No chunk produced a usable candidate moment")
+    return reduce(moments, timeline(clip_seconds), gemini_prompt, model, has_audio, audio_summary)
+
+
+# Function to analyze a project chunk by chunk from a coroutine
+async def run_async(chunks, clip_seconds, prepare_chunk, gemini_prompt, model, has_audio, audio_summary=None,
+                    concurrency=MAP_CONCURRENCY):
+    """The asyncio counterpart of run; prepare_chunk is a coroutine function."""
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def map_step(chunk):
+        async with semaphore:
+            chunk_media = await prepare_chunk(chunk)
+            with metrics.timed("map", clips=len(chunk)) as stage:
+                moments = await limits.wait_async("map", map_chunk_async(chunk_media, gemini_prompt, model),
+                                                  timeout=limits.GENERATE_TIMEOUT)
+                stage['moments'] = len(moments)
+        map_reduce_events.inc(step="map", result="moments" if moments else "empty")
+        return moments
+
+    results = await asyncio.gather(*(map_step(chunk) for chunk in chunks))
+    moments = [moment for chunk_moments in results for moment in chunk_moments]
+    if not moments:
+        raise response_decoder.ResponseDecodeError("No chunk produced a usable candidate moment")
+    return await reduce_async(moments, timeline(clip_seconds), gemini_prompt, model, has_audio, audio_summary)
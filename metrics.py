@@ -0,0 +1,217 @@
+import json
+import time
+import uuid
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+
+# Upper bounds in seconds; the last bucket catches everything above them
+DEFAULT_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Id of the request (or job) the current code is working on, attached to every log line
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+_registry = []
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float('inf') else repr(float(bound))
+
+
+class Counter:
+    """A thread-safe monotonically increasing counter with optional labels."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} {value}")
+        return lines
+
+
+class Histogram:
+    """A thread-safe cumulative histogram of observed values with optional labels."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            series = self._series.setdefault(key, {'counts': [0] * len(self.buckets), 'sum': 0.0})
+            series['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            series['sum'] += value
+
+    def snapshot(self, **labels):
+        """Returns the cumulative bucket counts, the sum and the count of observations."""
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key, {'counts': [0] * len(self.buckets), 'sum': 0.0})
+            return self._cumulative(series)
+
+    def _cumulative(self, series):
+        cumulative, running = [], 0
+        for bound, count in zip(self.buckets, series['counts']):
+            running += count
+            cumulative.append((bound, running))
+        return {'buckets': cumulative, 'sum': series['sum'], 'count': running}
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                labels = dict(zip(self.labelnames, key))
+                snapshot = self._cumulative(series)
+                for bound, count in snapshot['buckets']:
+                    bucket_labels = _format_labels({**labels, 'le': _format_bound(bound)})
+                    lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {snapshot['sum']}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {snapshot['count']}")
+        return lines
+
+
+class Gauge:
+    """A thread-safe value that can go up and down, with optional labels."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} {value}")
+        return lines
+
+
+# Function to export every registered metric in the Prometheus text format
+def render_prometheus():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+# Function to start a new request id for the current context
+def new_request_id(request_id=None):
+    request_id = request_id or uuid.uuid4().hex
+    request_id_var.set(request_id)
+    return request_id
+
+
+# Function to write a structured (JSON) log line tagged with the current request id
+def log_event(event, **fields):
+    record = {'ts': round(time.time(), 3), 'request_id': request_id_var.get(), 'event': event}
+    record.update(fields)
+    print(json.dumps(record, default=str), flush=True)
+
+
+@contextmanager
+def timed(stage, **fields):
+    """Times a pipeline stage into stage_duration and logs it when the block exits.
+
+    The yielded dictionary can be filled with extra fields (bytes, clips, ...)
+    that are added to the log line.
+    """
+    extra = dict(fields)
+    start = time.monotonic()
+    status = "ok"
+    try:
+        yield extra
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        elapsed = time.monotonic() - start
+        stage_duration.observe(elapsed, stage=stage)
+        log_event("stage", stage=stage, status=status, seconds=round(elapsed, 3), **extra)
+
+
+# Time spent in each stage of the processing pipeline
+stage_duration = Histogram(
+    "pipeline_stage_seconds",
+    "Seconds spent in each stage of the processing pipeline",
+    labelnames=("stage",),
+)
+
+# Bytes moved between the server and Firebase Storage or Gemini
+bytes_transferred = Counter(
+    "pipeline_bytes_total",
+    "Bytes downloaded from Firebase Storage and uploaded to Gemini",
+    labelnames=("direction",),
+)
+
+# Number of clips processed
+clips_processed = Counter(
+    "pipeline_clips_total",
+    "Number of video clips processed",
+)
+
+# Number of processing requests by outcome
+requests_total = Counter(
+    "pipeline_requests_total",
+    "Number of processing requests by outcome",
+    labelnames=("status",),
+)
+
+# Time from upload until a Gemini file leaves the PROCESSING state
+file_active_latency = Histogram(
+    "gemini_file_active_seconds",
+    "Seconds until an uploaded Gemini file becomes ACTIVE",
+)
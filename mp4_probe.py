@@ -0,0 +1,217 @@
+import math
+import struct
+
+
+# Sample entry types mapped to the codec names ffprobe reports
+VIDEO_CODECS = {'avc1': 'h264', 'avc3': 'h264', 'hvc1': 'hevc', 'hev1': 'hevc', 'av01': 'av1', 'vp09': 'vp9',
+                'mp4v': 'mpeg4', 'apcn': 'prores', 'apch': 'prores', 'apcs': 'prores', 'apco': 'prores'}
+AUDIO_CODECS = {'mp4a': 'aac', 'Opus': 'opus', 'ac-3': 'ac3', 'ec-3': 'eac3', 'fLaC': 'flac', 'alac': 'alac',
+                'sowt': 'pcm_s16le', 'twos': 'pcm_s16be', 'lpcm': 'pcm_s16le'}
+CHROMA_FORMATS = {0: 'gray', 1: 'yuv420p', 2: 'yuv422p', 3: 'yuv444p'}
+# H.264 profiles whose avcC record has no chroma format and bit depth fields (always 8-bit 4:2:0)
+AVC_BASE_PROFILES = (66, 77, 88)
+# Boxes that may appear at the top level of an MP4 or QuickTime file
+TOP_LEVEL_BOXES = {'ftyp', 'moov', 'mdat', 'free', 'skip', 'wide', 'uuid', 'pnot', 'meta', 'styp', 'sidx', 'moof'}
+
+
+class Mp4ParseError(ValueError):
+    """Raised when a file is not an MP4/MOV file this parser can read."""
+
+
+def _children(data, start, end):
+    # Yields (type, body start, box end) for every box between start and end
+    position = start
+    while position + 8 <= end:
+        size, kind = struct.unpack('>I4s', data[position:position + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', data[position + 8:position + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - position
+        if size < header or position + size > end:
+            raise Mp4ParseError(f"Corrupt box {kind!r} at offset {position}")
+        yield kind.decode('latin-1'), position + header, position + size
+        position += size
+
+
+def _child(data, start, end, kind):
+    return next(((body, box_end) for name, body, box_end in _children(data, start, end) if name == kind), None)
+
+
+def _path(data, start, end, *kinds):
+    for kind in kinds:
+        found = _child(data, start, end, kind)
+        if found is None:
+            return None
+        start, end = found
+    return start, end
+
+
+def _read_moov(f):
+    # Walks the top-level box headers, seeking past mdat, and returns the body of moov
+    f.seek(0, 2)
+    file_size = f.tell()
+    position = 0
+    while position + 8 <= file_size:
+        f.seek(position)
+        header = f.read(16)
+        size, kind = struct.unpack('>I4s', header[:8])
+        kind = kind.decode('latin-1')
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', header[8:16])[0]
+            header_size = 16
+        elif size == 0:
+            size = file_size - position
+        if kind not in TOP_LEVEL_BOXES or size < header_size:
+            raise Mp4ParseError(f"Not an MP4 file (found {kind!r} at offset {position})")
+        if kind == 'moov':
+            f.seek(position + header_size)
+            return f.read(size - header_size)
+        position += size
+    raise Mp4ParseError("No moov box found")
+
+
+def _full_box_times(data, start):
+    # mvhd and mdhd share the layout of their timescale and duration fields
+    if data[start] == 1:
+        return struct.unpack('>IQ', data[start + 20:start + 32])
+    return struct.unpack('>II', data[start + 12:start + 20])
+
+
+def _rotation(data, start):
+    # The display matrix in tkhd; rotation is the clockwise angle of its first column, like the 'rotate' tag
+    offset = start + (52 if data[start] == 1 else 40)
+    a, b = struct.unpack('>ii', data[offset:offset + 8])
+    return round(math.degrees(math.atan2(b, a))) % 360
+
+
+def _frame_rate(data, stbl, timescale):
+    stts = _child(data, *stbl, 'stts')
+    if stts is None or not timescale:
+        return None
+    start = stts[0]
+    entry_count = struct.unpack('>I', data[start + 4:start + 8])[0]
+    entries = [struct.unpack('>II', data[start + 8 + i * 8:start + 16 + i * 8]) for i in range(entry_count)]
+    if not entries:
+        return None
+    # The most common sample delta, as ffprobe's r_frame_rate would report it
+    delta = max(entries, key=lambda entry: entry[0])[1]
+    if not delta:
+        return None
+    divisor = math.gcd(timescale, delta)
+    return f"{timescale // divisor}/{delta // divisor}"
+
+
+def _pixel_format(data, entry_start, entry_end, codec):
+    chroma, depth, full_range = 1, 8, False
+    for kind, body, box_end in _children(data, entry_start + 86, entry_end):
+        if kind == 'avcC' and box_end - body > 6:
+            if data[body + 1] not in AVC_BASE_PROFILES:
+                # Skip the SPS and PPS lists to reach the optional high profile fields
+                position = body + 6
+                for _ in range(data[body + 5] & 0x1F):
+                    position += 2 + struct.unpack('>H', data[position:position + 2])[0]
+                pps_count = data[position]
+                position += 1
+                for _ in range(pps_count):
+                    position += 2 + struct.unpack('>H', data[position:position + 2])[0]
+                if position + 2 <= box_end:
+                    chroma, depth = data[position] & 0x03, (data[position + 1] & 0x07) + 8
+        elif kind == 'hvcC' and box_end - body > 17:
+            chroma, depth = data[body + 16] & 0x03, (data[body + 17] & 0x07) + 8
+        elif kind == 'colr' and data[body:body + 4] == b'nclx' and box_end - body >= 11:
+            full_range = bool(data[body + 10] & 0x80)
+    pix_fmt = CHROMA_FORMATS.get(chroma, 'yuv420p')
+    if codec == 'h264' and full_range and pix_fmt != 'gray':
+        pix_fmt = pix_fmt.replace('yuv', 'yuvj')
+    if depth > 8:
+        pix_fmt += f"{depth}le"
+    return pix_fmt
+
+
+def _track(data, start, end):
+    tkhd = _child(data, start, end, 'tkhd')
+    mdhd = _path(data, start, end, 'mdia', 'mdhd')
+    hdlr = _path(data, start, end, 'mdia', 'hdlr')
+    stbl = _path(data, start, end, 'mdia', 'minf', 'stbl')
+    if not (tkhd and mdhd and hdlr and stbl):
+        return None
+    stsd = _child(data, *stbl, 'stsd')
+    if stsd is None:
+        return None
+    entry = next(_children(data, stsd[0] + 8, stsd[1]), None)
+    if entry is None:
+        return None
+
+    timescale, _ = _full_box_times(data, mdhd[0])
+    handler = data[hdlr[0] + 8:hdlr[0] + 12].decode('latin-1')
+    fourcc, entry_start, entry_end = entry
+    entry_start -= 8
+    track = {'handler': handler, 'fourcc': fourcc}
+
+    if handler == 'vide':
+        codec = VIDEO_CODECS.get(fourcc, fourcc.strip().lower())
+        width, height = struct.unpack('>HH', data[entry_start + 32:entry_start + 36])
+        track.update(codec=codec, width=width, height=height, rotation=_rotation(data, tkhd[0]),
+                     frame_rate=_frame_rate(data, stbl, timescale),
+                     pix_fmt=_pixel_format(data, entry_start, entry_end, codec))
+    elif handler == 'soun':
+        channels = struct.unpack('>H', data[entry_start + 24:entry_start + 26])[0]
+        sample_rate = struct.unpack('>H', data[entry_start + 32:entry_start + 34])[0]
+        track.update(codec=AUDIO_CODECS.get(fourcc, fourcc.strip().lower()), channels=channels,
+                     # Rates above 65535 Hz do not fit the sample entry; the media timescale holds them
+                     sample_rate=sample_rate or timescale)
+    return track
+
+
+# Function to read clip properties from MP4/MOV metadata without starting ffprobe
+def probe_mp4(path):
+    """Reads duration and stream properties from the moov box of an MP4 or MOV file.
+
+    Only box headers are read until moov is found, so an mdat of any size is
+    skipped with a single seek. The colour range (yuvj pixel formats) is only
+    detected when the sample entry has a colr box.
+
+    Returns:
+        A dictionary with the same keys as Video.probe_video.
+
+    Raises:
+        Mp4ParseError: If the file is not MP4/MOV, is fragmented or has no video track.
+    """
+    with open(path, 'rb') as f:
+        moov = _read_moov(f)
+
+    try:
+        mvhd = _child(moov, 0, len(moov), 'mvhd')
+        if mvhd is None:
+            raise Mp4ParseError("No mvhd box found")
+        timescale, duration = _full_box_times(moov, mvhd[0])
+        if not timescale or not duration:
+            # Fragmented files keep their duration in the fragments
+            raise Mp4ParseError("File has no movie duration")
+
+        tracks = [_track(moov, body, end) for kind, body, end in _children(moov, 0, len(moov)) if kind == 'trak']
+    except (struct.error, IndexError) as e:
+        raise Mp4ParseError(f"Truncated moov box: {e}")
+
+    video = next((track for track in tracks if track and track['handler'] == 'vide'), None)
+    audio = next((track for track in tracks if track and track['handler'] == 'soun'), None)
+    if video is None:
+        raise Mp4ParseError(f"No video track found in: {path}")
+
+    return {
+        'path': path,
+        'duration': duration / timescale,
+        'video_codec': video['codec'],
+        'width': video['width'],
+        'height': video['height'],
+        'pix_fmt': video['pix_fmt'],
+        'frame_rate': video['frame_rate'],
+        'rotation': video['rotation'],
+        'has_audio': audio is not None,
+        'audio_codec': audio['codec'] if audio else None,
+        'sample_rate': audio['sample_rate'] if audio else None,
+        'channels': audio['channels'] if audio else None,
+    }
@@ -0,0 +1,157 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import concurrent.futures
+import quota
+import metrics
+from clip_store import blob_version_key
+
+
+# Prepare project media when clips are uploaded, before the prompt arrives
+PREPROCESS = os.getenv("PREPROCESS", "1") == "1"
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", 2))
+# Quiet time after the last upload event of a project before it is prepared
+PREPROCESS_DEBOUNCE_SECONDS = float(os.getenv("PREPROCESS_DEBOUNCE_SECONDS", 3))
+# Storage events must carry this value in the X-Event-Token header; without it they are refused
+STORAGE_EVENT_TOKEN = os.getenv("STORAGE_EVENT_TOKEN", "")
+# Media is only prepared for accepted events, so without a token requests do not look for it
+PREPARED_MEDIA_LOOKUP = PREPROCESS and bool(STORAGE_EVENT_TOKEN)
+
+# Objects whose upload should trigger preparation of their project
+MEDIA_OBJECT = re.compile(r"^users/(?P<user_id>[^/]+)/projects/(?P<project_id>[^/]+)/(?:videos|audios)/[^/]+$")
+
+preprocess_events = metrics.Counter(
+    "preprocess_events_total",
+    "Upload-time preparation runs by outcome",
+    labelnames=("result",),
+)
+prepared_lookups = metrics.Counter(
+    "prepared_media_lookups_total",
+    "Requests that found their media prepared at upload time, by result",
+    labelnames=("result",),
+)
+
+
+# Function to get the project a storage finalize event belongs to
+def parse_storage_event(payload):
+    """Returns (user_id, project_id) for an upload under a project's videos or audios, else None.
+
+    Accepts the Cloud Storage object resource as sent by a storage trigger, or
+    a CloudEvent that carries it under "data" (e.g. from Eventarc).
+    """
+    if not isinstance(payload, dict):
+        return None
+    data = payload.get('data') if isinstance(payload.get('data'), dict) else payload
+    match = MEDIA_OBJECT.match(data.get('name') or "")
+    if match is None:
+        return None
+    return match.group('user_id'), match.group('project_id')
+
+
+# Function to identify the exact media a project's prepared files were built from
+def media_fingerprint(media_blobs, variant=""):
+    """Hashes the name and generation of every blob, in order, plus a variant string
+    for settings that change the uploaded file (e.g. whether a proxy is used)."""
+    content = "\n".join([variant] + [blob_version_key(blob) for blob in media_blobs])
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+# Function to build the record stored on the project document once its media is ready
+def prepared_record(fingerprint, gemini_video, video_durations, gemini_audio):
+    return {
+        'fingerprint': fingerprint,
+        'video_file': gemini_video.name,
+        'audio_file': gemini_audio.name if gemini_audio is not None else None,
+        # JSON text, because clip paths are not usable as Firestore map keys
+        'video_durations': json.dumps(video_durations),
+        'prepared_at': time.time(),
+    }
+
+
+# Function to get the Gemini files of a prepared record if they match this request
+def ready_media(record, fingerprint, video_paths, genai):
+    """Returns (gemini_video, video_durations, gemini_audio), or None when the request must prepare its media.
+
+    The record is used only when it was built from exactly the same blobs, it
+    names the same local clip paths and its Gemini files are still ACTIVE.
+    """
+    if record is None or record.get('fingerprint') != fingerprint:
+        prepared_lookups.inc(result="miss")
+        return None
+
+    video_durations = json.loads(record['video_durations'])
+    if set(video_durations) != set(video_paths):
+        prepared_lookups.inc(result="stale")
+        return None
+    try:
+        gemini_video = genai.get_file(record['video_file'])
+        gemini_audio = genai.get_file(record['audio_file']) if record.get('audio_file') else None
+    except Exception as e:
+        print(f"Prepared Gemini files are no longer available: {e}")
+        prepared_lookups.inc(result="stale")
+        return None
+    if any(file is not None and file.state.name != "ACTIVE" for file in (gemini_video, gemini_audio)):
+        prepared_lookups.inc(result="stale")
+        return None
+
+    prepared_lookups.inc(result="hit")
+    return gemini_video, video_durations, gemini_audio
+
+
+class Preprocessor:
+    """Runs prepare(user_id, project_id) in the background after a project's uploads settle.
+
+    A project is prepared once its events have been quiet for `debounce`
+    seconds. Events that arrive while it is waiting are absorbed; events that
+    arrive while it is being prepared cause one more run afterwards, so the
+    last upload is always included. Its Gemini calls run in the scheduler's
+    background lane, behind those of interactive requests.
+    """
+
+    def __init__(self, prepare, workers=PREPROCESS_WORKERS, debounce=PREPROCESS_DEBOUNCE_SECONDS):
+        self.prepare = prepare
+        self.debounce = debounce
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preprocess")
+        # Projects that are waiting or running, mapped to whether another run is needed
+        self._projects = {}
+        self._lock = threading.Lock()
+
+    # Function to schedule preparation of a project
+    def schedule(self, user_id, project_id):
+        """Returns True if a run was scheduled, False if the event joined one already pending."""
+        key = (user_id, project_id)
+        with self._lock:
+            if key in self._projects:
+                self._projects[key] = True
+                preprocess_events.inc(result="coalesced")
+                return False
+            self._projects[key] = False
+        self._start_timer(key)
+        preprocess_events.inc(result="scheduled")
+        return True
+
+    def _start_timer(self, key):
+        timer = threading.Timer(self.debounce, self._executor.submit, (self._run, key))
+        timer.daemon = True
+        timer.start()
+
+    def _run(self, key):
+        with self._lock:
+            self._projects[key] = False
+        try:
+            with metrics.timed("preprocess"), quota.priority(quota.BACKGROUND):
+                self.prepare(*key)
+            preprocess_events.inc(result="prepared")
+        except Exception as e:
+            print(f"Preparing media of project {key[1]} failed: {e}")
+            preprocess_events.inc(result="failed")
+
+        with self._lock:
+            if self._projects[key]:
+                self._projects[key] = False
+                self._start_timer(key)
+            else:
+                del self._projects[key]
@@ -0,0 +1,120 @@
+import os
+import textwrap
+from string import Template
+import metrics
+
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt_templates")
+
+# Requests whose prompt, video and audio together exceed this many tokens are trimmed or rejected
+MAX_INPUT_TOKENS = int(os.getenv("MAX_INPUT_TOKENS", 1000000))
+# The user's prompt is never trimmed below this many characters
+MIN_USER_PROMPT_CHARS = int(os.getenv("MIN_USER_PROMPT_CHARS", 200))
+# Rough size of a token, used to decide how much of an oversized prompt to cut
+CHARS_PER_TOKEN = 4
+
+
+def _load_template(file_name):
+    with open(os.path.join(TEMPLATE_DIR, file_name)) as f:
+        return textwrap.dedent(f.read()).strip() + "\n"
+
+
+# Templates are read once at import time; only the per-request slots are filled afterwards
+EDIT_INSTRUCTIONS = _load_template("instructions.txt")
+REQUEST_TEMPLATE = Template(_load_template("request.txt"))
+KEYFRAME_REQUEST_TEMPLATE = Template(_load_template("request_keyframes.txt"))
+AUDIO_SUMMARY_TEMPLATE = Template(_load_template("audio_summary.txt"))
+MAP_TEMPLATE = Template(_load_template("map.txt"))
+REDUCE_TEMPLATE = Template(_load_template("reduce.txt"))
+
+
+# Number of input tokens per request
+input_tokens = metrics.Histogram(
+    "gemini_input_tokens",
+    "Input tokens (prompt and media) sent per Gemini request",
+    buckets=(1000, 10000, 50000, 100000, 250000, 500000, 1000000, 2000000),
+)
+
+
+class PromptTooLarge(ValueError):
+    """Raised when a request cannot be brought under the input token budget."""
+
+
+# Function to describe the locally analyzed audio timing, if any
+def build_audio_section(audio_summary):
+    return AUDIO_SUMMARY_TEMPLATE.substitute(audio_summary=audio_summary) if audio_summary else ""
+
+
+# Function to fill the per-request slots of the prompt
+def build_request(video_durations, gemini_prompt, audio_summary=None):
+    request = REQUEST_TEMPLATE.substitute(video_durations=str(video_durations), gemini_prompt=gemini_prompt)
+    return request + build_audio_section(audio_summary)
+
+
+# Function to build the full text prompt sent with the media
+def build_prompt(video_durations, gemini_prompt, audio_summary=None):
+    return build_request(video_durations, gemini_prompt, audio_summary) + "\n" + EDIT_INSTRUCTIONS
+
+
+# Function to build the full text prompt sent with keyframes instead of the video
+def build_keyframe_prompt(video_durations, gemini_prompt, audio_summary=None):
+    request = KEYFRAME_REQUEST_TEMPLATE.substitute(video_durations=str(video_durations), gemini_prompt=gemini_prompt)
+    return request + build_audio_section(audio_summary) + "\n" + EDIT_INSTRUCTIONS
+
+
+# Function to build the prompt that asks for candidate moments in one chunk of clips
+def build_map_prompt(video_durations, gemini_prompt, max_moments):
+    return MAP_TEMPLATE.substitute(video_durations=str(video_durations), gemini_prompt=gemini_prompt,
+                                   max_moments=max_moments)
+
+
+# Function to build the text-only prompt that turns candidate moments into edit settings
+def build_reduce_prompt(video_durations, gemini_prompt, candidate_moments, audio_summary=None):
+    request = REDUCE_TEMPLATE.substitute(video_durations=str(video_durations), gemini_prompt=gemini_prompt,
+                                         candidate_moments=candidate_moments)
+    return request + build_audio_section(audio_summary) + "\n" + EDIT_INSTRUCTIONS
+
+
+# Function to count the tokens of a prompt and its media and keep them under the budget
+def fit_to_budget(model, media_parts, video_durations, gemini_prompt, max_tokens=MAX_INPUT_TOKENS,
+                  build=build_prompt, cached_tokens=0, audio_summary=None):
+    """Builds the prompt and checks its token count with the model's token counter.
+
+    If the request is over budget, the user's prompt is shortened once by the
+    estimated excess. The prompt template and the media are never trimmed.
+
+    Args:
+        model: The genai.GenerativeModel the request will be sent to.
+        media_parts: The uploaded files sent alongside the prompt.
+        video_durations: The clip timestamp map.
+        gemini_prompt: The user's prompt.
+        max_tokens: The input token budget.
+        build: Builds the prompt text; build_request when the instructions are
+            already in a context cache.
+        cached_tokens: Tokens already held in a context cache for this request.
+        audio_summary: The timing of the audio from audio_analysis.timing_summary, if any.
+
+    Returns:
+        A tuple of the prompt text and its total input token count.
+
+    Raises:
+        PromptTooLarge: If the request is still over budget after trimming.
+    """
+    prompt = build(video_durations, gemini_prompt, audio_summary)
+    total_tokens = cached_tokens + model.count_tokens(media_parts + [prompt]).total_tokens
+
+    if total_tokens > max_tokens:
+        excess_chars = (total_tokens - max_tokens) * CHARS_PER_TOKEN
+        keep_chars = max(len(gemini_prompt) - excess_chars, MIN_USER_PROMPT_CHARS)
+        if keep_chars < len(gemini_prompt):
+            metrics.log_event("prompt_trimmed", tokens=total_tokens, max_tokens=max_tokens,
+                              removed_chars=len(gemini_prompt) - keep_chars)
+            prompt = build(video_durations, gemini_prompt[:keep_chars], audio_summary)
+            total_tokens = cached_tokens + model.count_tokens(media_parts + [prompt]).total_tokens
+
+    if total_tokens > max_tokens:
+        raise PromptTooLarge(f"Request needs {total_tokens} input tokens, the limit is {max_tokens}")
+
+    input_tokens.observe(total_tokens)
+    metrics.log_event("prompt_tokens", tokens=total_tokens, prompt_chars=len(prompt))
+    return prompt, total_tokens
@@ -0,0 +1,515 @@
+import os
+import re
+import abc
+import json
+import time
+import fcntl
+import random
+import asyncio
+import tempfile
+import threading
+import contextvars
+from contextlib import contextmanager
+import limits
+import metrics
+
+
+# Route every Gemini call through a shared rate limiter
+GEMINI_SCHEDULER = os.getenv("GEMINI_SCHEDULER", "1") == "1"
+# "memory" limits this process only; "file" shares the buckets with every worker on the host
+GEMINI_QUOTA_BACKEND = os.getenv("GEMINI_QUOTA_BACKEND", "file")
+GEMINI_QUOTA_PATH = os.getenv("GEMINI_QUOTA_PATH", os.path.join(tempfile.gettempdir(), "craite_gemini_quota.json"))
+# Requests per minute of each endpoint class; 0 leaves a class unlimited
+GEMINI_UPLOAD_RPM = float(os.getenv("GEMINI_UPLOAD_RPM", 300))
+GEMINI_POLL_RPM = float(os.getenv("GEMINI_POLL_RPM", 1200))
+GEMINI_GENERATE_RPM = float(os.getenv("GEMINI_GENERATE_RPM", 1000))
+# Tokens per minute of generation, charged with the token count of each response
+GEMINI_GENERATE_TPM = float(os.getenv("GEMINI_GENERATE_TPM", 4000000))
+# Size of each bucket in seconds of quota, i.e. how much may be spent at once after a quiet spell
+GEMINI_QUOTA_BURST_SECONDS = float(os.getenv("GEMINI_QUOTA_BURST_SECONDS", 10))
+# Share of every bucket that background pre-processing leaves to interactive requests
+GEMINI_INTERACTIVE_RESERVE = float(os.getenv("GEMINI_INTERACTIVE_RESERVE", 0.25))
+# Retries of a call Gemini rejects for quota (429), and the backoff used when it does not say how long to wait
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", 5))
+GEMINI_BACKOFF_INITIAL = float(os.getenv("GEMINI_BACKOFF_INITIAL", 2))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", 60))
+
+# Endpoint classes, each with its own bucket
+UPLOAD = "upload"
+POLL = "poll"
+GENERATE = "generate"
+# The token bucket that generate calls draw from as well
+GENERATE_TOKENS = "generate_tokens"
+
+# Priority lanes
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+# Longest sleep between checks of a bucket, so callers notice quota freed by other workers
+MAX_SLEEP = 0.5
+# How often background callers check whether interactive callers are still waiting
+LANE_POLL_SECONDS = 0.05
+
+# The lane of the current request or job; pre-processing runs in the background lane
+priority_var = contextvars.ContextVar("gemini_priority", default=INTERACTIVE)
+
+# Gemini's quota errors say e.g. "Please retry in 25.3s." or carry a RetryInfo detail
+RETRY_IN = re.compile(r"retry in (\d+(?:\.\d+)?)\s*s", re.IGNORECASE)
+RETRY_DELAY = re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)")
+
+queue_depth = metrics.Gauge(
+    "gemini_scheduler_queue_depth",
+    "Gemini calls waiting for quota",
+    labelnames=("endpoint", "priority"),
+)
+quota_wait = metrics.Histogram(
+    "gemini_scheduler_wait_seconds",
+    "Seconds Gemini calls waited for quota before they were sent",
+    labelnames=("endpoint", "priority"),
+    buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+throttle_events = metrics.Counter(
+    "gemini_throttled_total",
+    "Gemini calls held back by the scheduler (bucket), rejected by Gemini and retried (rate_limited) "
+    "or given up on (exhausted)",
+    labelnames=("endpoint", "reason"),
+)
+
+
+class QuotaExhausted(Exception):
+    """Raised when Gemini keeps rejecting a call for quota, or when the quota
+    would not be available before the request's deadline."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Function to run the Gemini calls made in a block in another priority lane
+@contextmanager
+def priority(lane):
+    token = priority_var.set(lane)
+    try:
+        yield
+    finally:
+        priority_var.reset(token)
+
+
+# Function to tell quota errors apart from other API errors
+def is_rate_limited(error):
+    # google.api_core errors carry the HTTP status, gRPC errors a status code enum
+    code = getattr(error, 'code', None)
+    if code == 429 or getattr(code, 'name', None) == "RESOURCE_EXHAUSTED":
+        return True
+    return type(error).__name__ in ("ResourceExhausted", "TooManyRequests")
+
+
+# Function to read how long Gemini asked the caller to wait
+def retry_after(error):
+    """Returns the delay in seconds from the error's Retry-After header, its
+    RetryInfo detail or its message, or None when Gemini gave none."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+
+    for detail in getattr(error, 'details', None) or []:
+        delay = getattr(detail, 'retry_delay', None)
+        if delay is not None:
+            if hasattr(delay, 'total_seconds'):
+                return delay.total_seconds()
+            return delay.seconds + delay.nanos / 1e9
+
+    match = RETRY_IN.search(str(error)) or RETRY_DELAY.search(str(error))
+    return float(match.group(1)) if match else None
+
+
+class QuotaBackend(abc.ABC):
+    """Token buckets kept in some store; subclasses implement _state.
+
+    _state is a context manager that yields the buckets as a dictionary and
+    stores any changes when the block ends, with no other update in between.
+    A store shared by several processes (a file here, but e.g. Redis or a
+    database row would do) makes the limits hold across all of them.
+    Times are wall-clock seconds so that every process agrees on them.
+    """
+
+    @abc.abstractmethod
+    def _state(self):
+        """Yields the buckets and stores any changes when the block ends."""
+
+    @staticmethod
+    def _refill(buckets, name, rate, capacity, now):
+        bucket = buckets.setdefault(name, {'level': capacity, 'updated': now, 'blocked_until': 0})
+        bucket['level'] = min(capacity, bucket['level'] + max(0, now - bucket['updated']) * rate)
+        bucket['updated'] = now
+        return bucket
+
+    # Function to take quota from several buckets at once
+    def take(self, demands, now=None):
+        """Takes `amount` from every bucket, or from none of them.
+
+        Args:
+            demands: (name, amount, rate per second, capacity, floor) tuples. A
+                bucket only gives out quota while at least `floor` would remain.
+
+        Returns:
+            0 when the quota was taken, else the seconds until it may be available.
+        """
+        now = time.time() if now is None else now
+        with self._state() as buckets:
+            wait = 0.0
+            for name, amount, rate, capacity, floor in demands:
+                bucket = self._refill(buckets, name, rate, capacity, now)
+                wait = max(wait, bucket['blocked_until'] - now, (floor + amount - bucket['level']) / rate)
+            if wait <= 0:
+                for name, amount, *_ in demands:
+                    buckets[name]['level'] -= amount
+        return max(wait, 0.0)
+
+    # Function to draw quota that was only known after the call, e.g. its tokens
+    def charge(self, name, amount, rate, capacity, now=None):
+        """Takes `amount` even if the bucket runs into debt, which later calls wait out."""
+        now = time.time() if now is None else now
+        with self._state() as buckets:
+            self._refill(buckets, name, rate, capacity, now)['level'] -= amount
+
+    # Function to stop a bucket from giving out quota for a while, e.g. after a 429
+    def block(self, name, until):
+        with self._state() as buckets:
+            bucket = buckets.setdefault(name, {'level': 0, 'updated': time.time(), 'blocked_until': 0})
+            bucket['blocked_until'] = max(bucket['blocked_until'], until)
+
+
+class MemoryQuotaBackend(QuotaBackend):
+    """Buckets held in this process."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _state(self):
+        with self._lock:
+            yield self._buckets
+
+
+class FileQuotaBackend(QuotaBackend):
+    """Buckets in a JSON file, shared by every worker on the host.
+
+    A file lock serializes updates across processes and a thread lock does the
+    same within a process, like in UploadCache.
+    """
+
+    def __init__(self, path=GEMINI_QUOTA_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _state(self):
+        with self._lock, open(f"{self.path}.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path) as f:
+                        buckets = json.load(f)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    buckets = {}
+                yield buckets
+                temp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(temp_path, 'w') as f:
+                    json.dump(buckets, f)
+                os.replace(temp_path, self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class QuotaScheduler:
+    """Spaces out Gemini calls with token buckets and retries those Gemini rejects for quota.
+
+    Every endpoint class has a bucket of requests per minute, and generate
+    calls also draw from a bucket of tokens per minute. Calls wait until
+    their buckets have quota. Callers in the background lane leave a reserve
+    of every bucket to interactive callers and step aside while interactive
+    callers of the same class are waiting in this process.
+
+    A call rejected with 429 blocks its class in the backend for as long as
+    Gemini asked (or an exponential backoff with jitter), so every worker
+    sharing the backend holds off, and is then retried.
+    """
+
+    def __init__(self, backend, rates_per_minute=None, burst_seconds=GEMINI_QUOTA_BURST_SECONDS,
+                 reserve=GEMINI_INTERACTIVE_RESERVE, max_retries=GEMINI_MAX_RETRIES,
+                 initial_backoff=GEMINI_BACKOFF_INITIAL, max_backoff=GEMINI_BACKOFF_MAX):
+        if rates_per_minute is None:
+            rates_per_minute = {UPLOAD: GEMINI_UPLOAD_RPM, POLL: GEMINI_POLL_RPM, GENERATE: GEMINI_GENERATE_RPM,
+                                GENERATE_TOKENS: GEMINI_GENERATE_TPM}
+        self.backend = backend
+        self.rates = {name: rate / 60 for name, rate in rates_per_minute.items() if rate > 0}
+        self.burst_seconds = burst_seconds
+        self.reserve = reserve
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._interactive_waiting = {}
+        self._lock = threading.Lock()
+
+    def _capacity(self, name):
+        return max(self.rates[name] * self.burst_seconds, 1)
+
+    def _demands(self, endpoint, lane):
+        names = [endpoint, GENERATE_TOKENS] if endpoint == GENERATE else [endpoint]
+        demands = []
+        for name in names:
+            if name not in self.rates:
+                continue
+            capacity = self._capacity(name)
+            # Tokens are charged after the call, so their bucket only has to be out of debt
+            amount = 0 if name == GENERATE_TOKENS else 1
+            floor = min(self.reserve * capacity, capacity - amount) if lane == BACKGROUND else 0
+            demands.append((name, amount, self.rates[name], capacity, floor))
+        return demands
+
+    def _try_acquire(self, endpoint, lane):
+        if lane == BACKGROUND and self._interactive_waiting.get(endpoint):
+            return LANE_POLL_SECONDS
+        demands = self._demands(endpoint, lane)
+        return self.backend.take(demands) if demands else 0
+
+    def _enter(self, endpoint, lane):
+        queue_depth.inc(endpoint=endpoint, priority=lane)
+        if lane == INTERACTIVE:
+            with self._lock:
+                self._interactive_waiting[endpoint] = self._interactive_waiting.get(endpoint, 0) + 1
+
+    def _leave(self, endpoint, lane, start, throttled):
+        queue_depth.dec(endpoint=endpoint, priority=lane)
+        if lane == INTERACTIVE:
+            with self._lock:
+                self._interactive_waiting[endpoint] -= 1
+        quota_wait.observe(time.monotonic() - start, endpoint=endpoint, priority=lane)
+        if throttled:
+            throttle_events.inc(endpoint=endpoint, reason="bucket")
+
+    def _check_deadline(self, endpoint, wait):
+        remaining = limits.remaining()
+        if remaining is not None and wait > remaining:
+            raise QuotaExhausted(f"Gemini {endpoint} quota is not available before the request's deadline",
+                                 retry_after=wait)
+
+    # Function to wait until an endpoint class has quota for one call
+    def acquire(self, endpoint, lane=None):
+        lane = lane or priority_var.get()
+        start, throttled = time.monotonic(), False
+        self._enter(endpoint, lane)
+        try:
+            while True:
+                wait = self._try_acquire(endpoint, lane)
+                if wait <= 0:
+                    return
+                throttled = True
+                self._check_deadline(endpoint, wait)
+                time.sleep(min(wait, MAX_SLEEP))
+        finally:
+            self._leave(endpoint, lane, start, throttled)
+
+    async def acquire_async(self, endpoint, lane=None):
+        """Like acquire, sleeping without holding a thread.
+
+        The bucket update runs in a thread, since the file backend waits for a
+        lock that other workers may hold.
+        """
+        lane = lane or priority_var.get()
+        start, throttled = time.monotonic(), False
+        self._enter(endpoint, lane)
+        try:
+            while True:
+                wait = await asyncio.to_thread(self._try_acquire, endpoint, lane)
+                if wait <= 0:
+                    return
+                throttled = True
+                self._check_deadline(endpoint, wait)
+                await asyncio.sleep(min(wait, MAX_SLEEP))
+        finally:
+            self._leave(endpoint, lane, start, throttled)
+
+    def _back_off(self, endpoint, error, attempt):
+        # Called while handling a 429; returns how long the class is blocked, or raises once the retries are used up
+        delay = retry_after(error)
+        if delay is None:
+            backoff = min(self.max_backoff, self.initial_backoff * 2 ** attempt)
+            delay = backoff / 2 + random.uniform(0, backoff / 2)
+        if attempt >= self.max_retries:
+            throttle_events.inc(endpoint=endpoint, reason="exhausted")
+            raise QuotaExhausted(f"Gemini rejected the {endpoint} call for quota after {attempt + 1} attempts: {error}",
+                                 retry_after=delay) from error
+        throttle_events.inc(endpoint=endpoint, reason="rate_limited")
+        metrics.log_event("gemini_rate_limited", endpoint=endpoint, attempt=attempt + 1, retry_after=round(delay, 2))
+        return delay
+
+    def _charge(self, endpoint, response):
+        # Streamed responses only know the tokens of their first chunk here, which include the whole input
+        usage = getattr(response, 'usage_metadata', None)
+        tokens = getattr(usage, 'total_token_count', 0) or 0
+        if endpoint == GENERATE and tokens and GENERATE_TOKENS in self.rates:
+            self.backend.charge(GENERATE_TOKENS, tokens, self.rates[GENERATE_TOKENS],
+                                self._capacity(GENERATE_TOKENS))
+
+    # Function to make a Gemini call within its endpoint class's quota
+    def call(self, endpoint, fn, *args, **kwargs):
+        """Calls fn(*args, **kwargs) once `endpoint` has quota and returns its result.
+
+        Raises:
+            QuotaExhausted: If Gemini rejected the call for quota more than
+                max_retries times, or the wait would outlast the request's deadline.
+        """
+        lane = priority_var.get()
+        attempt = 0
+        while True:
+            self.acquire(endpoint, lane)
+            try:
+                response = fn(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limited(e):
+                    raise
+                self.backend.block(endpoint, time.time() + self._back_off(endpoint, e, attempt))
+                attempt += 1
+                continue
+            self._charge(endpoint, response)
+            return response
+
+    async def call_async(self, endpoint, fn, *args, **kwargs):
+        """Like call, for coroutine functions such as send_message_async."""
+        lane = priority_var.get()
+        attempt = 0
+        while True:
+            await self.acquire_async(endpoint, lane)
+            try:
+                response = await fn(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limited(e):
+                    raise
+                delay = self._back_off(endpoint, e, attempt)
+                await asyncio.to_thread(self.backend.block, endpoint, time.time() + delay)
+                attempt += 1
+                continue
+            await asyncio.to_thread(self._charge, endpoint, response)
+            return response
+
+
+class ScheduledChatSession:
+    """A chat session whose messages go through the scheduler."""
+
+    def __init__(self, chat_session, scheduler):
+        self._chat_session = chat_session
+        self._scheduler = scheduler
+
+    def send_message(self, *args, **kwargs):
+        return self._scheduler.call(GENERATE, self._chat_session.send_message, *args, **kwargs)
+
+    async def send_message_async(self, *args, **kwargs):
+        return await self._scheduler.call_async(GENERATE, self._chat_session.send_message_async, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._chat_session, name)
+
+
+class ScheduledModel:
+    """A genai.GenerativeModel whose calls, and those of its chat sessions, go through the scheduler."""
+
+    def __init__(self, model, scheduler):
+        self._model = model
+        self._scheduler = scheduler
+
+    def generate_content(self, *args, **kwargs):
+        return self._scheduler.call(GENERATE, self._model.generate_content, *args, **kwargs)
+
+    async def generate_content_async(self, *args, **kwargs):
+        return await self._scheduler.call_async(GENERATE, self._model.generate_content_async, *args, **kwargs)
+
+    def count_tokens(self, *args, **kwargs):
+        return self._scheduler.call(POLL, self._model.count_tokens, *args, **kwargs)
+
+    def start_chat(self, *args, **kwargs):
+        return ScheduledChatSession(self._model.start_chat(*args, **kwargs), self._scheduler)
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+
+class ScheduledModelClass:
+    """genai.GenerativeModel, creating models that go through the scheduler."""
+
+    def __init__(self, model_class, scheduler):
+        self._model_class = model_class
+        self._scheduler = scheduler
+
+    def __call__(self, *args, **kwargs):
+        return ScheduledModel(self._model_class(*args, **kwargs), self._scheduler)
+
+    def from_cached_content(self, *args, **kwargs):
+        return ScheduledModel(self._model_class.from_cached_content(*args, **kwargs), self._scheduler)
+
+
+class ScheduledCachedContent:
+    """genai.caching.CachedContent, creating cached content within the upload quota."""
+
+    def __init__(self, cached_content_class, scheduler):
+        self._cached_content_class = cached_content_class
+        self._scheduler = scheduler
+
+    def create(self, *args, **kwargs):
+        return self._scheduler.call(UPLOAD, self._cached_content_class.create, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cached_content_class, name)
+
+
+class ScheduledCaching:
+    """genai.caching with its CachedContent going through the scheduler."""
+
+    def __init__(self, caching, scheduler):
+        self._caching = caching
+        self.CachedContent = ScheduledCachedContent(caching.CachedContent, scheduler)
+
+    def __getattr__(self, name):
+        return getattr(self._caching, name)
+
+
+class ScheduledGenai:
+    """The google.generativeai module with its API calls going through a scheduler.
+
+    Code that is handed this in place of the module needs no changes: the
+    Files API, the models it creates and their chat sessions are all
+    scheduled. Listing calls, which page lazily, pass straight through.
+    """
+
+    def __init__(self, genai, scheduler):
+        self._genai = genai
+        self.scheduler = scheduler
+        self.GenerativeModel = ScheduledModelClass(genai.GenerativeModel, scheduler)
+
+    def upload_file(self, *args, **kwargs):
+        return self.scheduler.call(UPLOAD, self._genai.upload_file, *args, **kwargs)
+
+    def get_file(self, *args, **kwargs):
+        return self.scheduler.call(POLL, self._genai.get_file, *args, **kwargs)
+
+    def delete_file(self, *args, **kwargs):
+        return self.scheduler.call(POLL, self._genai.delete_file, *args, **kwargs)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._genai, name)
+        if name == "caching":
+            return ScheduledCaching(attribute, self.scheduler)
+        return attribute
+
+
+# Function to build the scheduler configured by the environment
+def create_scheduler(backend=GEMINI_QUOTA_BACKEND):
+    if backend == "file":
+        return QuotaScheduler(FileQuotaBackend())
+    return QuotaScheduler(MemoryQuotaBackend())
@@ -0,0 +1,452 @@
+import os
+import math
+import json
+import time
+import hashlib
+import threading
+import concurrent.futures
+import ffmpeg
+import helpers
+import limits
+from video import Video
+
+
+# Settings for server-side rendering of the Gemini edit list
+RENDER_WIDTH = int(os.getenv("RENDER_WIDTH", 0))
+RENDER_HEIGHT = int(os.getenv("RENDER_HEIGHT", 0))
+RENDER_FPS = float(os.getenv("RENDER_FPS", 30))
+RENDER_CRF = int(os.getenv("RENDER_CRF", 23))
+RENDER_TRANSITION_SECONDS = float(os.getenv("RENDER_TRANSITION_SECONDS", 0.5))
+# drawtext needs either a font file or a fontconfig installation to find a default font
+RENDER_FONT_FILE = os.getenv("RENDER_FONT_FILE")
+
+# "graph" renders everything in one filter graph, "segments" renders edits in parallel and joins them
+RENDER_MODE = os.getenv("RENDER_MODE", "graph")
+# Most ffmpeg processes encoding segments in parallel; each beyond the first needs a free CPU stage slot
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", os.cpu_count() or 1))
+# Rendered segments are kept here so unchanged edits are not encoded again on a re-prompt
+SEGMENT_CACHE_DIR = os.getenv("SEGMENT_CACHE_DIR", "/tmp/craite_segments")
+# Least recently used segments are deleted once the cache grows beyond this size
+SEGMENT_CACHE_MAX_BYTES = int(os.getenv("SEGMENT_CACHE_MAX_BYTES", 5 * 1024 ** 3))
+# Segments used this recently are never evicted, so a concurrent render can still join them
+SEGMENT_CACHE_PIN_SECONDS = int(os.getenv("SEGMENT_CACHE_PIN_SECONDS", 900))
+
+# Transition names used by the app mapped to ffmpeg xfade transitions
+XFADE_TRANSITIONS = {
+    'fade': 'fade',
+    'cross-fade': 'dissolve',
+    'crossfade': 'dissolve',
+    'dissolve': 'dissolve',
+    'slide': 'slideleft',
+    'wipe': 'wipeleft',
+}
+
+
+def _numbers(adjustment):
+    # Adjustments arrive as a number, a list of numbers or occasionally a numeric string
+    values = adjustment if isinstance(adjustment, list) else [adjustment]
+    numbers = []
+    for value in values:
+        try:
+            numbers.append(float(value))
+        except (TypeError, ValueError):
+            pass
+    return numbers
+
+
+def _clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+def _ffmpeg_color(color, default="white"):
+    """Converts '#RRGGBB' or Android '#AARRGGBB' colours to ffmpeg's '0xRRGGBB@alpha'."""
+    if not isinstance(color, str) or not color.startswith('#'):
+        return default
+    hex_digits = color[1:]
+    try:
+        if len(hex_digits) == 8:
+            alpha = int(hex_digits[:2], 16) / 255
+            return f"0x{hex_digits[2:]}@{alpha:.2f}"
+        if len(hex_digits) == 6:
+            int(hex_digits, 16)
+            return f"0x{hex_digits}"
+    except ValueError:
+        pass
+    return default
+
+
+class Renderer:
+
+    # Function to apply the effects of one edit to its video stream
+    @staticmethod
+    def apply_effects(stream, effects, width, height, fps):
+        eq = {}
+        for effect in effects:
+            name = effect.get('name')
+            values = _numbers(effect.get('adjustment'))
+
+            if name == 'brightness' and values:
+                eq['brightness'] = _clamp(values[0], -1, 1)
+            elif name == 'contrast' and values:
+                eq['contrast'] = _clamp(1 + values[0], 0, 2)
+            elif name == 'saturation' and values:
+                # 0 means unchanged in the app, -1 is greyscale
+                eq['saturation'] = _clamp(1 + values[0], 0, 3)
+            elif name == 'vignette':
+                outer = _clamp(values[0], 0, 1) if values else 0.5
+                stream = stream.filter('vignette', angle=f"{outer * math.pi / 2:.4f}")
+            elif name == 'fisheye':
+                strength = _clamp(values[0], 0, 1) if values else 0.5
+                # Negative coefficients give barrel distortion
+                stream = stream.filter('lenscorrection', k1=-0.5 * strength, k2=-0.2 * strength)
+            elif name == 'colorTint':
+                tint = effect.get('adjustment')
+                tint = tint[0] if isinstance(tint, list) and tint else tint
+                color = _ffmpeg_color(tint, '0xFFFFFF').split('@')[0]
+                stream = stream.drawbox(0, 0, 'iw', 'ih', color=f"{color}@0.25", thickness='fill')
+            elif name == 'rotate' and values:
+                stream = stream.filter('rotate', angle=f"{values[0] * math.pi / 180:.6f}", fillcolor='black')
+            elif name in ('zoomIn', 'zoomOut') and values:
+                factor = values[0] if values[0] > 0 else 1
+                frames = max(1, int((values[1] if len(values) > 1 else 1) * fps))
+                if name == 'zoomIn':
+                    target = max(factor, 1)
+                    zoom = f"min(1+{target - 1:.4f}*on/{frames},{target:.4f})"
+                else:
+                    # zoompan cannot zoom below 1, so zooming out starts magnified and returns to 1
+                    start = max(1 / factor if factor < 1 else factor, 1)
+                    zoom = f"max({start:.4f}-{start - 1:.4f}*on/{frames},1)"
+                stream = stream.filter('zoompan', z=zoom, d=1, x='iw/2-(iw/zoom/2)', y='ih/2-(ih/zoom/2)',
+                                       s=f"{width}x{height}", fps=fps)
+
+        if eq:
+            stream = stream.filter('eq', **eq)
+        return stream
+
+    # Function to draw the text overlays of one edit on its video stream
+    @staticmethod
+    def apply_text(stream, texts, height):
+        for i, text in enumerate(texts):
+            if not text.get('text'):
+                continue
+            try:
+                font_size = int(float(text.get('font_size') or 24))
+            except (TypeError, ValueError):
+                font_size = 24
+            options = {
+                'text': text['text'],
+                'expansion': 'none',
+                # Sizes are given for a phone screen; scale them to the output height
+                'fontsize': max(8, int(font_size * height / 640)),
+                'fontcolor': _ffmpeg_color(text.get('text_color')),
+                'box': 1,
+                'boxcolor': _ffmpeg_color(text.get('background_color'), '0x000000@0.5'),
+                'boxborderw': 10,
+                'x': '(w-text_w)/2',
+                # Stack multiple overlays upwards from the bottom of the frame
+                'y': f"h-text_h-{40 + i * int(font_size * height / 640 * 1.8)}",
+            }
+            if RENDER_FONT_FILE:
+                options['fontfile'] = RENDER_FONT_FILE
+            stream = stream.drawtext(**options)
+        return stream
+
+    # Function to build the trimmed, normalized and edited streams of one edit
+    @staticmethod
+    def segment_streams(edit, source_path, probe, width, height, fps):
+        start = max(float(edit['start_time']), 0)
+        duration = max(float(edit['end_time']) - start, 1 / fps)
+
+        # Seek on the input so the decoder skips straight to the segment
+        source = ffmpeg.input(source_path, ss=start)
+        video = (
+            source.video
+            .trim(duration=duration)
+            .setpts('PTS-STARTPTS')
+            .filter('scale', width, height, force_original_aspect_ratio='decrease')
+            .filter('pad', width, height, '(ow-iw)/2', '(oh-ih)/2')
+            .filter('setsar', 1)
+            .filter('fps', fps=fps)
+        )
+        video = Renderer.apply_effects(video, edit.get('effects') or [], width, height, fps)
+        video = Renderer.apply_text(video, edit.get('text') or [], height)
+        # concat outputs a microsecond time base and xfade needs both inputs to match
+        video = video.filter('format', 'yuv420p').filter('settb', 'AVTB')
+
+        if probe['has_audio']:
+            audio = (
+                source.audio
+                .filter('atrim', duration=duration)
+                .filter('asetpts', 'PTS-STARTPTS')
+                .filter('aresample', 44100)
+                .filter('aformat', channel_layouts='stereo')
+            )
+        else:
+            audio = ffmpeg.input('anullsrc=channel_layout=stereo:sample_rate=44100', f='lavfi', t=duration).audio
+        return video, audio, duration
+
+    @staticmethod
+    def output_geometry(probes):
+        if RENDER_WIDTH and RENDER_HEIGHT:
+            return RENDER_WIDTH, RENDER_HEIGHT
+        probe = probes[0]
+        width, height = probe['width'], probe['height']
+        if probe['rotation'] in (90, 270):
+            width, height = height, width
+        return width - width % 2, height - height % 2
+
+    # Function to compile an edit list into one ffmpeg filter graph and encode it in one pass
+    @staticmethod
+    def render(video_edits, audio_edits, output_path, audio_path=None, video_paths=None):
+        """Renders the Gemini edit settings into a single video file.
+
+        Every edit becomes a trim/setpts chain with eq, vignette, rotate, zoompan
+        and drawtext filters. Edits are joined with xfade/acrossfade where a
+        transition is requested and with concat otherwise, all in one filter
+        graph, so each source frame is decoded once and encoded once with no
+        intermediate files.
+
+        Args:
+            video_edits: The 'video_edits' list built by Gemini.prompt_gemini_api.
+            audio_edits: The 'audio_edits' dictionary; used to trim audio_path.
+            output_path: Where to write the rendered video.
+            audio_path: Optional music track that replaces the clips' own sound.
+            video_paths: The local paths of the clips; each video_name must name
+                one of them (matched by file name).
+
+        Returns:
+            The output path.
+        """
+        edits, sources, probes, width, height = Renderer.prepare(video_edits, video_paths)
+        fps = RENDER_FPS
+
+        video, audio, total = None, None, 0.0
+        previous_transition = ""
+        for edit, source in zip(edits, sources):
+            segment_video, segment_audio, duration = Renderer.segment_streams(
+                edit, source, probes[source], width, height, fps)
+
+            if video is None:
+                video, audio, total = segment_video, segment_audio, duration
+            elif previous_transition:
+                fade = min(RENDER_TRANSITION_SECONDS, total / 2, duration / 2)
+                video = ffmpeg.filter([video, segment_video], 'xfade', transition=previous_transition,
+                                      duration=fade, offset=total - fade)
+                audio = ffmpeg.filter([audio, segment_audio], 'acrossfade', d=fade)
+                total += duration - fade
+            else:
+                joined = ffmpeg.concat(video, audio, segment_video, segment_audio, v=1, a=1).node
+                video, audio = joined[0], joined[1]
+                total += duration
+
+            transition = (edit.get('transition') or "").strip().lower()
+            previous_transition = XFADE_TRANSITIONS.get(transition, 'fade') if transition else ""
+
+        music = Renderer.music_stream(audio_path, audio_edits, total)
+        if music is not None:
+            audio = music
+
+        (
+            ffmpeg
+            .output(video, audio, output_path, vcodec='libx264', preset='veryfast', crf=RENDER_CRF,
+                    pix_fmt='yuv420p', acodec='aac', movflags='+faststart', t=total)
+            .overwrite_output()
+            .run(quiet=True)
+        )
+        print(f"Rendered {len(edits)} edits ({total:.2f}s) to: {output_path}")
+        return output_path
+
+    # Function to render every edit as its own cached segment in parallel and join them with stream copy
+    @staticmethod
+    def render_segments(video_edits, audio_edits, output_path, audio_path=None, video_paths=None,
+                        workers=RENDER_WORKERS, cache_dir=SEGMENT_CACHE_DIR):
+        """Renders the Gemini edit settings as independent segments joined by stream copy.
+
+        Every edit is encoded by its own ffmpeg process, up to `workers` at once,
+        with identical encoder settings, so the segments can be joined by the
+        concat demuxer without re-encoding.
+        Segments are cached under a hash of the source content, the edit's
+        trim, effects, text and fades and the output settings; when a re-prompt
+        changes only a few edits, only those are encoded again.
+
+        Segments cannot overlap when joined by stream copy, so a transition is
+        rendered as a fade out of one segment and a fade in of the next.
+
+        Args:
+            Same as render, plus:
+            workers: Most segments encoded at once; each beyond the first needs a free CPU stage slot.
+            cache_dir: Directory of the segment cache.
+
+        Returns:
+            The output path.
+        """
+        edits, sources, probes, width, height = Renderer.prepare(video_edits, video_paths)
+        fps = RENDER_FPS
+        os.makedirs(cache_dir, exist_ok=True)
+        source_hashes = {path: helpers.file_sha256(path) for path in probes}
+
+        jobs, segment_paths, total = {}, [], 0.0
+        for i, (edit, source) in enumerate(zip(edits, sources)):
+            duration = max(float(edit['end_time']) - max(float(edit['start_time']), 0), 1 / fps)
+            fade = min(RENDER_TRANSITION_SECONDS / 2, duration / 2)
+            fade_in = fade if i > 0 and (edits[i - 1].get('transition') or "").strip() else 0
+            fade_out = fade if i < len(edits) - 1 and (edit.get('transition') or "").strip() else 0
+
+            key = Renderer.segment_key(edit, source_hashes[source], width, height, fps, fade_in, fade_out)
+            segment_path = os.path.join(cache_dir, f"{key}.mp4")
+            if os.path.exists(segment_path):
+                # Refresh the modification time so eviction keeps recently used segments
+                os.utime(segment_path)
+            else:
+                jobs.setdefault(segment_path, (edit, source, probes[source], width, height, fps, fade_in, fade_out))
+            segment_paths.append(segment_path)
+            total += duration
+
+        print(f"Rendering {len(jobs)} of {len(edits)} segments, {len(edits) - len(jobs)} reused from cache")
+        if jobs:
+            # The render stage holds one CPU slot; further encodes only run in slots that are free.
+            # Each encode is an ffmpeg child process, so threads are enough to run them side by side
+            # and the multithreaded web worker is never forked
+            with limits.extra_slots(limits.CPU, min(workers, len(jobs)) - 1) as extra, \
+                    concurrent.futures.ThreadPoolExecutor(max_workers=1 + extra,
+                                                          thread_name_prefix="render") as executor:
+                futures = [executor.submit(Renderer.render_segment, *args, segment_path)
+                           for segment_path, args in jobs.items()]
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+
+        music = Renderer.music_stream(audio_path, audio_edits, total)
+        if music is None:
+            Video.stream_copy_concat(segment_paths, output_path)
+        else:
+            joined_path = f"{output_path}.joined.mp4"
+            Video.stream_copy_concat(segment_paths, joined_path)
+            try:
+                # Only the soundtrack is encoded again; the video stream is copied
+                (
+                    ffmpeg
+                    .output(ffmpeg.input(joined_path).video, music, output_path, vcodec='copy', acodec='aac',
+                            movflags='+faststart', t=total)
+                    .overwrite_output()
+                    .run(quiet=True)
+                )
+            finally:
+                os.remove(joined_path)
+
+        Renderer.prune_segment_cache(cache_dir)
+        print(f"Rendered {len(edits)} segments ({total:.2f}s) to: {output_path}")
+        return output_path
+
+    # Function to encode a single edit as a self-contained segment
+    @staticmethod
+    def render_segment(edit, source_path, probe, width, height, fps, fade_in, fade_out, output_path):
+        video, audio, duration = Renderer.segment_streams(edit, source_path, probe, width, height, fps)
+        if fade_in:
+            video = video.filter('fade', type='in', start_time=0, duration=fade_in)
+            audio = audio.filter('afade', type='in', start_time=0, duration=fade_in)
+        if fade_out:
+            video = video.filter('fade', type='out', start_time=duration - fade_out, duration=fade_out)
+            audio = audio.filter('afade', type='out', start_time=duration - fade_out, duration=fade_out)
+
+        # Write next to the final path and rename, so concurrent renders never see a partial segment
+        partial_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.partial.mp4"
+        (
+            ffmpeg
+            .output(video, audio, partial_path, vcodec='libx264', preset='veryfast', crf=RENDER_CRF,
+                    pix_fmt='yuv420p', r=fps, acodec='aac', ar=44100, ac=2, t=duration)
+            .overwrite_output()
+            .run(quiet=True)
+        )
+        os.replace(partial_path, output_path)
+        return output_path
+
+    @staticmethod
+    def segment_key(edit, source_hash, width, height, fps, fade_in, fade_out):
+        settings = {
+            'source': source_hash,
+            'start_time': float(edit['start_time']),
+            'end_time': float(edit['end_time']),
+            'effects': edit.get('effects') or [],
+            'text': edit.get('text') or [],
+            'fades': [fade_in, fade_out],
+            'output': [width, height, fps, RENDER_CRF, RENDER_FONT_FILE],
+        }
+        return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+    # Function to delete the least recently used segments once the cache is over its size limit
+    @staticmethod
+    def prune_segment_cache(cache_dir=SEGMENT_CACHE_DIR, max_bytes=SEGMENT_CACHE_MAX_BYTES,
+                            pin_seconds=SEGMENT_CACHE_PIN_SECONDS):
+        entries = []
+        for name in os.listdir(cache_dir):
+            if name.endswith('.partial.mp4'):
+                continue
+            path = os.path.join(cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            if now - mtime < pin_seconds:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    # Function to resolve the sources of an edit list and pick the output geometry
+    @staticmethod
+    def prepare(video_edits, video_paths=None):
+        if not video_edits:
+            raise ValueError("Nothing to render: the edit list is empty")
+
+        edits = sorted(video_edits, key=lambda edit: edit['id'])
+        sources = [Renderer.resolve_source(edit['video_name'], video_paths) for edit in edits]
+        unique_sources = list(dict.fromkeys(sources))
+        probes = dict(zip(unique_sources, Video.probe_videos(unique_sources)))
+        width, height = Renderer.output_geometry([probes[sources[0]]])
+        return edits, sources, probes, width, height
+
+    @staticmethod
+    def music_stream(audio_path, audio_edits, total):
+        if not audio_path:
+            return None
+        start = _numbers((audio_edits or {}).get('start_time'))
+        end = _numbers((audio_edits or {}).get('end_time'))
+        start = start[0] if start else 0
+        music = ffmpeg.input(audio_path, ss=start).audio
+        if end and end[0] > start:
+            music = music.filter('atrim', duration=end[0] - start)
+        # Pad short tracks with silence and cut long ones to the video length
+        return (
+            music
+            .filter('asetpts', 'PTS-STARTPTS')
+            .filter('aresample', 44100)
+            .filter('aformat', channel_layouts='stereo')
+            .filter('apad')
+            .filter('atrim', duration=total)
+        )
+
+    # Function to map a video_name from the model's output onto one of the request's clips
+    @staticmethod
+    def resolve_source(video_name, video_paths=None):
+        """Returns the clip in video_paths with the same file name as video_name.
+
+        video_name comes from the model's output, so it is never used as a
+        path itself; anything that is not one of the request's clips is rejected.
+
+        Raises:
+            ValueError: If video_name names none of the clips.
+        """
+        by_basename = {os.path.basename(path): path for path in (video_paths or [])}
+        source = by_basename.get(os.path.basename(str(video_name)))
+        if source is None:
+            raise ValueError(f"Edit refers to a video that is not part of the project: {video_name}")
+        return source
@@ -0,0 +1,274 @@
+import os
+import re
+import json
+import helpers
+import metrics
+
+
+# Maximum number of text-only follow-up calls made to fix invalid parts of one response
+DECODER_MAX_REPAIRS = int(os.getenv("DECODER_MAX_REPAIRS", 3))
+
+# Schemas mirroring helpers.return_video_edit, return_effect, return_text and return_audio_edits
+EFFECT_SCHEMA = {'name': (str,), 'adjustment': (int, float, str, list)}
+TEXT_SCHEMA = {'text': (str,), 'font_size': (int, float), 'text_color': (str,), 'background_color': (str,)}
+VIDEO_EDIT_SCHEMA = {
+    'id': (int,),
+    'video_name': (str,),
+    'start_time': (int, float),
+    'end_time': (int, float),
+    'effects': (list,),
+    'text': (list,),
+    'transition': (str,),
+}
+AUDIO_EDITS_SCHEMA = {'start_time': (int, float, str), 'end_time': (int, float, str)}
+
+EFFECT_NAMES = {'brightness', 'contrast', 'saturation', 'vignette', 'fisheye', 'colorTint', 'rotate', 'zoomIn', 'zoomOut'}
+
+# Number of repairs, re-asks and dropped edits while decoding responses
+decoder_events = metrics.Counter(
+    "gemini_decoder_events_total",
+    "Repairs, re-asks and dropped edits while decoding Gemini responses",
+    labelnames=("event",),
+)
+
+_FENCE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+_NUMBER_SUFFIX = re.compile(r"(?<=\d)[lLfFdD]\b")
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+
+
+class ResponseDecodeError(ValueError):
+    """Raised when a response cannot be turned into valid edit settings."""
+
+
+def _outside_strings(text, transform):
+    # Applies transform to every run of text that is not inside a JSON string
+    parts, start, in_string, escaped = [], 0, False, False
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+                parts.append(text[start:i + 1])
+                start = i + 1
+        elif char == '"':
+            parts.append(transform(text[start:i]))
+            start, in_string = i, True
+    parts.append(text[start:] if in_string else transform(text[start:]))
+    return "".join(parts)
+
+
+def _close_truncated(text):
+    # Cuts a truncated document back to its last complete member and closes every open bracket
+    stack, in_string, escaped = [], False, False
+    cut_points = []
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append(char)
+            cut_points.append((i + 1, list(stack)))
+        elif char in '}]':
+            if stack:
+                stack.pop()
+            if not stack:
+                # The top-level value is complete; anything after it is prose
+                return text[:i + 1]
+            cut_points.append((i + 1, list(stack)))
+        elif char == ',':
+            cut_points.append((i, list(stack)))
+
+    if not cut_points:
+        return text
+
+    cut, open_brackets = cut_points[-1]
+    closing = "".join('}' if bracket == '{' else ']' for bracket in reversed(open_brackets))
+    return text[:cut].rstrip().rstrip(',') + closing
+
+
+# Function to fix the defects models commonly produce in JSON output
+def repair_json_text(text):
+    """Strips code fences and surrounding prose, removes Java-style number suffixes
+    (1L, 2.0f) and trailing commas, and closes a truncated document."""
+    text = _FENCE.sub("", text.strip())
+    start = text.find('{')
+    if start > 0:
+        text = text[start:]
+    text = _outside_strings(text, lambda chunk: _TRAILING_COMMA.sub(r"\1", _NUMBER_SUFFIX.sub("", chunk)))
+    return _close_truncated(text)
+
+
+def _coerce_number(value):
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    return value
+
+
+def _type_errors(obj, schema, path):
+    if not isinstance(obj, dict):
+        return [f"{path} must be an object"]
+    errors = []
+    for field, types in schema.items():
+        if field not in obj:
+            errors.append(f"{path}.{field} is missing")
+        elif isinstance(obj[field], bool) or not isinstance(obj[field], types):
+            errors.append(f"{path}.{field} must be of type {'/'.join(t.__name__ for t in types)}")
+    return errors
+
+
+def _normalize_video_edit(edit, video_names):
+    # Fixes defects that do not need the model: numeric strings, null lists, basenames, unknown effects
+    if not isinstance(edit, dict):
+        return edit
+    edit = dict(edit)
+    for field in ('start_time', 'end_time'):
+        if field in edit:
+            edit[field] = _coerce_number(edit[field])
+    if isinstance(edit.get('id'), (str, float)):
+        number = _coerce_number(edit['id'])
+        if isinstance(number, float) and number.is_integer():
+            edit['id'] = int(number)
+    for field in ('effects', 'text'):
+        if edit.get(field, []) is None:
+            edit[field] = []
+    if edit.get('transition', "") is None:
+        edit['transition'] = ""
+    if video_names and isinstance(edit.get('video_name'), str) and edit['video_name'] not in video_names:
+        by_basename = {os.path.basename(name): name for name in video_names}
+        if os.path.basename(edit['video_name']) in by_basename:
+            edit['video_name'] = by_basename[os.path.basename(edit['video_name'])]
+    if isinstance(edit.get('effects'), list):
+        effects = [effect for effect in edit['effects']
+                   if not isinstance(effect, dict) or effect.get('name') in EFFECT_NAMES]
+        if len(effects) != len(edit['effects']):
+            decoder_events.inc(len(edit['effects']) - len(effects), event="unknown_effect_dropped")
+        edit['effects'] = effects
+    return edit
+
+
+# Function to list everything wrong with one video edit
+def validate_video_edit(edit, video_names=None):
+    errors = _type_errors(edit, VIDEO_EDIT_SCHEMA, "video_edit")
+    if errors:
+        return errors
+    for i, effect in enumerate(edit['effects']):
+        errors.extend(_type_errors(effect, EFFECT_SCHEMA, f"video_edit.effects[{i}]"))
+    for i, text in enumerate(edit['text']):
+        errors.extend(_type_errors(text, TEXT_SCHEMA, f"video_edit.text[{i}]"))
+    if not 0 <= edit['start_time'] < edit['end_time']:
+        errors.append("video_edit.start_time must be at least 0 and lower than end_time")
+    if video_names and edit['video_name'] not in video_names:
+        errors.append(f"video_edit.video_name must be one of {sorted(video_names)}")
+    return errors
+
+
+def _ask_for_fix(model, fragment, errors):
+    # Text-only call, so the media does not have to be processed again
+    prompt = (
+        "The following JSON fragment is part of a video edit response but it is invalid.\n"
+        f"Problems: {'; '.join(errors)}\n"
+        f"Fragment: {fragment}\n"
+        "Return only the corrected JSON fragment with the same meaning, keeping every field of the original "
+        "structure (id, video_name, start_time, end_time, effects, text, transition for a video edit)."
+    )
+    response = model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
+    return repair_json_text(response.text)
+
+
+# Function to turn raw model output into validated edit settings
+def decode_response(text, model=None, video_names=None, max_repairs=DECODER_MAX_REPAIRS):
+    """Parses, repairs and validates a Gemini edit-settings response.
+
+    Cheap local repairs are tried first. Whatever is still invalid (the whole
+    document if it cannot be parsed, otherwise only the offending video edits)
+    is sent back to the model in a text-only call, at most max_repairs times.
+    Video edits that stay invalid are dropped.
+
+    Args:
+        text: The raw response text.
+        model: The genai.GenerativeModel used for re-asks, or None to disable them.
+        video_names: The keys of the video_durations map, used to validate video_name.
+        max_repairs: The re-ask budget for this response.
+
+    Returns:
+        A dictionary with 'video_edits' built by helpers.return_video_edit and 'audio_edits'.
+
+    Raises:
+        ResponseDecodeError: If no valid video edit could be recovered.
+    """
+    repairs_left = max_repairs
+    try:
+        document = json.loads(text)
+    except ValueError:
+        repaired = repair_json_text(text)
+        decoder_events.inc(event="local_repair")
+        try:
+            document = json.loads(repaired)
+        except ValueError as e:
+            document = None
+            while document is None and model is not None and repairs_left > 0:
+                repairs_left -= 1
+                decoder_events.inc(event="reask_document")
+                try:
+                    document = json.loads(_ask_for_fix(model, repaired, [f"not valid JSON: {e}"]))
+                except ValueError as retry_error:
+                    e = retry_error
+            if document is None:
+                raise ResponseDecodeError(f"Response is not valid JSON: {e}")
+
+    if not isinstance(document, dict) or not isinstance(document.get('video_edits'), list):
+        raise ResponseDecodeError("Response has no video_edits list")
+
+    video_edits = []
+    for edit in document['video_edits']:
+        edit = _normalize_video_edit(edit, video_names)
+        errors = validate_video_edit(edit, video_names)
+        while errors and model is not None and repairs_left > 0:
+            repairs_left -= 1
+            decoder_events.inc(event="reask_edit")
+            try:
+                edit = _normalize_video_edit(json.loads(_ask_for_fix(model, json.dumps(edit), errors)), video_names)
+                errors = validate_video_edit(edit, video_names)
+            except ValueError as e:
+                errors = [f"not valid JSON: {e}"]
+        if errors:
+            decoder_events.inc(event="edit_dropped")
+            print(f"Dropping invalid video edit {edit}: {errors}")
+            continue
+        video_edits.append(helpers.video_edit_from_json(edit))
+
+    if not video_edits:
+        raise ResponseDecodeError("Response contains no valid video edits")
+
+    audio_edits = helpers.return_audio_edits("", "")
+    candidate = document.get('audio_edits')
+    if isinstance(candidate, dict):
+        candidate = {field: _coerce_number(candidate.get(field)) for field in AUDIO_EDITS_SCHEMA}
+        if not _type_errors(candidate, AUDIO_EDITS_SCHEMA, "audio_edits"):
+            audio_edits = helpers.return_audio_edits(candidate['start_time'], candidate['end_time'])
+
+    return {
+        'video_edits': video_edits,
+        'audio_edits': audio_edits,
+    }
+
+
+# Function to decode a single streamed video edit, applying local repairs only
+def decode_video_edit(fragment, video_names=None):
+    edit = _normalize_video_edit(json.loads(repair_json_text(fragment)), video_names)
+    errors = validate_video_edit(edit, video_names)
+    if errors:
+        raise ValueError("; ".join(errors))
+    return helpers.video_edit_from_json(edit)
@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import tempfile
+import threading
+import unicodedata
+from collections import OrderedDict
+import metrics
+import prompts
+import async_runtime
+
+
+# Settings for memoizing Gemini edit settings of identical requests
+RESULT_CACHE_BACKEND = os.getenv("RESULT_CACHE_BACKEND", "memory")
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 512))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "craite_results"))
+RESULT_CACHE_COLLECTION = os.getenv("RESULT_CACHE_COLLECTION", "gemini_result_cache")
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 7 * 24 * 3600))
+
+# Hits, misses and requests that waited on an identical request in flight
+result_cache_events = metrics.Counter(
+    "gemini_result_cache_total",
+    "Lookups of memoized Gemini responses by result",
+    labelnames=("result",),
+)
+
+
+# Function to make prompts that differ only in whitespace, case or Unicode form share a key
+def normalize_prompt(text):
+    return " ".join(unicodedata.normalize("NFC", text).split()).casefold()
+
+
+# Function to build the memoization key of a request
+def result_key(media, gemini_prompt, model_name, generation_config, input_mode="video", audio_mode="upload",
+               analysis_mode="single"):
+    """Hashes everything that determines the edit settings of a request.
+
+    Args:
+        media: (file name, content hash) pairs of the clips in order, followed by the audio.
+        gemini_prompt: The user's prompt.
+        model_name: The Gemini model the request goes to.
+        generation_config: The model's generation config.
+        input_mode: How the clips are shown to the model ("video" or "keyframes").
+        audio_mode: How the audio is shown to the model and whether its edits
+            are snapped to the beat (see main.audio_mode).
+        analysis_mode: Whether long projects are analyzed in one call or in
+            chunks, and how chunks are reduced (see main.analysis_mode).
+    """
+    content = {
+        'media': [list(item) for item in media],
+        'prompt': normalize_prompt(gemini_prompt),
+        'model': model_name,
+        'generation_config': generation_config,
+        'input_mode': input_mode,
+        'audio_mode': audio_mode,
+        'analysis_mode': analysis_mode,
+        # New instructions produce different edits for the same request
+        'template': hashlib.sha256((prompts.EDIT_INSTRUCTIONS + prompts.REQUEST_TEMPLATE.template +
+                                    prompts.KEYFRAME_REQUEST_TEMPLATE.template +
+                                    prompts.AUDIO_SUMMARY_TEMPLATE.template + prompts.MAP_TEMPLATE.template +
+                                    prompts.REDUCE_TEMPLATE.template).encode()).hexdigest(),
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# Function to point the video names of a memoized response at this request's local files
+def rebase_video_names(gemini_response, video_paths):
+    by_basename = {os.path.basename(path): path for path in video_paths}
+    video_edits = []
+    for edit in gemini_response['video_edits']:
+        edit = dict(edit)
+        edit['video_name'] = by_basename.get(os.path.basename(edit['video_name']), edit['video_name'])
+        video_edits.append(edit)
+    return {**gemini_response, 'video_edits': video_edits}
+
+
+class MemoryResultBackend:
+    """Least recently used entries held in this process."""
+
+    def __init__(self, max_entries=RESULT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class DiskResultBackend:
+    """One JSON file per entry, shared by every worker on the host."""
+
+    def __init__(self, directory=RESULT_CACHE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def put(self, key, entry):
+        temp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(temp_path, self._path(key))
+
+
+class FirestoreResultBackend:
+    """One document per entry in a Firestore collection, shared by every instance."""
+
+    def __init__(self, firestore_client, collection=RESULT_CACHE_COLLECTION):
+        self.collection = firestore_client.collection(collection)
+
+    def get(self, key):
+        snapshot = self.collection.document(key).get()
+        if not snapshot.exists:
+            return None
+        document = snapshot.to_dict()
+        # Responses are stored as JSON text because Firestore cannot hold nested arrays
+        return {'created_at': document['created_at'], 'value': json.loads(document['value'])}
+
+    def put(self, key, entry):
+        self.collection.document(key).set({'created_at': entry['created_at'], 'value': json.dumps(entry['value'])})
+
+
+class SingleFlight:
+    """Runs a function once per key at a time; concurrent callers share its outcome."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        """Returns a tuple of the function's result and whether it came from another caller."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result'], True
+
+        try:
+            call['result'] = function()
+            return call['result'], False
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+
+class ResultCache:
+    """Memoizes Gemini edit settings in front of Gemini.prompt_gemini_api."""
+
+    def __init__(self, backend, ttl=RESULT_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self._flights = SingleFlight()
+        # Computations in flight on the event loop, keyed like _flights
+        self._async_flights = {}
+
+    def get(self, key):
+        try:
+            entry = self.backend.get(key)
+        except Exception as e:
+            print(f"Result cache lookup failed: {e}")
+            return None
+        if entry is None or time.time() - entry['created_at'] > self.ttl:
+            return None
+        return entry['value']
+
+    def put(self, key, value):
+        try:
+            self.backend.put(key, {'created_at': time.time(), 'value': value})
+        except Exception as e:
+            print(f"Result cache write failed: {e}")
+
+    # Function to return a memoized response or compute it once for all concurrent identical requests
+    def get_or_compute(self, key, compute):
+        """Returns a tuple of the response and where it came from: "hit", "shared" or "miss".
+
+        compute is only called on a miss, and only by one of the concurrent
+        callers with the same key. A None response is not memoized.
+        """
+        value = self.get(key)
+        if value is not None:
+            result_cache_events.inc(result="hit")
+            return value, "hit"
+
+        def compute_and_store():
+            # Another request may have stored the response between our lookup and acquiring the flight
+            cached = self.get(key)
+            if cached is not None:
+                return cached, "hit"
+            computed = compute()
+            if computed is not None:
+                self.put(key, computed)
+            return computed, "miss"
+
+        (value, source), shared = self._flights.do(key, compute_and_store)
+        source = "shared" if shared else source
+        result_cache_events.inc(result=source)
+        return value, source
+
+
+    async def get_or_compute_async(self, key, compute):
+        """Like get_or_compute for a coroutine function.
+
+        Concurrent callers on the event loop share one computation. Backend
+        calls run on the asyncio I/O executor.
+        """
+        value = await async_runtime.run_io(self.get, key)
+        if value is not None:
+            result_cache_events.inc(result="hit")
+            return value, "hit"
+
+        flight = self._async_flights.get(key)
+        if flight is not None:
+            # Shielded, so a caller that gives up does not cancel the computation for the others
+            value = await asyncio.shield(flight)
+            result_cache_events.inc(result="shared")
+            return value, "shared"
+
+        flight = self._async_flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await compute()
+            if value is not None:
+                await async_runtime.run_io(self.put, key, value)
+            flight.set_result(value)
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except BaseException as e:
+            flight.set_exception(e)
+            # Marks the exception as retrieved when no other caller was waiting for it
+            flight.exception()
+            raise
+        finally:
+            del self._async_flights[key]
+        result_cache_events.inc(result="miss")
+        return value, "miss"
+
+
+# Function to build the result cache configured by the environment
+def create_result_cache(firestore_client=None, backend=RESULT_CACHE_BACKEND):
+    if backend == "none":
+        return None
+    if backend == "disk":
+        return ResultCache(DiskResultBackend())
+    if backend == "firestore":
+        return ResultCache(FirestoreResultBackend(firestore_client))
+    return ResultCache(MemoryResultBackend())
@@ -0,0 +1,28 @@
+from audio_analysis import snap_audio_edits
+
+ANALYSIS = {'beats': [0.5, 1.0, 1.5, 2.0, 2.5, 3.0], 'duration': 10.0}
+
+
+def test_start_moves_to_the_nearest_beat_and_length_is_kept():
+    snapped = snap_audio_edits({'start_time': 1.2, 'end_time': 5.2}, ANALYSIS)
+
+    assert snapped == {'start_time': 1.0, 'end_time': 5.0}
+
+
+def test_numeric_strings_are_snapped():
+    assert snap_audio_edits({'start_time': "2.4", 'end_time': "4.4"}, ANALYSIS) == {'start_time': 2.5, 'end_time': 4.5}
+
+
+def test_beats_that_would_run_past_the_track_are_not_used():
+    snapped = snap_audio_edits({'start_time': 2.9, 'end_time': 11.5}, ANALYSIS)
+
+    # Only starts up to 1.4 leave room for 8.6 seconds within the 10 second track
+    assert snapped == {'start_time': 1.0, 'end_time': 9.6}
+
+
+def test_unusable_edits_are_returned_unchanged():
+    for audio_edits in ({'start_time': "", 'end_time': ""}, {'start_time': 3, 'end_time': 1}, {}):
+        assert snap_audio_edits(audio_edits, ANALYSIS) is audio_edits
+
+    no_beats = {'start_time': 1.2, 'end_time': 5.2}
+    assert snap_audio_edits(no_beats, {'beats': [], 'duration': 10.0}) is no_beats
@@ -0,0 +1,68 @@
+import os
+import json
+
+import fakes
+import metrics
+from clip_store import ClipStore
+
+
+def make_bucket(tmp_path, sizes):
+    for name, size in sizes.items():
+        path = tmp_path / "bucket" / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * size)
+    return fakes.FakeBucket(str(tmp_path / "bucket"))
+
+
+def events(output, name):
+    return [record for record in map(json.loads, filter(None, output.splitlines())) if record['event'] == name]
+
+
+def test_sync_downloads_once_and_reports_every_download(tmp_path, capsys):
+    bucket = make_bucket(tmp_path, {"users/u/projects/p/videos/a.mp4": 1000, "users/u/projects/p/videos/b.mp4": 3000})
+    store = ClipStore(str(tmp_path / "store"))
+    blobs = bucket.list_blobs("users/u/projects/p/")
+    metrics.new_request_id("req-1")
+
+    paths, stats = store.sync(blobs, bucket)
+
+    assert [path.rsplit("/", 1)[-1] for path in paths] == ["a.mp4", "b.mp4"]
+    assert (stats['downloads'], stats['hits'], stats['bytes']) == (2, 0, 4000)
+    assert stats['throughput'] > 0
+    output = capsys.readouterr().out
+    downloads = events(output, "clip_download")
+    assert sorted((record['blob'], record['bytes']) for record in downloads) == [
+        ("users/u/projects/p/videos/a.mp4", 1000), ("users/u/projects/p/videos/b.mp4", 3000)]
+    assert {record['request_id'] for record in downloads} == {"req-1"}
+    assert events(output, "clip_store_sync")[0]['bytes'] == 4000
+
+    paths_again, stats = store.sync(blobs, bucket)
+
+    assert paths_again == paths
+    assert (stats['downloads'], stats['hits'], stats['bytes_saved']) == (0, 2, 4000)
+    assert events(capsys.readouterr().out, "clip_download") == []
+
+
+def test_leased_clips_stay_until_the_lease_is_released(tmp_path):
+    bucket = make_bucket(tmp_path, {"users/u/projects/p/videos/a.mp4": 1000, "users/u/projects/q/videos/b.mp4": 1000})
+    store = ClipStore(str(tmp_path / "store"), max_bytes=1500, pin_seconds=3600)
+
+    with store.leased() as lease:
+        (path,), _ = store.sync(bucket.list_blobs("users/u/projects/p/"), bucket, lease=lease)
+        with store.leased() as other_lease:
+            (other_path,), _ = store.sync(bucket.list_blobs("users/u/projects/q/"), bucket, lease=other_lease)
+            # Over the quota, but both clips are in use
+            assert os.path.exists(path) and os.path.exists(other_path)
+
+        # The older clip is still in use, so the released one goes instead
+        assert os.path.exists(path) and not os.path.exists(other_path)
+
+
+def test_pins_of_unreleased_leases_expire(tmp_path):
+    bucket = make_bucket(tmp_path, {"users/u/projects/p/videos/a.mp4": 1000, "users/u/projects/q/videos/b.mp4": 1000})
+    store = ClipStore(str(tmp_path / "store"), max_bytes=1500, pin_seconds=0)
+
+    (path,), _ = store.sync(bucket.list_blobs("users/u/projects/p/"), bucket, lease="worker-that-died")
+    store.sync(bucket.list_blobs("users/u/projects/q/"), bucket)
+
+    assert not os.path.exists(path)
@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+
+import fakes
+from context_cache import ContextCache, project_key
+
+
+class FakeCachedModel:
+    @staticmethod
+    def from_cached_content(cached_content, generation_config=None):
+        return cached_content.display_name
+
+
+def make_genai():
+    return SimpleNamespace(caching=fakes.FakeCaching(), GenerativeModel=FakeCachedModel)
+
+
+MODEL = SimpleNamespace(model_name="models/fake-gemini")
+MEDIA = [fakes.FakeFile("files/a", "clip0.mp4", "video/mp4", "ACTIVE")]
+
+
+def lookup(cache, project_id, media=MEDIA):
+    return cache.model_for("user", project_id, MODEL, media, {"clip0.mp4": [0, 10]})
+
+
+def test_other_workers_find_the_cached_content():
+    genai = make_genai()
+    first, second = ContextCache(genai), ContextCache(genai)
+
+    created, tokens = lookup(first, "p1")
+    found, _ = lookup(second, "p1")
+
+    assert found == created and tokens == 40000
+    assert genai.caching.create_calls == 1
+
+
+def test_one_list_call_answers_lookups_of_other_projects():
+    genai = make_genai()
+    cache = ContextCache(genai)
+
+    for project_id in ("p1", "p2", "p3"):
+        lookup(cache, project_id)
+    lookup(ContextCache(genai), "p1")
+
+    assert genai.caching.create_calls == 3
+    assert genai.caching.list_calls == 2
+
+
+def test_changed_clips_replace_the_cached_content():
+    genai = make_genai()
+    cache = ContextCache(genai)
+
+    lookup(cache, "p1")
+    lookup(cache, "p1", [fakes.FakeFile("files/b", "clip0.mp4", "video/mp4", "ACTIVE")])
+
+    assert len(list(genai.caching.list())) == 1
+    assert genai.caching.create_calls == 2
+
+
+def test_remembered_projects_and_locks_are_bounded():
+    genai = make_genai()
+    cache = ContextCache(genai, max_projects=2, list_seconds=0)
+
+    for project_id in ("p1", "p2", "p3"):
+        lookup(cache, project_id)
+    lookup(cache, "p2")
+    lookup(cache, "p4")
+
+    # p2 was used more recently than p3, so it is still remembered and needs no list call
+    assert list(cache._entries) == [project_key("user", "p2"), project_key("user", "p4")]
+    assert not cache._locks
+    listed = genai.caching.list_calls
+    lookup(cache, "p2")
+    assert genai.caching.list_calls == listed
@@ -0,0 +1,60 @@
+import json
+
+from edit_stream import IncrementalEditParser
+
+
+def edit(edit_id, video_name="a.mp4", text="Hi"):
+    return {'id': edit_id, 'video_name': video_name, 'start_time': 0, 'end_time': 2, 'effects': [],
+            'text': [{'text': text, 'font_size': 24, 'text_color': 'white', 'background_color': 'black'}],
+            'transition': 'fade'}
+
+
+def feed_in_chunks(parser, text, size):
+    batches = [parser.feed(text[i:i + size]) for i in range(0, len(text), size)]
+    return [edit for batch in batches for edit in batch]
+
+
+def test_edits_are_returned_as_soon_as_they_close():
+    parser = IncrementalEditParser()
+    text = json.dumps({'video_edits': [edit(1), edit(2)]})
+    first_end = text.index('}]', text.index('"transition"')) + 2
+
+    assert [e['id'] for e in parser.feed(text[:first_end])] == [1]
+    assert [e['id'] for e in parser.feed(text[first_end:])] == [2]
+
+
+def test_any_chunking_gives_the_same_edits():
+    text = "```json\n" + json.dumps({'video_edits': [edit(1), edit(2), edit(3)],
+                                     'audio_edits': {'start_time': 0, 'end_time': 10}}) + "\n```"
+
+    for size in (1, 7, 64, len(text)):
+        assert [e['id'] for e in feed_in_chunks(IncrementalEditParser(), text, size)] == [1, 2, 3]
+
+
+def test_braces_and_quotes_inside_strings_are_ignored():
+    text = json.dumps({'video_edits': [edit(1, text='a "quoted" {brace} ] and \\ slash'), edit(2)]})
+
+    edits = feed_in_chunks(IncrementalEditParser(), text, 5)
+
+    assert [e['id'] for e in edits] == [1, 2]
+    assert edits[0]['text'][0]['text'] == 'a "quoted" {brace} ] and \\ slash'
+
+
+def test_objects_outside_the_edits_array_are_skipped():
+    text = json.dumps({'notes': [{'id': 9}], 'video_edits': [edit(1)], 'audio_edits': {'start_time': 0}})
+
+    assert [e['id'] for e in IncrementalEditParser().feed(text)] == [1]
+
+
+def test_malformed_edit_is_skipped():
+    text = json.dumps({'video_edits': [{'id': 1}, edit(2)]})
+
+    assert [e['id'] for e in IncrementalEditParser().feed(text)] == [2]
+
+
+def test_video_names_are_resolved():
+    parser = IncrementalEditParser(video_names={"users/u/projects/p/videos/a.mp4": (0, 2)})
+
+    edits = parser.feed(json.dumps({'video_edits': [edit(1, video_name="a.mp4")]}))
+
+    assert edits[0]['video_name'] == "users/u/projects/p/videos/a.mp4"
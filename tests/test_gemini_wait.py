@@ -0,0 +1,48 @@
+import pytest
+
+import fakes
+from gemini import Gemini
+
+
+@pytest.fixture
+def upload(tmp_path):
+    def upload(genai, name):
+        path = tmp_path / name
+        path.write_bytes(b"media")
+        return genai.upload_file(str(path), display_name=name)
+    return upload
+
+
+def test_waits_for_every_file_and_keeps_their_order(upload):
+    genai = fakes.FakeGenai(processing_seconds=0.2)
+    video, audio = upload(genai, "video.mp4"), upload(genai, "audio.mp3")
+
+    ready = Gemini.wait_for_files_active([video, None, audio], genai, timeout=5)
+
+    assert [file and file.name for file in ready] == [video.name, None, audio.name]
+    assert all(file.state.name == "ACTIVE" for file in ready if file is not None)
+
+
+def test_active_file_is_not_polled(upload):
+    genai = fakes.FakeGenai(processing_seconds=0)
+    file = upload(genai, "video.mp4")
+    file.state = fakes.FakeState("ACTIVE")
+
+    assert Gemini.wait_for_file_active(file, genai, timeout=5) is file
+    assert genai.get_file_calls == 0
+
+
+def test_failed_file_raises(upload):
+    genai = fakes.FakeGenai(processing_seconds=0.1, failing_files=["video.mp4"])
+    file = upload(genai, "video.mp4")
+
+    with pytest.raises(ValueError, match="FAILED"):
+        Gemini.wait_for_file_active(file, genai, timeout=5, initial_interval=0.05)
+
+
+def test_files_share_one_deadline(upload):
+    genai = fakes.FakeGenai(processing_seconds=60)
+    files = [upload(genai, "video.mp4"), upload(genai, "audio.mp3")]
+
+    with pytest.raises(TimeoutError):
+        Gemini.wait_for_files_active(files, genai, timeout=0.3)
@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("firebase_admin")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+import jobs
+import loadtest
+import main
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    loadtest.install_fakes(main, str(tmp_path / "bucket"), 0, 0, 0)
+    monkeypatch.setattr(main, "ASYNC_PIPELINE", False)
+    monkeypatch.setattr(main, "run_pipeline", lambda user_id, project_id, prompt_id, gemini_prompt, render:
+                        {'gemini_response': {'video_edits': [], 'prompt': gemini_prompt}})
+    monkeypatch.setattr(main, "job_manager", jobs.JobManager(workers=1, on_status=main.store_job_status))
+    return main.app.test_client()
+
+
+def submit(client):
+    response = client.post('/jobs', json={'user_id': "alice", 'project_id': "p0", 'prompt_id': "pr0",
+                                          'gemini_prompt': "Make a highlight reel"})
+    assert response.status_code == 202
+    return response.get_json()
+
+
+def poll_result(client, job_id, token, timeout=5):
+    deadline = time.monotonic() + timeout
+    while True:
+        response = client.get(f'/jobs/{job_id}/result', headers={'X-Job-Token': token})
+        if response.status_code != 202 or time.monotonic() > deadline:
+            return response
+        time.sleep(0.01)
+
+
+def test_submitter_reads_the_result_with_its_token(client):
+    job = submit(client)
+
+    response = poll_result(client, job['job_id'], job['job_token'])
+
+    assert response.status_code == 200
+    assert response.get_json()['gemini_response']['prompt'] == "Make a highlight reel"
+    status = client.get(f"/jobs/{job['job_id']}", headers={'X-Job-Token': job['job_token']}).get_json()
+    assert status['status'] == jobs.SUCCEEDED
+
+
+def test_other_clients_get_404(client):
+    job = submit(client)
+    poll_result(client, job['job_id'], job['job_token'])
+
+    for headers in ({}, {'X-Job-Token': submit(client)['job_token']}):
+        assert client.get(f"/jobs/{job['job_id']}", headers=headers).status_code == 404
+        assert client.get(f"/jobs/{job['job_id']}/result", headers=headers).status_code == 404
+    assert client.get("/jobs/unknown", headers={'X-Job-Token': job['job_token']}).status_code == 404
+
+
+def test_another_worker_answers_from_the_shared_store(client, monkeypatch):
+    job = submit(client)
+    poll_result(client, job['job_id'], job['job_token'])
+
+    # A worker that did not run the job has no record of it in memory
+    monkeypatch.setattr(main, "job_manager", jobs.JobManager(workers=1))
+    response = client.get(f"/jobs/{job['job_id']}/result", headers={'X-Job-Token': job['job_token']})
+
+    assert response.status_code == 200
+    assert response.get_json()['gemini_response']['prompt'] == "Make a highlight reel"
@@ -0,0 +1,139 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+import jobs
+
+
+def wait_for(manager, job_id, status, timeout=5):
+    deadline = time.monotonic() + timeout
+    while manager.get(job_id)['status'] != status:
+        assert time.monotonic() < deadline, f"job is still {manager.get(job_id)['status']}"
+        time.sleep(0.01)
+    return manager.get(job_id)
+
+
+@pytest.fixture
+def statuses():
+    return []
+
+
+@pytest.fixture
+def manager(statuses):
+    manager = jobs.JobManager(workers=1, on_status=lambda job: statuses.append((job['job_id'], job['status'])))
+    yield manager
+    manager.shutdown(wait=True, timeout=5)
+
+
+def test_job_runs_and_reports_every_status_change(manager, statuses):
+    job = manager.submit(lambda a, b: {'sum': a + b}, 2, 3, metadata={'user_id': "u"})
+
+    assert job['status'] == jobs.PENDING
+    finished = wait_for(manager, job['job_id'], jobs.SUCCEEDED)
+    assert finished['result'] == {'sum': 5}
+    assert finished['metadata'] == {'user_id': "u"}
+    assert finished['started_at'] <= finished['finished_at']
+    assert statuses == [(job['job_id'], jobs.PENDING), (job['job_id'], jobs.RUNNING),
+                        (job['job_id'], jobs.SUCCEEDED)]
+
+
+def test_failing_job_records_its_error(manager):
+    def fail():
+        raise RuntimeError("ffmpeg crashed")
+
+    job = wait_for(manager, manager.submit(fail)['job_id'], jobs.FAILED)
+
+    assert job['error'] == "ffmpeg crashed"
+    assert job['result'] is None
+
+
+def test_jobs_beyond_the_queue_are_rejected(statuses):
+    release = threading.Event()
+    manager = jobs.JobManager(backend=jobs.InMemoryJobBackend(max_pending=1), workers=1,
+                              on_status=lambda job: statuses.append(job['status']))
+    try:
+        running = manager.submit(release.wait)
+        wait_for(manager, running['job_id'], jobs.RUNNING)
+        manager.submit(release.wait)
+
+        with pytest.raises(jobs.JobRejected):
+            manager.submit(release.wait)
+        assert statuses[-2:] == [jobs.PENDING, jobs.FAILED]
+    finally:
+        release.set()
+        manager.shutdown(wait=True, timeout=5)
+
+
+def test_shutdown_finishes_queued_jobs_and_rejects_new_ones(manager):
+    submitted = [manager.submit(time.sleep, 0.05) for _ in range(3)]
+
+    assert manager.shutdown(wait=True, timeout=5)
+    assert [manager.get(job['job_id'])['status'] for job in submitted] == [jobs.SUCCEEDED] * 3
+    with pytest.raises(jobs.JobRejected):
+        manager.submit(time.sleep, 0)
+
+
+def test_shutdown_timeout_fails_jobs_that_have_not_started(statuses):
+    release = threading.Event()
+    manager = jobs.JobManager(workers=1, on_status=lambda job: statuses.append((job['job_id'], job['status'])))
+    running = manager.submit(release.wait)
+    wait_for(manager, running['job_id'], jobs.RUNNING)
+    queued = manager.submit(release.wait)
+
+    assert not manager.shutdown(wait=True, timeout=0.2)
+    release.set()
+
+    assert manager.get(queued['job_id'])['status'] == jobs.FAILED
+    assert "resubmit" in manager.get(queued['job_id'])['error']
+    assert (queued['job_id'], jobs.FAILED) in statuses
+
+
+def test_async_job_runs_on_the_shared_loop(statuses):
+    manager = jobs.AsyncJobManager(on_status=lambda job: statuses.append(job['status']))
+
+    async def pipeline(seconds):
+        await asyncio.sleep(seconds)
+        return {'slept': seconds}
+
+    job = wait_for(manager, manager.submit(pipeline, 0.05)['job_id'], jobs.SUCCEEDED)
+
+    assert job['result'] == {'slept': 0.05}
+    assert manager.shutdown(wait=True, timeout=5)
+    assert statuses == [jobs.PENDING, jobs.RUNNING, jobs.SUCCEEDED]
+
+
+def test_only_the_submitters_token_matches():
+    token, token_hash = jobs.new_job_token()
+    job = jobs.new_job({'user_id': "u", 'token_hash': token_hash})
+
+    assert jobs.job_token_matches(job, token)
+    assert not jobs.job_token_matches(job, jobs.new_job_token()[0])
+    assert not jobs.job_token_matches(job, None)
+    assert not jobs.job_token_matches(jobs.new_job({'user_id': "u"}), token)
+    assert not jobs.job_token_matches(None, token)
+
+
+def test_shutdown_timeout_fails_jobs_that_are_still_running(statuses):
+    release = threading.Event()
+    manager = jobs.JobManager(workers=1, on_status=lambda job: statuses.append((job['job_id'], job['status'])))
+    running = manager.submit(release.wait)
+    wait_for(manager, running['job_id'], jobs.RUNNING)
+
+    assert not manager.shutdown(wait=True, timeout=0.1)
+
+    assert manager.get(running['job_id'])['error'] == jobs.INTERRUPTED_ERROR
+    assert statuses[-1] == (running['job_id'], jobs.FAILED)
+    release.set()
+
+
+def test_async_shutdown_timeout_fails_jobs_that_are_still_running(statuses):
+    manager = jobs.AsyncJobManager(on_status=lambda job: statuses.append(job['status']))
+    job = manager.submit(asyncio.sleep, 1)
+    wait_for(manager, job['job_id'], jobs.RUNNING)
+
+    assert not manager.shutdown(wait=True, timeout=0.1)
+
+    assert manager.get(job['job_id'])['error'] == jobs.INTERRUPTED_ERROR
+    assert statuses[-1] == jobs.FAILED
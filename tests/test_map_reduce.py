@@ -0,0 +1,201 @@
+import asyncio
+
+import pytest
+
+import fakes
+import map_reduce
+from response_decoder import ResponseDecodeError
+
+# Five 40 second clips, planned into chunks of at most 100 seconds
+CLIPS = {f"users/u/projects/p/videos/clip{i}.mp4": 40 for i in range(5)}
+
+
+class EmptyChunkModel(fakes.FakeGenerativeModel):
+    """Answers map prompts that mention one of `empty_clips` without usable moments."""
+
+    def __init__(self, empty_clips=(), **kwargs):
+        super().__init__(latency=0, **kwargs)
+        self.empty_clips = empty_clips
+
+    def response_for(self, prompt):
+        if '"candidate_moments"' in prompt and any(clip in prompt for clip in self.empty_clips):
+            return {'candidate_moments': "none found"}
+        return super().response_for(prompt)
+
+
+def chunk_media(chunk):
+    file = fakes.FakeFile("files/chunk", "chunk.mp4", "video/mp4", state="ACTIVE")
+    return None, file, map_reduce.timeline({name: CLIPS[name] for name in chunk})
+
+
+def total_seconds(gemini_response):
+    return sum(edit['end_time'] - edit['start_time'] for edit in gemini_response['video_edits'])
+
+
+@pytest.fixture
+def chunks():
+    return map_reduce.plan_chunks(CLIPS, chunk_seconds=100, min_seconds=60)
+
+
+def test_plan_chunks_keeps_short_projects_in_one_chunk():
+    clips = {'a.mp4': 20, 'b.mp4': 20, 'c.mp4': 20}
+
+    assert map_reduce.plan_chunks(clips, chunk_seconds=30, min_seconds=120) == [['a.mp4', 'b.mp4', 'c.mp4']]
+
+
+def test_plan_chunks_follows_clip_boundaries_and_project_order():
+    clips = {'a.mp4': 40, 'b.mp4': 50, 'c.mp4': 30, 'd.mp4': 80, 'e.mp4': 10}
+
+    chunks = map_reduce.plan_chunks(clips, chunk_seconds=100, min_seconds=60)
+
+    assert chunks == [['a.mp4', 'b.mp4'], ['c.mp4'], ['d.mp4', 'e.mp4']]
+    assert [name for chunk in chunks for name in chunk] == list(clips)
+
+
+def test_plan_chunks_gives_a_long_clip_its_own_chunk():
+    clips = {'a.mp4': 10, 'long.mp4': 500, 'b.mp4': 10}
+
+    assert map_reduce.plan_chunks(clips, chunk_seconds=100, min_seconds=60) == [['a.mp4'], ['long.mp4'], ['b.mp4']]
+
+
+def test_parse_moments_clamps_to_the_clip_and_drops_unusable_moments():
+    video_durations = {"users/u/projects/p/videos/a.mp4": [0, 10], "users/u/projects/p/videos/b.mp4": [10, 30]}
+    text = """{"candidate_moments": [
+        {"video_name": "a.mp4", "start_time": -2, "end_time": 99, "score": 3},
+        {"video_name": "users/u/projects/p/videos/b.mp4", "start_time": "5", "end_time": "8.5"},
+        {"video_name": "a.mp4", "start_time": 4, "end_time": 4.2},
+        {"video_name": "missing.mp4", "start_time": 0, "end_time": 5},
+        {"video_name": "a.mp4", "start_time": "soon", "end_time": 5},
+    ]}"""
+
+    moments = map_reduce.parse_moments(text, video_durations)
+
+    assert [(m['video_name'], m['start_time'], m['end_time'], m['score']) for m in moments] == [
+        ("users/u/projects/p/videos/a.mp4", 0.0, 10.0, 1.0),
+        ("users/u/projects/p/videos/b.mp4", 5.0, 8.5, 0.5),
+    ]
+    assert map_reduce.parse_moments("no moments today", video_durations) == []
+
+
+def test_fit_to_length_trims_the_last_edits_and_the_audio():
+    gemini_response = {'video_edits': [{'id': 1, 'start_time': 0, 'end_time': 40},
+                                       {'id': 2, 'start_time': 10, 'end_time': 40},
+                                       {'id': 3, 'start_time': 0, 'end_time': 5}],
+                       'audio_edits': {'start_time': 5, 'end_time': 100}}
+
+    fitted = map_reduce.fit_to_length(gemini_response, max_seconds=60)
+
+    assert [(edit['id'], edit['end_time']) for edit in fitted['video_edits']] == [(1, 40), (2, 30)]
+    assert fitted['audio_edits'] == {'start_time': 5, 'end_time': 65}
+
+
+def test_every_chunk_is_prepared_and_mapped(chunks):
+    prepared = []
+
+    def prepare_chunk(chunk):
+        prepared.append(chunk)
+        return chunk_media(chunk)
+
+    gemini_response = map_reduce.run(chunks, CLIPS, prepare_chunk, "Make a highlight reel", EmptyChunkModel(),
+                                     has_audio=True, concurrency=2)
+
+    assert chunks == [list(CLIPS)[:2], list(CLIPS)[2:4], list(CLIPS)[4:]]
+    assert sorted(prepared) == sorted(chunks)
+    assert len(gemini_response['video_edits']) <= len(CLIPS)
+    assert total_seconds(gemini_response) <= map_reduce.MAX_VIDEO_SECONDS
+
+
+def test_model_reduce_is_fitted_to_the_length_limit(chunks, monkeypatch):
+    monkeypatch.setattr(map_reduce, "REDUCE_MODE", "model")
+
+    gemini_response = map_reduce.run(chunks, CLIPS, chunk_media, "Make a highlight reel", EmptyChunkModel(),
+                                     has_audio=True)
+
+    # The stand-in's reduce answer keeps 32 seconds of every clip, 160 seconds in all
+    assert [edit['id'] for edit in gemini_response['video_edits']] == [1, 2]
+    assert total_seconds(gemini_response) == pytest.approx(map_reduce.MAX_VIDEO_SECONDS)
+    assert gemini_response['audio_edits'] == {'start_time': 0, 'end_time': 30}
+
+
+def test_heuristic_reduce_plays_the_best_moments_in_project_order(chunks, monkeypatch):
+    monkeypatch.setattr(map_reduce, "REDUCE_MODE", "heuristic")
+
+    gemini_response = map_reduce.run(chunks, CLIPS, chunk_media, "Make a highlight reel", EmptyChunkModel(),
+                                     has_audio=True)
+
+    # The stand-in finds an 8 second moment per clip, so all five fit in 60 seconds
+    assert [edit['video_name'] for edit in gemini_response['video_edits']] == list(CLIPS)
+    assert gemini_response['audio_edits'] == {'start_time': 0, 'end_time': 40}
+    assert gemini_response['video_edits'][-1]['transition'] == ""
+
+
+def test_failed_model_reduce_falls_back_to_the_heuristic(chunks, monkeypatch):
+    monkeypatch.setattr(map_reduce, "REDUCE_MODE", "model")
+
+    class NoEditsModel(EmptyChunkModel):
+        def response_for(self, prompt):
+            return super().response_for(prompt) if '"candidate_moments"' in prompt else {'video_edits': []}
+
+    gemini_response = map_reduce.run(chunks, CLIPS, chunk_media, "Make a highlight reel", NoEditsModel(),
+                                     has_audio=False)
+
+    assert [edit['video_name'] for edit in gemini_response['video_edits']] == list(CLIPS)
+    assert gemini_response['audio_edits'] == {'start_time': "", 'end_time': ""}
+
+
+def test_chunks_without_moments_are_left_out(chunks, monkeypatch):
+    monkeypatch.setattr(map_reduce, "REDUCE_MODE", "heuristic")
+    model = EmptyChunkModel(empty_clips=chunks[0])
+
+    gemini_response = map_reduce.run(chunks, CLIPS, chunk_media, "Make a highlight reel", model, has_audio=True)
+
+    assert [edit['video_name'] for edit in gemini_response['video_edits']] == chunks[1] + chunks[2]
+
+
+def test_no_usable_moments_raises(chunks):
+    with pytest.raises(ResponseDecodeError):
+        map_reduce.run(chunks, CLIPS, chunk_media, "Make a highlight reel", EmptyChunkModel(empty_clips=list(CLIPS)),
+                       has_audio=True)
+
+
+def test_failed_chunk_preparation_fails_the_request(chunks):
+    def prepare_chunk(chunk):
+        if chunk == chunks[1]:
+            raise RuntimeError("upload failed")
+        return chunk_media(chunk)
+
+    with pytest.raises(RuntimeError, match="upload failed"):
+        map_reduce.run(chunks, CLIPS, prepare_chunk, "Make a highlight reel", EmptyChunkModel(), has_audio=True)
+
+
+@pytest.mark.parametrize("mode", ["model", "heuristic"])
+def test_async_run_matches_the_threaded_run(chunks, monkeypatch, mode):
+    monkeypatch.setattr(map_reduce, "REDUCE_MODE", mode)
+    prepared = []
+
+    async def prepare_chunk(chunk):
+        prepared.append(chunk)
+        return chunk_media(chunk)
+
+    gemini_response = asyncio.run(map_reduce.run_async(chunks, CLIPS, prepare_chunk, "Make a highlight reel",
+                                                       EmptyChunkModel(), has_audio=True, concurrency=2))
+
+    assert sorted(prepared) == sorted(chunks)
+    assert gemini_response == map_reduce.run(chunks, CLIPS, chunk_media, "Make a highlight reel", EmptyChunkModel(),
+                                             has_audio=True)
+
+
+def test_async_run_leaves_out_chunks_without_moments_and_raises_without_any(chunks, monkeypatch):
+    monkeypatch.setattr(map_reduce, "REDUCE_MODE", "heuristic")
+
+    async def prepare_chunk(chunk):
+        return chunk_media(chunk)
+
+    def run(model):
+        return asyncio.run(map_reduce.run_async(chunks, CLIPS, prepare_chunk, "Make a highlight reel", model,
+                                                has_audio=True))
+
+    assert [edit['video_name'] for edit in run(EmptyChunkModel(empty_clips=chunks[2]))['video_edits']] == \
+        chunks[0] + chunks[1]
+    with pytest.raises(ResponseDecodeError):
+        run(EmptyChunkModel(empty_clips=list(CLIPS)))
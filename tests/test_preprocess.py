@@ -0,0 +1,83 @@
+import time
+import threading
+
+import fakes
+from preprocess import Preprocessor, parse_storage_event
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_uploads_of_project_media_are_accepted():
+    video = fakes.storage_finalize_event("users/u1/projects/p1/videos/clip.mp4")
+    audio = fakes.storage_finalize_event("users/u1/projects/p1/audios/song.mp3", content_type="audio/mpeg")
+
+    assert parse_storage_event(video) == ("u1", "p1")
+    assert parse_storage_event(audio) == ("u1", "p1")
+    # A storage trigger sends the object resource without the CloudEvent envelope
+    assert parse_storage_event(video['data']) == ("u1", "p1")
+
+
+def test_other_payloads_are_rejected():
+    for name in ("users/u1/projects/p1/renders/out.mp4", "users/u1/projects/p1/videos/", "users/u1/avatar.png",
+                 "users/u1/projects/p1/videos/nested/clip.mp4", "other/users/u1/projects/p1/videos/clip.mp4"):
+        assert parse_storage_event(fakes.storage_finalize_event(name)) is None, name
+    for payload in (None, "users/u1/projects/p1/videos/clip.mp4", {}, {'data': {}}, {'name': None}):
+        assert parse_storage_event(payload) is None
+
+
+def test_a_burst_of_uploads_is_prepared_once():
+    runs = []
+    preprocessor = Preprocessor(lambda user_id, project_id: runs.append((user_id, project_id)), debounce=0.1)
+
+    scheduled = [preprocessor.schedule("u1", "p1") for _ in range(5)] + [preprocessor.schedule("u1", "p2")]
+
+    assert scheduled == [True, False, False, False, False, True]
+    wait_until(lambda: len(runs) == 2)
+    time.sleep(0.3)
+    assert sorted(runs) == [("u1", "p1"), ("u1", "p2")]
+
+
+def test_uploads_during_preparation_cause_one_more_run():
+    started, release, runs = threading.Event(), threading.Event(), []
+
+    def prepare(user_id, project_id):
+        runs.append(time.monotonic())
+        started.set()
+        release.wait(5)
+
+    preprocessor = Preprocessor(prepare, debounce=0.05)
+    preprocessor.schedule("u1", "p1")
+    assert started.wait(5)
+
+    assert not preprocessor.schedule("u1", "p1")
+    assert not preprocessor.schedule("u1", "p1")
+    release.set()
+
+    wait_until(lambda: len(runs) == 2)
+    time.sleep(0.3)
+    assert len(runs) == 2
+    # Once both runs are done the project can be scheduled afresh
+    assert preprocessor.schedule("u1", "p1")
+
+
+def test_a_failed_preparation_does_not_block_the_project():
+    runs = []
+
+    def prepare(user_id, project_id):
+        runs.append(project_id)
+        if len(runs) == 1:
+            raise RuntimeError("upload failed")
+
+    preprocessor = Preprocessor(prepare, debounce=0.05)
+    preprocessor.schedule("u1", "p1")
+    wait_until(lambda: len(runs) == 1)
+    time.sleep(0.2)
+
+    assert preprocessor.schedule("u1", "p1")
+
+    wait_until(lambda: len(runs) == 2)
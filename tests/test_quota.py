@@ -0,0 +1,134 @@
+import time
+import types
+import asyncio
+
+import pytest
+
+import fakes
+import quota
+
+
+def scheduler(rates=None, **kwargs):
+    kwargs.setdefault('initial_backoff', 0.01)
+    kwargs.setdefault('max_backoff', 0.05)
+    return quota.QuotaScheduler(quota.MemoryQuotaBackend(), rates or {quota.GENERATE: 6000}, **kwargs)
+
+
+def rejecting(times, message="429 Resource has been exhausted (e.g. check quota)."):
+    """A Gemini call that is rejected for quota `times` times before it succeeds."""
+    calls = []
+
+    def call():
+        calls.append(time.monotonic())
+        if len(calls) <= times:
+            raise fakes.FakeRateLimitError(message)
+        return fakes.FakeResponse("{}")
+    return call, calls
+
+
+def test_rate_limited_call_is_retried_after_the_delay_gemini_asks_for():
+    call, calls = rejecting(1, "429 Resource has been exhausted. Please retry in 0.3s.")
+
+    response = scheduler().call(quota.GENERATE, call)
+
+    assert response.text == "{}"
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.3
+
+
+def test_gives_up_after_max_retries():
+    call, calls = rejecting(10)
+
+    with pytest.raises(quota.QuotaExhausted) as error:
+        scheduler(max_retries=2).call(quota.GENERATE, call)
+
+    assert len(calls) == 3
+    assert 0 < error.value.retry_after <= 0.05
+
+
+def test_other_errors_are_not_retried():
+    calls = []
+
+    def call():
+        calls.append(1)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        scheduler().call(quota.GENERATE, call)
+    assert len(calls) == 1
+
+
+def test_async_call_is_retried():
+    call, calls = rejecting(2)
+
+    async def call_async():
+        return call()
+
+    assert asyncio.run(scheduler().call_async(quota.GENERATE, call_async)).text == "{}"
+    assert len(calls) == 3
+
+
+def test_async_bucket_updates_do_not_block_the_event_loop():
+    class SlowBackend(quota.MemoryQuotaBackend):
+        """Takes as long as a file lock held by another worker."""
+
+        def take(self, demands, now=None):
+            time.sleep(0.3)
+            return super().take(demands, now)
+
+    async def main():
+        gaps = []
+
+        async def tick():
+            last = time.monotonic()
+            for _ in range(20):
+                await asyncio.sleep(0.01)
+                gaps.append(time.monotonic() - last)
+                last = time.monotonic()
+
+        limited = quota.QuotaScheduler(SlowBackend(), {quota.GENERATE: 6000})
+        await asyncio.gather(limited.acquire_async(quota.GENERATE), tick())
+        return max(gaps)
+
+    assert asyncio.run(main()) < 0.2
+
+
+def test_backends_must_provide_state():
+    with pytest.raises(TypeError):
+        quota.QuotaBackend()
+
+
+def test_retry_after_is_read_from_headers_details_and_message():
+    header = types.SimpleNamespace(response=types.SimpleNamespace(headers={'Retry-After': "7"}))
+    detail = types.SimpleNamespace(details=[types.SimpleNamespace(retry_delay=types.SimpleNamespace(seconds=3,
+                                                                                                    nanos=5e8))])
+
+    assert quota.retry_after(header) == 7
+    assert quota.retry_after(detail) == 3.5
+    assert quota.retry_after(Exception("Please retry in 12.5s.")) == 12.5
+    assert quota.retry_after(Exception("quota exceeded")) is None
+
+
+def test_bucket_spaces_out_calls():
+    # 10 calls per second with room for a single call at once
+    limited = scheduler({quota.GENERATE: 600}, burst_seconds=0.1)
+
+    start = time.monotonic()
+    for _ in range(5):
+        limited.call(quota.GENERATE, lambda: None)
+
+    assert time.monotonic() - start >= 0.35
+
+
+def test_scheduled_genai_completes_every_call_under_gemini_quota():
+    genai = fakes.FakeGenaiModule(latency=0, generate_rpm=3, quota_window=0.5)
+    with pytest.raises(fakes.FakeRateLimitError):
+        for _ in range(4):
+            genai.GenerativeModel().generate_content("Make a highlight reel")
+
+    genai = fakes.FakeGenaiModule(latency=0, generate_rpm=3, quota_window=0.5)
+    # The same 3 calls per half second, as requests per minute
+    model = quota.ScheduledGenai(genai, scheduler({quota.GENERATE: 3 * 120}, burst_seconds=0.5)).GenerativeModel()
+    responses = [model.generate_content("Make a highlight reel") for _ in range(8)]
+
+    assert all(response.text for response in responses)
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+import fakes
+from response_decoder import ResponseDecodeError, decode_response, repair_json_text
+
+VIDEO_NAMES = {"users/u/projects/p/videos/a.mp4": (0, 10), "users/u/projects/p/videos/b.mp4": (10, 20)}
+
+
+def video_edit(**fields):
+    edit = {'id': 1, 'video_name': "users/u/projects/p/videos/a.mp4", 'start_time': 1, 'end_time': 4,
+            'effects': [{'name': 'brightness', 'adjustment': 0.1}], 'text': [], 'transition': 'fade'}
+    edit.update(fields)
+    return edit
+
+
+class FixingModel:
+    """Answers every re-ask with the same fixed fragment."""
+
+    def __init__(self, fixed):
+        self.fixed = fixed
+        self.prompts = []
+
+    def generate_content(self, prompt, generation_config=None):
+        self.prompts.append(prompt)
+        return fakes.FakeResponse(json.dumps(self.fixed))
+
+
+def test_valid_response_is_decoded():
+    text = json.dumps({'video_edits': [video_edit()], 'audio_edits': {'start_time': 0, 'end_time': 30}})
+
+    response = decode_response(text, video_names=VIDEO_NAMES)
+
+    assert response['video_edits'][0]['video_name'] == "users/u/projects/p/videos/a.mp4"
+    assert response['audio_edits'] == {'start_time': 0, 'end_time': 30}
+
+
+def test_local_repairs():
+    text = '```json\n{"video_edits": [{"id": 1L, "video_name": "a.mp4", "start_time": "1.5", "end_time": 4.0f,' \
+           ' "effects": null, "text": [], "transition": "fade",},], "audio_edits": {"start_time": 0, "end_'
+
+    response = decode_response(text, video_names=VIDEO_NAMES)
+
+    edit = response['video_edits'][0]
+    assert edit['id'] == 1
+    assert edit['video_name'] == "users/u/projects/p/videos/a.mp4"
+    assert (edit['start_time'], edit['end_time'], edit['effects']) == (1.5, 4.0, [])
+
+
+def test_repair_keeps_string_contents():
+    text = '{"video_edits": [{"text": [{"text": "1L, ]"}]}]}'
+
+    assert repair_json_text(text) == text
+
+
+def test_invalid_edit_is_reasked_once():
+    model = FixingModel(video_edit(start_time=2, end_time=5))
+    text = json.dumps({'video_edits': [video_edit(start_time=5, end_time=2)]})
+
+    response = decode_response(text, model=model, video_names=VIDEO_NAMES)
+
+    assert len(model.prompts) == 1
+    assert (response['video_edits'][0]['start_time'], response['video_edits'][0]['end_time']) == (2, 5)
+
+
+def test_invalid_edits_are_dropped_without_a_model():
+    text = json.dumps({'video_edits': [video_edit(video_name="missing.mp4"), video_edit(id=2)]})
+
+    response = decode_response(text, video_names=VIDEO_NAMES)
+
+    assert [edit['id'] for edit in response['video_edits']] == [2]
+
+
+def test_no_valid_edit_raises():
+    with pytest.raises(ResponseDecodeError):
+        decode_response(json.dumps({'video_edits': [video_edit(end_time=0)]}), video_names=VIDEO_NAMES)
+    with pytest.raises(ResponseDecodeError):
+        decode_response("Sorry, I can't help with that.", model=None)
@@ -0,0 +1,28 @@
+from result_cache import result_key
+
+MEDIA = [("clip0.mp4", "md5-a"), ("clip1.mp4", "md5-b"), ("song.mp3", "md5-c")]
+CONFIG = {'temperature': 0.7}
+
+
+def key(media=MEDIA, prompt="Make a highlight reel", **kwargs):
+    return result_key(media, prompt, "models/gemini", CONFIG, **kwargs)
+
+
+def test_equivalent_prompts_share_a_key():
+    assert key(prompt="  Make a   HIGHLIGHT reel ") == key()
+
+
+def test_media_versions_change_the_key():
+    assert key(media=[("clip0.mp4", "md5-changed")] + MEDIA[1:]) != key()
+    assert key(media=MEDIA[1::-1] + MEDIA[2:]) != key()
+
+
+def test_analysis_settings_change_the_key():
+    single = key(analysis_mode="single")
+    heuristic = key(analysis_mode="map_reduce,min=600,chunk=180,moments=8,reduce=heuristic")
+    model = key(analysis_mode="map_reduce,min=600,chunk=180,moments=8,reduce=model")
+
+    assert len({single, heuristic, model}) == 3
+    assert key() == single
+    assert key(input_mode="keyframes") != single
+    assert key(audio_mode="upload=0,analysis=1,snap=1") != single
@@ -0,0 +1,51 @@
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("firebase_admin")
+
+import fakes
+import main
+from preprocess import Preprocessor
+
+EVENT = fakes.storage_finalize_event("users/u1/projects/p1/videos/clip.mp4")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    runs = []
+    monkeypatch.setattr(main, "PREPROCESS", True)
+    monkeypatch.setattr(main, "INPUT_MODE", "video")
+    monkeypatch.setattr(main, "preprocessor", Preprocessor(lambda *key: runs.append(key), debounce=0.05))
+    client = main.app.test_client()
+    client.runs = runs
+    return client
+
+
+def post(client, payload, token=None):
+    headers = {'X-Event-Token': token} if token is not None else {}
+    return client.post('/events/storage_finalize', json=payload, headers=headers)
+
+
+def test_events_are_refused_without_a_configured_token(client, monkeypatch):
+    monkeypatch.setattr(main, "STORAGE_EVENT_TOKEN", "")
+
+    assert post(client, EVENT).status_code == 403
+    assert post(client, EVENT, token="").status_code == 403
+
+
+def test_events_need_the_configured_token(client, monkeypatch):
+    monkeypatch.setattr(main, "STORAGE_EVENT_TOKEN", "secret")
+
+    assert post(client, EVENT).status_code == 401
+    assert post(client, EVENT, token="guess").status_code == 401
+
+
+def test_accepted_events_schedule_the_project_once(client, monkeypatch):
+    monkeypatch.setattr(main, "STORAGE_EVENT_TOKEN", "secret")
+
+    first, second = post(client, EVENT, token="secret"), post(client, EVENT, token="secret")
+    other = post(client, fakes.storage_finalize_event("users/u1/projects/p1/renders/out.mp4"), token="secret")
+
+    assert (first.status_code, first.get_json()['status']) == (202, "scheduled")
+    assert (second.status_code, second.get_json()['status']) == (202, "coalesced")
+    assert (other.status_code, other.get_json()['status']) == (200, "ignored")
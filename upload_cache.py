@@ -0,0 +1,102 @@
+import os
+import json
+import fcntl
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+
+# Settings for the persistent cache of files uploaded to the Gemini Files API
+UPLOAD_CACHE_PATH = os.getenv("UPLOAD_CACHE_PATH", os.path.join(tempfile.gettempdir(), "craite_upload_cache.json"))
+UPLOAD_CACHE_MAX_ENTRIES = int(os.getenv("UPLOAD_CACHE_MAX_ENTRIES", 256))
+
+# The Files API deletes uploads after 48 hours
+GEMINI_FILE_LIFETIME = timedelta(hours=48)
+# Entries this close to expiry are dropped so a file cannot expire while a request still uses it
+UPLOAD_CACHE_EXPIRY_MARGIN = timedelta(hours=1)
+
+
+class UploadCache:
+    """Maps content hashes of local files to files already uploaded to Gemini.
+
+    Entries are stored in a JSON file so they survive restarts and are shared by
+    every worker on the host. A file lock serializes read-modify-write cycles
+    across processes and a thread lock does the same within a process.
+    """
+
+    def __init__(self, path=UPLOAD_CACHE_PATH, max_entries=UPLOAD_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock, open(f"{self.path}.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            entries = {}
+        # Least recently used entries come first
+        return OrderedDict(sorted(entries.items(), key=lambda item: item[1]['last_used']))
+
+    def _save(self, entries):
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(temp_path, self.path)
+
+    def _evict(self, entries, now):
+        for key in [key for key, entry in entries.items()
+                    if datetime.fromisoformat(entry['expires_at']) - UPLOAD_CACHE_EXPIRY_MARGIN <= now]:
+            del entries[key]
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    # Function to look up an uploaded file by content hash
+    def get(self, key):
+        now = datetime.now(timezone.utc)
+        with self._locked():
+            entries = self._load()
+            self._evict(entries, now)
+            entry = entries.get(key)
+            if entry is not None:
+                entry['last_used'] = now.isoformat()
+                entries.move_to_end(key)
+            self._save(entries)
+        return entry
+
+    # Function to record an uploaded file under the content hash of its source
+    def put(self, key, file):
+        now = datetime.now(timezone.utc)
+        expires_at = getattr(file, 'expiration_time', None) or now + GEMINI_FILE_LIFETIME
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+
+        with self._locked():
+            entries = self._load()
+            entries[key] = {
+                'name': file.name,
+                'uri': file.uri,
+                'mime_type': getattr(file, 'mime_type', None),
+                'expires_at': expires_at.isoformat(),
+                'last_used': now.isoformat(),
+            }
+            entries.move_to_end(key)
+            self._evict(entries, now)
+            self._save(entries)
+
+    def remove(self, key):
+        with self._locked():
+            entries = self._load()
+            if entries.pop(key, None) is not None:
+                self._save(entries)
@@ -0,0 +1,503 @@
+import os
+import json
+import uuid
+import time
+import hashlib
+import tempfile
+import threading
+import concurrent.futures
+import ffmpeg
+import helpers
+import metrics
+import mp4_probe
+
+
+# Settings for the low-bitrate copy of the concatenated video that is sent to Gemini
+PROXY_HEIGHT = int(os.getenv("PROXY_HEIGHT", 360))
+PROXY_MAX_FPS = float(os.getenv("PROXY_MAX_FPS", 10))
+PROXY_CRF = int(os.getenv("PROXY_CRF", 30))
+PROXY_AUDIO_BITRATE = os.getenv("PROXY_AUDIO_BITRATE", "32k")
+
+# Settings for reusing concatenations and normalized clips across requests
+CONCAT_CACHE_DIR = os.getenv("CONCAT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "craite_concat"))
+CONCAT_CACHE_MAX_BYTES = int(os.getenv("CONCAT_CACHE_MAX_BYTES", 10 * 1024 ** 3))
+# Files used this recently are never evicted, so a request cannot lose files it is still reading
+CONCAT_CACHE_PIN_SECONDS = int(os.getenv("CONCAT_CACHE_PIN_SECONDS", 900))
+# Number of clips normalized in parallel when their formats differ
+CONCAT_WORKERS = int(os.getenv("CONCAT_WORKERS", 2))
+
+# Number of clips probed at once
+PROBE_MAX_WORKERS = int(os.getenv("PROBE_MAX_WORKERS", 8))
+
+# Time taken to read the properties of one clip, by method
+clip_probe_seconds = metrics.Histogram(
+    "clip_probe_seconds",
+    "Seconds spent reading the properties of one clip",
+    labelnames=("method",),
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+# Content hashes of clips keyed by path, size and modification time
+_clip_hashes = {}
+
+
+class Video:
+
+    # Function to read codec, resolution, frame rate and duration of a clip from its container
+    @staticmethod
+    def probe_video(path):
+        """Reads the properties of a clip from container metadata without decoding any frames.
+
+        MP4 and MOV files are parsed in-process (see mp4_probe); anything else,
+        including fragmented files, falls back to ffprobe. The time taken is
+        recorded per method in the clip_probe_seconds histogram.
+
+        Args:
+            path: Path to the media file.
+
+        Returns:
+            A dictionary with the container duration and the properties of the
+            first video and audio streams that matter for stream-copy concatenation,
+            plus 'probe_method' and 'probe_seconds'.
+        """
+        start = time.monotonic()
+        try:
+            probe = mp4_probe.probe_mp4(path)
+            method = 'mp4'
+        except mp4_probe.Mp4ParseError:
+            probe = Video.ffprobe_video(path)
+            method = 'ffprobe'
+        seconds = time.monotonic() - start
+        clip_probe_seconds.observe(seconds, method=method)
+        probe.update(probe_method=method, probe_seconds=seconds)
+        return probe
+
+    # Function to probe several clips at once
+    @staticmethod
+    def probe_videos(paths, max_workers=PROBE_MAX_WORKERS):
+        """Probes clips concurrently, so clips that need ffprobe do not wait on each other.
+
+        Returns:
+            The probes, in the same order as paths.
+        """
+        if not paths:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(paths)))) as executor:
+            probes = list(executor.map(Video.probe_video, paths))
+        for probe in probes:
+            print(f"Probed {probe['path']} with {probe['probe_method']} in {probe['probe_seconds'] * 1000:.1f}ms")
+        return probes
+
+    # Function to read clip properties with ffprobe
+    @staticmethod
+    def ffprobe_video(path):
+        info = ffmpeg.probe(path)
+        video_stream = next((s for s in info['streams'] if s['codec_type'] == 'video'), None)
+        audio_stream = next((s for s in info['streams'] if s['codec_type'] == 'audio'), None)
+
+        if video_stream is None:
+            raise ValueError(f"No video stream found in: {path}")
+
+        duration = info.get('format', {}).get('duration') or video_stream.get('duration') or 0
+
+        probe = {
+            'path': path,
+            'duration': float(duration),
+            'video_codec': video_stream.get('codec_name'),
+            'width': int(video_stream.get('width', 0)),
+            'height': int(video_stream.get('height', 0)),
+            'pix_fmt': video_stream.get('pix_fmt'),
+            'frame_rate': video_stream.get('r_frame_rate'),
+            'rotation': Video._stream_rotation(video_stream),
+            'has_audio': audio_stream is not None,
+            'audio_codec': audio_stream.get('codec_name') if audio_stream else None,
+            'sample_rate': int(audio_stream.get('sample_rate', 0)) if audio_stream else None,
+            'channels': audio_stream.get('channels') if audio_stream else None,
+        }
+        return probe
+
+    @staticmethod
+    def _stream_rotation(stream):
+        rotation = stream.get('tags', {}).get('rotate')
+        if rotation is None:
+            for side_data in stream.get('side_data_list', []):
+                if 'rotation' in side_data:
+                    rotation = side_data['rotation']
+                    break
+        return int(float(rotation)) % 360 if rotation is not None else 0
+
+    # Function to check whether clips can be joined by the concat demuxer without re-encoding
+    @staticmethod
+    def clips_are_compatible(probes):
+        keys = ('video_codec', 'width', 'height', 'pix_fmt', 'frame_rate', 'rotation',
+                'has_audio', 'audio_codec', 'sample_rate', 'channels')
+        first = probes[0]
+        return all(all(probe[key] == first[key] for key in keys) for probe in probes[1:])
+
+    @staticmethod
+    def _frame_rate_value(frame_rate):
+        try:
+            numerator, denominator = frame_rate.split('/')
+            return float(numerator) / float(denominator)
+        except (AttributeError, ValueError, ZeroDivisionError):
+            return 30.0
+
+    # Function to join clips with the concat demuxer and stream copy
+    @staticmethod
+    def stream_copy_concat(paths, output_path):
+        list_path = f"{output_path}.txt"
+        with open(list_path, 'w') as list_file:
+            for path in paths:
+                escaped = os.path.abspath(path).replace("'", "'\\''")
+                list_file.write(f"file '{escaped}'\n")
+
+        try:
+            (
+                ffmpeg
+                .input(list_path, format='concat', safe=0)
+                .output(output_path, c='copy', movflags='+faststart')
+                .overwrite_output()
+                .run(quiet=True)
+            )
+        finally:
+            os.remove(list_path)
+        return output_path
+
+    # Function to join clips of different formats in a single normalizing transcode pass
+    @staticmethod
+    def transcode_concat(probes, output_path):
+        # Normalize everything to the first clip's geometry and the highest frame rate present
+        width = probes[0]['width']
+        height = probes[0]['height']
+        if probes[0]['rotation'] in (90, 270):
+            width, height = height, width
+        width, height = width - width % 2, height - height % 2
+        fps = max(Video._frame_rate_value(probe['frame_rate']) for probe in probes)
+
+        streams = []
+        for probe in probes:
+            source = ffmpeg.input(probe['path'])
+            video = (
+                source.video
+                .filter('scale', width, height, force_original_aspect_ratio='decrease')
+                .filter('pad', width, height, '(ow-iw)/2', '(oh-ih)/2')
+                .filter('setsar', 1)
+                .filter('fps', fps=fps)
+                .filter('format', 'yuv420p')
+            )
+            if probe['has_audio']:
+                audio = source.audio.filter('aresample', 44100).filter('aformat', channel_layouts='stereo')
+            else:
+                # Clips without sound still need an audio segment so the concat filter stays aligned
+                audio = ffmpeg.input('anullsrc=channel_layout=stereo:sample_rate=44100',
+                                     f='lavfi', t=probe['duration']).audio
+            streams.extend([video, audio])
+
+        joined = ffmpeg.concat(*streams, v=1, a=1).node
+        (
+            ffmpeg
+            .output(joined[0], joined[1], output_path,
+                    vcodec='libx264', preset='veryfast', crf=23,
+                    acodec='aac', movflags='+faststart')
+            .overwrite_output()
+            .run(quiet=True)
+        )
+        return output_path
+
+    @staticmethod
+    def concatenate_videos(video_data, output_dir):
+        """Concatenates multiple videos from a dictionary and returns the output path,
+        durations, and total duration.
+
+        Clips that share codec, resolution, frame rate and audio layout are joined
+        with the concat demuxer without re-encoding. Otherwise a single transcode
+        pass normalizes them to a common format.
+
+        Args:
+            video_data: A dictionary with video names as keys and their paths as values.
+            output_dir: The directory to save the concatenated video in.
+
+        Returns:
+            A tuple containing:
+                - The output path of the concatenated video.
+                - A dictionary with video names as keys and lists of [start_timestamp, end_timestamp] for durations.
+                - The total duration of the concatenated video in seconds.
+        """
+        durations = {}
+        total_duration = 0
+
+        probes = Video.probe_videos(list(video_data.values()))
+        for video_name, probe in zip(video_data, probes):
+            duration = probe['duration']
+            durations[video_name] = [total_duration, total_duration + duration]
+            total_duration += duration
+
+        basename, extension = os.path.splitext(os.path.basename(next(iter(video_data.values()))))
+        new_filename = f"{basename}_{uuid.uuid4()}{extension}"
+        output_clip_path = os.path.join(output_dir, new_filename)
+
+        if Video.clips_are_compatible(probes):
+            Video.stream_copy_concat([probe['path'] for probe in probes], output_clip_path)
+            print(f"Concatenated {len(probes)} videos with stream copy to: {output_clip_path}")
+        else:
+            Video.transcode_concat(probes, output_clip_path)
+            print(f"Concatenated {len(probes)} videos with transcode to: {output_clip_path}")
+
+        return output_clip_path, durations, total_duration
+
+    # Function to hash a clip, remembering the hashes of files that have not changed
+    @staticmethod
+    def clip_hash(path):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if key not in _clip_hashes:
+            if len(_clip_hashes) > 4096:
+                _clip_hashes.clear()
+            _clip_hashes[key] = helpers.file_sha256(path)
+        return _clip_hashes[key]
+
+    # Function to re-encode one clip to a common format so it can be joined by stream copy
+    @staticmethod
+    def normalize_clip(probe, output_path, width, height, fps):
+        source = ffmpeg.input(probe['path'])
+        video = (
+            source.video
+            .filter('scale', width, height, force_original_aspect_ratio='decrease')
+            .filter('pad', width, height, '(ow-iw)/2', '(oh-ih)/2')
+            .filter('setsar', 1)
+            .filter('fps', fps=fps)
+            .filter('format', 'yuv420p')
+        )
+        if probe['has_audio']:
+            audio = source.audio.filter('aresample', 44100).filter('aformat', channel_layouts='stereo')
+        else:
+            audio = ffmpeg.input('anullsrc=channel_layout=stereo:sample_rate=44100',
+                                 f='lavfi', t=probe['duration']).audio
+
+        partial_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.partial.mp4"
+        (
+            ffmpeg
+            .output(video, audio, partial_path, vcodec='libx264', preset='veryfast', crf=23,
+                    acodec='aac', ar=44100, ac=2, t=probe['duration'])
+            .overwrite_output()
+            .run(quiet=True)
+        )
+        os.replace(partial_path, output_path)
+        return output_path
+
+    @staticmethod
+    def _manifest_path(cache_dir, hashes):
+        key = hashlib.sha256("\n".join(hashes).encode()).hexdigest()
+        return os.path.join(cache_dir, "manifests", f"{key}.json"), key
+
+    @staticmethod
+    def _load_manifest(cache_dir, hashes):
+        manifest_path, _ = Video._manifest_path(cache_dir, hashes)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # The output may have been evicted since the manifest was written
+        if manifest['clips'] != hashes or not os.path.exists(manifest['output']):
+            return None
+        os.utime(manifest['output'])
+        return manifest
+
+    # Function to concatenate clips, reusing the concatenation of an earlier prefix of the same clips
+    @staticmethod
+    def concatenate_videos_incremental(video_data, output_dir=None, cache_dir=CONCAT_CACHE_DIR):
+        """Concatenates videos like concatenate_videos, reusing earlier work.
+
+        Every concatenation is recorded in a manifest keyed by the ordered list
+        of clip content hashes, holding the output and the clip durations. The
+        longest cached prefix of the requested clips is looked up, and only the
+        clips after it are probed and joined to the cached output with stream
+        copy; appending a clip to a project therefore costs one clip. Clips of
+        differing formats are normalized one by one (in parallel) to the first
+        clip's geometry and frame rate, and the normalized intermediates are
+        cached too.
+
+        Args:
+            video_data: A dictionary with video names as keys and their paths as values.
+            output_dir: Unused; the output is kept in the cache and must not be modified.
+            cache_dir: Directory of the manifests, intermediates and outputs.
+
+        Returns:
+            The same tuple as concatenate_videos.
+        """
+        names, paths = list(video_data), list(video_data.values())
+        hashes = [Video.clip_hash(path) for path in paths]
+        for subdirectory in ("manifests", "clips", "outputs"):
+            os.makedirs(os.path.join(cache_dir, subdirectory), exist_ok=True)
+
+        manifest, prefix_length = None, 0
+        for length in range(len(hashes), 0, -1):
+            manifest = Video._load_manifest(cache_dir, hashes[:length])
+            if manifest is not None:
+                prefix_length = length
+                break
+
+        if prefix_length < len(hashes):
+            tail_probes = Video.probe_videos(paths[prefix_length:])
+            if manifest is not None and manifest['mode'] == 'copy' \
+                    and not Video.clips_are_compatible([manifest['reference']] + tail_probes):
+                # An appended clip has a different format, so the cached output cannot be extended
+                manifest, prefix_length = None, 0
+                tail_probes = Video.probe_videos(paths[:len(paths) - len(tail_probes)]) + tail_probes
+            manifest = Video._extend_concatenation(manifest, hashes, tail_probes, cache_dir)
+            print(f"Concatenated {len(paths)} videos, {prefix_length} reused from cache: {manifest['output']}")
+        else:
+            print(f"Reusing concatenation of {len(paths)} videos: {manifest['output']}")
+
+        durations, total_duration = {}, 0
+        for name, duration in zip(names, manifest['durations']):
+            durations[name] = [total_duration, total_duration + duration]
+            total_duration += duration
+
+        Video.prune_concat_cache(cache_dir)
+        return manifest['output'], durations, total_duration
+
+    @staticmethod
+    def _extend_concatenation(manifest, hashes, tail_probes, cache_dir):
+        tail_hashes = hashes[len(hashes) - len(tail_probes):]
+        if manifest is None:
+            reference = tail_probes[0]
+            width, height = reference['width'], reference['height']
+            if reference['rotation'] in (90, 270):
+                width, height = height, width
+            geometry = [width - width % 2, height - height % 2, Video._frame_rate_value(reference['frame_rate'])]
+            mode = 'copy' if Video.clips_are_compatible(tail_probes) else 'normalized'
+            parts = []
+        else:
+            reference, geometry, mode = manifest['reference'], manifest['geometry'], manifest['mode']
+            parts = [manifest['output']]
+
+        if mode == 'copy':
+            parts.extend(probe['path'] for probe in tail_probes)
+        else:
+            normalized = [os.path.join(cache_dir, "clips", f"{clip_hash}_{geometry[0]}x{geometry[1]}_{geometry[2]:g}.mp4")
+                          for clip_hash in tail_hashes]
+            # Identical clips share one intermediate
+            pending = {path: probe for probe, path in zip(tail_probes, normalized) if not os.path.exists(path)}
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, CONCAT_WORKERS)) as executor:
+                futures = [executor.submit(Video.normalize_clip, probe, path, *geometry) for path, probe in pending.items()]
+                for future in futures:
+                    future.result()
+            parts.extend(normalized)
+
+        _, key = Video._manifest_path(cache_dir, hashes)
+        output_path = os.path.join(cache_dir, "outputs", f"{key}.mp4")
+        partial_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.partial.mp4"
+        Video.stream_copy_concat(parts, partial_path)
+        os.replace(partial_path, output_path)
+
+        extended = {
+            'clips': hashes,
+            'durations': (manifest['durations'] if manifest else []) + [probe['duration'] for probe in tail_probes],
+            'output': output_path,
+            'mode': mode,
+            'reference': reference,
+            'geometry': geometry,
+        }
+        manifest_path, _ = Video._manifest_path(cache_dir, hashes)
+        temp_path = f"{manifest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(extended, f)
+        os.replace(temp_path, manifest_path)
+        return extended
+
+    # Function to delete the least recently used outputs and intermediates above the cache size limit
+    @staticmethod
+    def prune_concat_cache(cache_dir=CONCAT_CACHE_DIR, max_bytes=CONCAT_CACHE_MAX_BYTES,
+                           pin_seconds=CONCAT_CACHE_PIN_SECONDS):
+        entries = []
+        for subdirectory in ("clips", "outputs"):
+            directory = os.path.join(cache_dir, subdirectory)
+            for name in os.listdir(directory):
+                if name.endswith('.partial.mp4'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(directory, name)))
+
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            if now - mtime < pin_seconds:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    @staticmethod
+    def create_analysis_proxy(input_path, output_dir, height=PROXY_HEIGHT, max_fps=PROXY_MAX_FPS,
+                              crf=PROXY_CRF, audio_bitrate=PROXY_AUDIO_BITRATE):
+        """Encodes a small copy of a video that is only used for model analysis.
+
+        The proxy is downscaled to at most `height` pixels, capped at `max_fps` and
+        carries a mono low-bitrate audio track. No frames are trimmed and the
+        container starts at zero, so timestamps in the proxy match the source and
+        the video_durations map stays valid.
+
+        Args:
+            input_path: Path to the (concatenated) source video.
+            output_dir: The directory to save the proxy in.
+            height: Maximum height of the proxy in pixels.
+            max_fps: Maximum frame rate of the proxy.
+            crf: x264 constant rate factor for the proxy video.
+            audio_bitrate: Bitrate of the mono audio track.
+
+        Returns:
+            A tuple containing:
+                - The path of the proxy, or input_path if the proxy would not be smaller.
+                - A dictionary with source_bytes, proxy_bytes, saved_bytes and saved_ratio.
+        """
+        probe = Video.probe_video(input_path)
+
+        # ffmpeg applies the rotation tag while decoding, so compare against the displayed height
+        source_height = probe['width'] if probe['rotation'] in (90, 270) else probe['height']
+        target_height = min(source_height, height)
+        target_height -= target_height % 2
+        fps = min(Video._frame_rate_value(probe['frame_rate']), max_fps)
+
+        basename, _ = os.path.splitext(os.path.basename(input_path))
+        proxy_path = os.path.join(output_dir, f"{basename}_proxy.mp4")
+
+        source = ffmpeg.input(input_path)
+        streams = [source.video.filter('scale', -2, target_height).filter('fps', fps=fps)]
+        output_args = {'vcodec': 'libx264', 'preset': 'veryfast', 'crf': crf,
+                       'pix_fmt': 'yuv420p', 'movflags': '+faststart'}
+        if probe['has_audio']:
+            streams.append(source.audio)
+            output_args.update({'acodec': 'aac', 'ac': 1, 'audio_bitrate': audio_bitrate})
+
+        (
+            ffmpeg
+            .output(*streams, proxy_path, **output_args)
+            .overwrite_output()
+            .run(quiet=True)
+        )
+
+        source_bytes = os.path.getsize(input_path)
+        proxy_bytes = os.path.getsize(proxy_path)
+        if proxy_bytes >= source_bytes:
+            print(f"Proxy for {input_path} is not smaller than the source, using the source")
+            os.remove(proxy_path)
+            proxy_path, proxy_bytes = input_path, source_bytes
+
+        saved_bytes = source_bytes - proxy_bytes
+        stats = {
+            'source_bytes': source_bytes,
+            'proxy_bytes': proxy_bytes,
+            'saved_bytes': saved_bytes,
+            'saved_ratio': saved_bytes / source_bytes if source_bytes else 0,
+        }
+        print(f"Analysis proxy saved {saved_bytes} bytes ({stats['saved_ratio']:.0%}): {proxy_path}")
+        return proxy_path, stats